@@ -0,0 +1,60 @@
+"""
+Writes rotated copies of every trial in a training directory (replaces running rotate_nifti.ipynb once per trial
+and angle).
+
+Usage:
+    python augment_nifti.py /path/to/training_dir --angles -30,30,135 --processes 8
+    python augment_nifti.py /path/to/training_dir --angles 90 --trials trial11_60_fs,trial12_30_fs --uncompressed
+
+Each trial folder gets a sibling <trial>_r<angle>_rot per angle, holding the rotated volume and segmentation in
+their original dtype and orientation, so training.py loads them as augmented data. Jobs whose
+output folder exists are skipped unless --overwrite is given.
+"""
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+import logging
+sys.path.append('src/')
+import pipeline
+import augmentation
+
+
+logger = logging.getLogger('__name__')
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Rotate all trials of a training directory.')
+    parser.add_argument('training_dir', action='store')
+    parser.add_argument('--angles', action='store', required=True, help='Comma separated rotations in degrees, e.g. -30,30.')
+    parser.add_argument('--trials', action='store', default=None, help='Comma separated trial folders to rotate (default: all).')
+    parser.add_argument('--save-dir', action='store', default=None, help='Parent folder of the outputs (default: training_dir).')
+    parser.add_argument('--processes', action='store', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--uncompressed', action='store_true', help='Write .nii instead of .nii.gz.')
+    parser.add_argument('--overwrite', action='store_true')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    angles = [int(angle) for angle in args.angles.split(',') if angle.strip()]
+    trial_dirs = sorted(pipeline.find_scan_paths(args.training_dir, load_augmented=False))
+    if args.trials:
+        selected = set(trial.strip() for trial in args.trials.split(','))
+        trial_dirs = [trial_dir for trial_dir in trial_dirs if os.path.basename(trial_dir) in selected]
+
+    start = time.time()
+    written = augmentation.rotate_trials(trial_dirs, angles, args.save_dir or args.training_dir, processes=args.processes,
+                                         compress=not args.uncompressed, overwrite=args.overwrite)
+    logger.info("Wrote %d rotated trials in %.1f s.", len(written), time.time() - start)
+
+
+if __name__ == '__main__':
+    stream = logging.StreamHandler(stream=sys.stdout)
+    stream.setFormatter(logging.Formatter("%(levelname)-8s %(message)s"))
+    logger.handlers = []
+    logger.addHandler(stream)
+    logger.setLevel(logging.INFO)
+    main()
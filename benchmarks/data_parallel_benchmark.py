@@ -0,0 +1,95 @@
+"""
+Measures data-parallel training throughput for each tower count.
+
+Usage (from the repository root):
+    python benchmarks/data_parallel_benchmark.py --devices cpu --counts 1,2,4 --batch-size 8
+    python benchmarks/data_parallel_benchmark.py --devices gpu --counts 1,2 --batch-size 8
+
+With --devices cpu, the session is given as many virtual CPU devices as the largest count, so towers can be
+exercised on a machine without GPUs. Each count trains a fresh model on the same synthetic batch and reports
+slices/sec.
+"""
+
+import sys
+import json
+import time
+import argparse
+sys.path.append('src/')
+import numpy as np
+import tensorflow as tf
+import Unet
+import session_config
+import synthetic
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark data-parallel Unet training.')
+    parser.add_argument('--devices', choices=['cpu', 'gpu'], default='cpu')
+    parser.add_argument('--counts', default='1,2,4')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--size', type=int, default=128)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--intra-op-threads', default='0')
+    parser.add_argument('--output', default=None, help='Append results as JSON lines to this file.')
+    return parser.parse_args()
+
+
+def make_labels(labels):
+    # One-hot over the nine label channels the network predicts; everything that is not bone or biceps is class 0.
+    encoded = np.zeros(labels.shape + (9,), dtype=np.float32)
+    encoded[..., 0] = 1
+    for channel, label in ((1, synthetic.HUMERUS_LABEL), (6, synthetic.BICEPS_LABEL)):
+        mask = labels == label
+        encoded[mask, 0] = 0
+        encoded[mask, channel] = 1
+    return encoded
+
+
+def run_count(x, y, count, args):
+    overrides = {'intra_op_threads': args.intra_op_threads,
+                 'tower_devices': args.devices if count > 1 else '',
+                 'virtual_cpus': count if args.devices == 'cpu' else 1}
+    session_params = session_config.get_session_params({}, overrides)
+    devices = ['/%s:%d' % (args.devices, i) for i in range(count)]
+
+    tf.reset_default_graph()
+    sess = session_config.create_session(session_params)
+    model = Unet.Unet(0, 1e-6, 1e-4, h=args.size, w=args.size, devices=devices)
+    sess.run(tf.global_variables_initializer())
+
+    model.fit_batch(sess, x, y)
+    start = time.time()
+    for _ in range(args.steps):
+        model.fit_batch(sess, x, y)
+    elapsed = time.time() - start
+    sess.close()
+    return args.steps * x.shape[0] / elapsed
+
+
+def main():
+    args = get_args()
+    visible_devices = 'all' if args.devices == 'gpu' else ''
+    session_config.apply_visible_devices(session_config.get_session_params({'visible_devices': visible_devices}))
+
+    volume, labels = synthetic.make_volume(args.batch_size, args.size, args.size)
+    x = volume[..., np.newaxis]
+    y = make_labels(labels)
+
+    results = []
+    baseline = None
+    for count in [int(c) for c in args.counts.split(',')]:
+        slices_per_sec = run_count(x, y, count, args)
+        baseline = baseline or slices_per_sec
+        results.append({'devices': args.devices, 'count': count, 'batch_size': args.batch_size, 'size': args.size,
+                        'slices_per_sec': slices_per_sec, 'speedup': slices_per_sec / baseline,
+                        'timestamp': time.time()})
+        print("{} x {}: {:8.2f} slices/sec ({:.2f}x)".format(count, args.devices, slices_per_sec, slices_per_sec / baseline))
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == '__main__':
+    main()
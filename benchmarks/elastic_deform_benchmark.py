@@ -0,0 +1,101 @@
+"""
+Measures elastic deformation throughput (slices/sec) of the per-slice loop in elastic_deform_nifti.ipynb against
+augmentation.elastic_deform_volume with different chunk sizes and process counts, on a synthetic volume.
+
+Usage (from the repository root):
+    python benchmarks/elastic_deform_benchmark.py --slices 128 --size 512 --chunks 8,32 --processes 1,4 --output deform_bench.jsonl
+"""
+
+import sys
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+sys.path.append('src/')
+import numpy as np
+from scipy.ndimage import gaussian_filter, map_coordinates
+import augmentation
+import synthetic
+
+
+def get_args():
+    cores = multiprocessing.cpu_count()
+    parser = argparse.ArgumentParser(description='Benchmark batched elastic deformation.')
+    parser.add_argument('--slices', type=int, default=64)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--alpha', type=float, default=10)
+    parser.add_argument('--sigma', type=float, default=3)
+    parser.add_argument('--chunks', default='8,32')
+    parser.add_argument('--processes', default=",".join(str(n) for n in sorted({1, max(cores // 2, 1), cores})))
+    parser.add_argument('--skip-reference', action='store_true', help='Do not time the notebook loop.')
+    parser.add_argument('--output', default=None, help='Append results as JSON lines to this file.')
+    return parser.parse_args()
+
+
+def elastic_transform_reference(image, alpha, sigma, rand_arr1, rand_arr2, int_order):
+    # elastic_transform from elastic_deform_nifti.ipynb, unchanged.
+    shape = image.shape
+    dx = gaussian_filter((rand_arr1 * 2 - 1), sigma, mode="constant", cval=0) * alpha
+    dy = gaussian_filter((rand_arr2 * 2 - 1), sigma, mode="constant", cval=0) * alpha
+    x, y = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+    indices = np.reshape(x+dx, (-1, 1)), np.reshape(y+dy, (-1, 1))
+    return map_coordinates(image, indices, order=int_order).reshape(shape)
+
+
+def run_reference(vol, seg, alpha, sigma):
+    randomizer = np.random.RandomState(0)
+    start = time.time()
+    for i in range(vol.shape[0]):
+        rand_arr1 = randomizer.rand(*vol[i].shape)
+        rand_arr2 = randomizer.rand(*vol[i].shape)
+        elastic_transform_reference(vol[i], alpha, sigma, rand_arr1, rand_arr2, int_order=1)
+        elastic_transform_reference(seg[i], alpha, sigma, rand_arr1, rand_arr2, int_order=0)
+    return vol.shape[0] / (time.time() - start)
+
+
+def run_batched(vol, seg, alpha, sigma, chunk_size, processes):
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    try:
+        if pool is not None:
+            # Warm-up so worker start-up is not timed.
+            augmentation.elastic_deform_volume(vol[:processes], seg[:processes], alpha, sigma, seed=0, chunk_size=1, pool=pool)
+        start = time.time()
+        vol_def, seg_def = augmentation.elastic_deform_volume(vol, seg, alpha, sigma, seed=0, chunk_size=chunk_size, pool=pool)
+        elapsed = time.time() - start
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    assert set(np.unique(seg_def)) <= set(np.unique(seg)), "label values changed"
+    return vol.shape[0] / elapsed
+
+
+def main():
+    args = get_args()
+    vol, seg = synthetic.make_volume(args.slices, args.size, args.size)
+
+    results = []
+    if not args.skip_reference:
+        results.append({'method': 'notebook loop', 'chunk_size': 1, 'processes': 1,
+                        'slices_per_sec': run_reference(vol, seg, args.alpha, args.sigma)})
+    for chunk_size, processes in itertools.product([int(c) for c in args.chunks.split(',')],
+                                                   [int(p) for p in args.processes.split(',')]):
+        results.append({'method': 'batched', 'chunk_size': chunk_size, 'processes': processes,
+                        'slices_per_sec': run_batched(vol, seg, args.alpha, args.sigma, chunk_size, processes)})
+
+    baseline = results[0]['slices_per_sec']
+    print("%-14s %6s %9s %12s %8s" % ('method', 'chunk', 'processes', 'slices/sec', 'speedup'))
+    for result in results:
+        result.update({'slices': args.slices, 'size': args.size, 'alpha': args.alpha, 'sigma': args.sigma})
+        print("%-14s %6d %9d %12.2f %7.2fx" % (result['method'], result['chunk_size'], result['processes'],
+                                              result['slices_per_sec'], result['slices_per_sec'] / baseline))
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Runtime and accuracy of the registration profiles (registration.REGISTRATION_PROFILES) against the default parameter
+maps, on a synthetic target and a rotated and shifted synthetic atlas surrounded by empty space like a real sweep.
+
+Usage (from the repository root):
+    python benchmarks/registration_profiles.py --slices 64 --size 128 --zero-margin 32 --profiles fast,balanced,accurate --unmasked --output reg_profiles.jsonl
+
+Reports wall time and the Dice of humerus and biceps of every profile against the target's ground truth. With
+--unmasked every profile also runs without masks and cropping (as "<profile>-unmasked"), which separates their effect
+from that of the iteration, pyramid and sample settings.
+"""
+
+import sys
+import json
+import time
+import argparse
+sys.path.append('./')
+sys.path.append('src/')
+import numpy as np
+import SimpleITK as sitk
+import registration
+import synthetic
+from registration_init_benchmark import make_atlas, to_image, dice
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark registration profiles.')
+    parser.add_argument('--slices', type=int, default=64)
+    parser.add_argument('--size', type=int, default=128)
+    parser.add_argument('--zero-margin', type=int, default=32, help='Empty voxels added around each slice.')
+    parser.add_argument('--rotation', type=float, default=10)
+    parser.add_argument('--shift', type=float, default=5)
+    parser.add_argument('--profiles', default=",".join(sorted(registration.REGISTRATION_PROFILES)))
+    parser.add_argument('--skip-default', action='store_true', help='Do not time the default parameter maps.')
+    parser.add_argument('--unmasked', action='store_true', help='Also run every profile without masks and cropping.')
+    parser.add_argument('--threads', type=int, default=0, help='Elastix threads (default: all cores).')
+    parser.add_argument('--output', default=None, help='Append results as JSON lines to this file.')
+    return parser.parse_args()
+
+
+def pad(arr, margin):
+    return np.pad(arr, ((0, 0), (margin, margin), (margin, margin)), mode='constant')
+
+
+def main():
+    args = get_args()
+    target_volume, target_labels = synthetic.make_volume(args.slices, args.size, args.size, seed=0)
+    atlas_volume, atlas_labels = make_atlas(args.size, args.slices, args.rotation, args.shift)
+    target_volume, target_labels = pad(target_volume, args.zero_margin), pad(target_labels, args.zero_margin)
+    target = to_image(target_volume)
+    atlas = to_image(pad(atlas_volume, args.zero_margin))
+    atlas_seg = to_image(pad(atlas_labels, args.zero_margin))
+    threads = args.threads or None
+
+    runs = []
+    if not args.skip_default:
+        runs.append(('default', lambda: registration.segment(target, atlas, atlas_seg, registration.get_default_parameter_maps(), num_threads=threads)))
+    for profile in args.profiles.split(','):
+        runs.append((profile, lambda profile=profile: registration.segment_profile(target, atlas, atlas_seg, profile, num_threads=threads)))
+        if args.unmasked:
+            runs.append((profile + '-unmasked', lambda profile=profile: registration.segment_profile(
+                target, atlas, atlas_seg, profile, num_threads=threads, masks=False, crop=False)))
+
+    results = []
+    for name, run in runs:
+        start = time.time()
+        result = np.rint(sitk.GetArrayFromImage(run())).astype(np.int16)
+        results.append({'profile': name, 'seconds': time.time() - start,
+                        'dice_humerus': dice(result, target_labels, synthetic.HUMERUS_LABEL),
+                        'dice_biceps': dice(result, target_labels, synthetic.BICEPS_LABEL),
+                        'slices': args.slices, 'size': args.size, 'zero_margin': args.zero_margin})
+
+    print("%-18s %9s %8s %13s %12s" % ('profile', 'seconds', 'speedup', 'dice humerus', 'dice biceps'))
+    for result in results:
+        print("%-18s %9.1f %7.2fx %13.3f %12.3f" % (result['profile'], result['seconds'], results[0]['seconds'] / result['seconds'],
+                                                  result['dice_humerus'], result['dice_biceps']))
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == '__main__':
+    main()
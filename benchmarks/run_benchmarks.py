@@ -0,0 +1,332 @@
+"""
+End-to-end benchmark suite for the segmentation pipeline on synthetic volumes (see synthetic.py), so it runs
+offline on a CPU-only machine.
+
+Usage (from the repository root):
+    python benchmarks/run_benchmarks.py run --sizes 650x512x512,1000x1024x1024 --history benchmark_history.json
+    python benchmarks/run_benchmarks.py run --sizes 128x256x256 --stages one_hot_encode,metrics --label quick
+    python benchmarks/run_benchmarks.py compare --history benchmark_history.json --threshold 0.1
+
+run writes a synthetic scan folder (<trial>_vol.nii and <trial>_seg.nii, as converted scans are named) for every
+size, given as slices x height x width, and times each stage in a fresh process:
+
+    load_data          pipeline.load_data on the scan folder (pads and one-hot encodes every slice)
+    one_hot_encode     pipeline.one_hot_encode on --sample-slices label slices
+    predict_whole_seg  pipeline.predict_whole_seg with an untrained Unet on --sample-slices slices
+    validate           nn.validate with the same model on --sample-slices slices
+    metrics            the accuracy table metrics (accuracy_metrics) on the whole volume
+    registration       registration.segment with the --registration-profile parameter maps on the whole volume
+
+Stages that work slice by slice only run on a sample, since one slice costs the same wherever it sits in the
+sweep; their seconds_per_slice is comparable between sizes with different slice counts. Peak memory is the
+maximum resident set size of the stage's process, and setup_rss_mb what it held before the timed part started.
+Stages whose dependencies are missing (TensorFlow, SimpleITK with Elastix) are recorded as skipped.
+
+Every run appends one record (commit, time, sizes and per-stage results) to the JSON history. compare checks the
+latest run against the one before it (or --baseline) and exits with status 1 when a stage got slower, or used more
+memory, by more than --threshold, and with status 2 when the runs have no timed stage in common.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import resource
+import subprocess
+import multiprocessing
+sys.path.append('./')
+sys.path.append('src/')
+import numpy as np
+import synthetic
+
+
+STAGES = ['load_data', 'one_hot_encode', 'predict_whole_seg', 'validate', 'metrics', 'registration']
+TRIAL_NAME = 'benchtrial'
+# Label values of pipeline.load_data, in one-hot channel order.
+CLASS_LABELS = [0, 7, 8, 9, 45, 51, 52, 53, 68]
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark the segmentation pipeline on synthetic volumes.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run = subparsers.add_parser('run', help='Time the pipeline stages and append the results to the history.')
+    run.add_argument('--sizes', default='650x512x512', help='Comma separated volume sizes, slices x height x width.')
+    run.add_argument('--stages', default=",".join(STAGES), help='Comma separated stages to run.')
+    run.add_argument('--sample-slices', type=int, default=8, help='Slices timed by the slice by slice stages.')
+    run.add_argument('--repeat', type=int, default=1, help='Time each stage this many times and keep the fastest.')
+    run.add_argument('--registration-profile', default='fast', help='Parameter maps of the registration stage.')
+    run.add_argument('--threads', type=int, default=0, help='TensorFlow and Elastix threads (default: all cores).')
+    run.add_argument('--data-dir', default=None, help='Keep the synthetic scans here and reuse them (default: a temporary directory).')
+    run.add_argument('--history', default='benchmark_history.json')
+    run.add_argument('--label', default='', help='Free text stored with the run, e.g. the change being measured.')
+
+    compare = subparsers.add_parser('compare', help='Flag regressions between two runs of the history.')
+    compare.add_argument('--history', default='benchmark_history.json')
+    compare.add_argument('--baseline', type=int, default=-2, help='History index of the baseline run (default: the previous run).')
+    compare.add_argument('--current', type=int, default=-1, help='History index of the run to check (default: the latest).')
+    compare.add_argument('--threshold', type=float, default=0.1, help='Allowed relative increase, e.g. 0.1 for 10%%.')
+    return parser.parse_args()
+
+
+def parse_size(size):
+    slices, height, width = (int(n) for n in size.lower().split('x'))
+    return slices, height, width
+
+
+##################################
+# SYNTHETIC DATA
+##################################
+
+def write_trial(data_dir, size):
+    '''
+    Writes the synthetic scan folder of one size, unless it already exists. Volumes are stored transposed, the way
+    pipeline.load_data(reorient=True) expects the converted scans.
+    '''
+    import nibabel as nib
+    trial_dir = os.path.join(data_dir, size, TRIAL_NAME)
+    if os.path.isdir(trial_dir):
+        return trial_dir
+    volume, labels = synthetic.make_volume(*parse_size(size))
+    tmp_dir = trial_dir + ".tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    nib.save(nib.Nifti1Image(np.swapaxes(volume, 0, 2), np.eye(4)), os.path.join(tmp_dir, TRIAL_NAME + "_vol.nii"))
+    nib.save(nib.Nifti1Image(np.swapaxes(labels, 0, 2), np.eye(4)), os.path.join(tmp_dir, TRIAL_NAME + "_seg.nii"))
+    os.replace(tmp_dir, trial_dir)
+    return trial_dir
+
+
+def perturb(labels, shift=2):
+    '''
+    A stand-in prediction: the labels shifted by a few voxels, so the metrics see partial overlap.
+    '''
+    return np.roll(labels, shift, axis=(1, 2))
+
+
+##################################
+# STAGES
+##################################
+
+# Each stage does its setup and returns (function to time, number of slices it processes).
+
+def prepare_load_data(config):
+    import pipeline
+    # Written here rather than by the parent, so a missing nibabel skips the stage like any other missing module.
+    # The synthetic arrays are freed before timing starts and are far smaller than what load_data allocates.
+    trial_dir = write_trial(config['data_dir'], config['size'])
+    slices, height, width = parse_size(config['size'])
+    return (lambda: pipeline.load_data(trial_dir, True, height, width)), slices
+
+
+def prepare_one_hot_encode(config):
+    import pipeline
+    _, height, width = parse_size(config['size'])
+    _, labels = synthetic.make_volume(config['sample_slices'], height, width)
+    return (lambda: [pipeline.one_hot_encode(label_slice, CLASS_LABELS) for label_slice in labels.astype(int)]), len(labels)
+
+
+def build_model(config, height, width):
+    import tensorflow as tf
+    import Unet
+    import session_config
+    overrides = {'visible_devices': '', 'intra_op_threads': config['threads'], 'inter_op_threads': config['threads']}
+    session_params = session_config.get_session_params({}, overrides)
+    session_config.apply_visible_devices(session_params)
+    sess = session_config.create_session(session_params)
+    model = Unet.Unet(0, 0.5, 0.5, h=height, w=width)
+    sess.run(tf.global_variables_initializer())
+    return sess, model
+
+
+def prepare_predict_whole_seg(config):
+    import pipeline
+    _, height, width = parse_size(config['size'])
+    volume = synthetic.make_batch(config['sample_slices'], height, width)
+    sess, model = build_model(config, height, width)
+    # Warm-up: the first run pays for graph optimization.
+    model.predict(sess, volume[0:1])
+    return (lambda: pipeline.predict_whole_seg(volume, model, sess)), len(volume)
+
+
+def prepare_validate(config):
+    import nn
+    _, height, width = parse_size(config['size'])
+    volume, labels = synthetic.make_volume(config['sample_slices'], height, width)
+    y = np.zeros(labels.shape + (len(CLASS_LABELS),), dtype=np.float32)
+    for channel, label in enumerate(CLASS_LABELS):
+        y[..., channel] = labels == label
+    sess, model = build_model(config, height, width)
+    model.predict(sess, volume[0:1, ..., np.newaxis])
+    return (lambda: nn.validate(sess, model, volume[..., np.newaxis], y)), len(volume)
+
+
+def prepare_metrics(config):
+    import accuracy_metrics as metrics
+    _, labels = synthetic.make_volume(*parse_size(config['size']))
+    prediction = perturb(labels)
+
+    def run():
+        return [metrics.bicep_iou(prediction, labels), metrics.humerus_iou(prediction, labels),
+                metrics.average_iou_accuracy(prediction, labels), metrics.percent_correct(prediction, labels)]
+    return run, len(labels)
+
+
+def prepare_registration(config):
+    import SimpleITK as sitk
+    import registration
+    if not hasattr(sitk, 'ElastixImageFilter'):
+        raise ImportError("SimpleITK was built without Elastix")
+    slices, height, width = parse_size(config['size'])
+    target, _ = synthetic.make_volume(slices, height, width, seed=0)
+    atlas, atlas_labels = synthetic.make_volume(slices, height, width, seed=1)
+    target = sitk.GetImageFromArray(target)
+    atlas = sitk.GetImageFromArray(perturb(atlas, 4))
+    atlas_seg = sitk.GetImageFromArray(perturb(atlas_labels, 4))
+    parameter_maps = registration.get_profile_parameter_maps(config['registration_profile'])
+    threads = config['threads'] or None
+    return (lambda: registration.segment(target, atlas, atlas_seg, parameter_maps, num_threads=threads)), slices
+
+
+def get_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_stage(stage, config):
+    '''
+    Runs in a fresh process per stage, so peak memory is the stage's own.
+    '''
+    try:
+        run, slices = globals()['prepare_' + stage](config)
+    except ImportError as e:
+        return {'skipped': str(e)}
+    setup_rss = get_rss_mb()
+    seconds = []
+    for _ in range(config['repeat']):
+        start = time.time()
+        run()
+        seconds.append(time.time() - start)
+    return {'seconds': min(seconds), 'slices': slices, 'seconds_per_slice': min(seconds) / slices,
+            'setup_rss_mb': setup_rss, 'peak_rss_mb': get_rss_mb()}
+
+
+##################################
+# HISTORY
+##################################
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_history(path):
+    if not os.path.isfile(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_history(path, history):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(history, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def run(args):
+    stages = args.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError("Unknown stage %s, choose from %s" % (stage, ", ".join(STAGES)))
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='pipeline_bench_')
+    # Spawned workers start from a clean interpreter; forked ones would inherit the parent's peak memory.
+    context = multiprocessing.get_context('spawn')
+
+    results = []
+    try:
+        for size in args.sizes.split(','):
+            parse_size(size)
+            config = {'size': size, 'sample_slices': args.sample_slices, 'repeat': args.repeat,
+                      'registration_profile': args.registration_profile, 'threads': args.threads,
+                      'data_dir': data_dir}
+            for stage in stages:
+                pool = context.Pool(1)
+                try:
+                    result = pool.apply(run_stage, (stage, config))
+                finally:
+                    pool.close()
+                    pool.join()
+                result.update(stage=stage, size=size)
+                results.append(result)
+                if 'skipped' in result:
+                    print("%-18s %-16s skipped (%s)" % (stage, size, result['skipped']))
+                else:
+                    print("%-18s %-16s %9.2f s %9.4f s/slice %9.0f MB peak" % (
+                        stage, size, result['seconds'], result['seconds_per_slice'], result['peak_rss_mb']))
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    history = read_history(args.history)
+    history.append({'commit': get_commit(), 'timestamp': time.time(), 'host': socket.gethostname(),
+                    'cpus': multiprocessing.cpu_count(), 'label': args.label, 'sizes': args.sizes.split(','),
+                    'sample_slices': args.sample_slices, 'results': results})
+    write_history(args.history, history)
+    print("Appended run %d to %s" % (len(history) - 1, args.history))
+    return 0
+
+
+def compare(args):
+    history = read_history(args.history)
+    if len(history) < 2:
+        print("%s holds %d run(s); nothing to compare." % (args.history, len(history)))
+        return 0
+    baseline, current = history[args.baseline], history[args.current]
+    baseline_results = {(r['stage'], r['size']): r for r in baseline['results'] if 'skipped' not in r}
+
+    print("baseline: %s (%s)   current: %s (%s)   threshold: %.0f%%" % (
+        baseline.get('commit'), baseline.get('label') or time.ctime(baseline['timestamp']),
+        current.get('commit'), current.get('label') or time.ctime(current['timestamp']), 100 * args.threshold))
+    print("%-18s %-16s %12s %12s %8s %10s %10s %8s" % ('stage', 'size', 'base s/slice', 'cur s/slice', 'speedup',
+                                                     'base MB', 'cur MB', ''))
+    regressions = 0
+    compared = 0
+    for result in current['results']:
+        base = baseline_results.get((result['stage'], result['size']))
+        if base is None or 'skipped' in result:
+            continue
+        compared += 1
+        slower = result['seconds_per_slice'] > base['seconds_per_slice'] * (1 + args.threshold)
+        larger = result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + args.threshold)
+        flags = ",".join(flag for flag, hit in (('TIME', slower), ('MEMORY', larger)) if hit)
+        regressions += bool(flags)
+        print("%-18s %-16s %12.4f %12.4f %7.2fx %10.0f %10.0f %8s" % (
+            result['stage'], result['size'], base['seconds_per_slice'], result['seconds_per_slice'],
+            base['seconds_per_slice'] / max(result['seconds_per_slice'], 1e-12), base['peak_rss_mb'],
+            result['peak_rss_mb'], flags))
+
+    if not compared:
+        skipped = sorted(set(r['stage'] for r in current['results'] + baseline['results'] if 'skipped' in r))
+        print("No comparable stages: the runs share no stage and size that both timed%s." % (
+            " (skipped: %s)" % ", ".join(skipped) if skipped else ""))
+        return 2
+    if regressions:
+        print("%d regression(s) beyond %.0f%%." % (regressions, 100 * args.threshold))
+        return 1
+    print("No regressions beyond %.0f%%." % (100 * args.threshold))
+    return 0
+
+
+def main():
+    args = get_args()
+    return run(args) if args.command == 'run' else compare(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
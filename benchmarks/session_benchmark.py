@@ -0,0 +1,86 @@
+"""
+Sweeps session settings (thread pools, XLA) and measures Unet inference throughput on a synthetic volume.
+
+Usage (from the repository root):
+    python benchmarks/session_benchmark.py --intra 1,4,auto --inter 1,2 --xla false,true --output session_bench.jsonl
+
+Each combination builds a fresh graph and session, predicts the volume one slice at a time (as
+pipeline.predict_whole_seg does) and reports slices/sec.
+"""
+
+import sys
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+sys.path.append('src/')
+import tensorflow as tf
+import Unet
+import session_config
+import synthetic
+
+
+def get_args():
+    cores = multiprocessing.cpu_count()
+    parser = argparse.ArgumentParser(description='Benchmark session settings for Unet inference.')
+    parser.add_argument('--slices', type=int, default=16)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--intra', default=",".join(str(n) for n in sorted({1, max(cores // 2, 1), cores})))
+    parser.add_argument('--inter', default='1,2')
+    parser.add_argument('--xla', default='false')
+    parser.add_argument('--visible-devices', default='')
+    parser.add_argument('--device', default='')
+    parser.add_argument('--output', default=None, help='Append results as JSON lines to this file.')
+    return parser.parse_args()
+
+
+def run_setting(volume, session_params, size):
+    tf.reset_default_graph()
+    sess = session_config.create_session(session_params)
+    with session_config.device_scope(session_params):
+        model = Unet.Unet(0, 0.5, 0.5, h=size, w=size)
+    sess.run(tf.global_variables_initializer())
+
+    # Warm-up: the first run pays for graph optimization (and XLA compilation).
+    model.predict(sess, volume[0:1])
+
+    start = time.time()
+    for i in range(volume.shape[0]):
+        model.predict(sess, volume[i:i+1])
+    elapsed = time.time() - start
+    sess.close()
+    return volume.shape[0] / elapsed
+
+
+def main():
+    args = get_args()
+    volume = synthetic.make_batch(args.slices, args.size, args.size)
+
+    base = {'visible_devices': args.visible_devices, 'device': args.device}
+    session_config.apply_visible_devices(session_config.get_session_params(base))
+
+    results = []
+    for intra, inter, xla in itertools.product(args.intra.split(','), args.inter.split(','), args.xla.split(',')):
+        overrides = dict(base, intra_op_threads=intra, inter_op_threads=inter, xla_jit=xla)
+        session_params = session_config.get_session_params({}, overrides)
+        slices_per_sec = run_setting(volume, session_params, args.size)
+        result = dict(session_params, slices=args.slices, size=args.size, slices_per_sec=slices_per_sec,
+                      timestamp=time.time())
+        results.append(result)
+        print("intra={:<4} inter={:<4} xla={:<6} {:8.2f} slices/sec".format(
+            session_params['intra_op_threads'], session_params['inter_op_threads'], str(session_params['xla_jit']),
+            slices_per_sec))
+
+    best = max(results, key=lambda r: r['slices_per_sec'])
+    print("Best: intra_op_threads = {}, inter_op_threads = {}, xla_jit = {} ({:.2f} slices/sec)".format(
+        best['intra_op_threads'], best['inter_op_threads'], str(best['xla_jit']).lower(), best['slices_per_sec']))
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == '__main__':
+    main()
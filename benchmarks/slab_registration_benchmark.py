@@ -0,0 +1,77 @@
+"""
+Wall time and accuracy of slab-wise registration (registration.segment_slabs) for different numbers of worker
+processes, against registering the whole synthetic sweep at once.
+
+Usage (from the repository root):
+    python benchmarks/slab_registration_benchmark.py --slices 1024 --size 128 --slab-size 256 --overlap 32 --processes 1,2,4 --output slab_bench.jsonl
+
+The sweep runs along the first array axis (the longest image axis), as in real scans.
+"""
+
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+sys.path.append('./')
+sys.path.append('src/')
+import numpy as np
+import SimpleITK as sitk
+import registration
+import synthetic
+from registration_init_benchmark import make_atlas, to_image, dice
+
+
+def get_args():
+    cores = multiprocessing.cpu_count()
+    parser = argparse.ArgumentParser(description='Benchmark slab-wise registration.')
+    parser.add_argument('--slices', type=int, default=1024)
+    parser.add_argument('--size', type=int, default=128)
+    parser.add_argument('--slab-size', type=int, default=256)
+    parser.add_argument('--overlap', type=int, default=32)
+    parser.add_argument('--processes', default=",".join(str(n) for n in sorted({1, max(cores // 2, 1), cores})))
+    parser.add_argument('--profile', default='fast', help='Registration profile used for whole and slab-wise runs.')
+    parser.add_argument('--skip-whole', action='store_true', help='Do not time whole-volume registration.')
+    parser.add_argument('--output', default=None, help='Append results as JSON lines to this file.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    cores = multiprocessing.cpu_count()
+    target_volume, target_labels = synthetic.make_volume(args.slices, args.size, args.size, seed=0)
+    atlas_volume, atlas_labels = make_atlas(args.size, args.slices, 5, 3)
+    target, atlas, atlas_seg = to_image(target_volume), to_image(atlas_volume), to_image(atlas_labels)
+    parameter_maps = registration.get_profile_parameter_maps(args.profile)
+
+    runs = []
+    if not args.skip_whole:
+        runs.append(('whole', 1, lambda: registration.segment(target, atlas, atlas_seg, parameter_maps)))
+    for processes in [int(p) for p in args.processes.split(',')]:
+        # Cores are shared out between the slab workers.
+        threads = max(1, cores // processes)
+        runs.append(('slabs', processes, lambda processes=processes, threads=threads: registration.segment_slabs(
+            target, atlas, atlas_seg, parameter_maps, args.slab_size, args.overlap, processes=processes, num_threads=threads)))
+
+    results = []
+    for name, processes, run in runs:
+        start = time.time()
+        result = np.rint(sitk.GetArrayFromImage(run())).astype(np.int16)
+        results.append({'method': name, 'processes': processes, 'seconds': time.time() - start,
+                        'dice_humerus': dice(result, target_labels, synthetic.HUMERUS_LABEL),
+                        'dice_biceps': dice(result, target_labels, synthetic.BICEPS_LABEL),
+                        'slices': args.slices, 'size': args.size, 'slab_size': args.slab_size, 'overlap': args.overlap})
+
+    print("%-8s %9s %9s %8s %13s %12s" % ('method', 'processes', 'seconds', 'speedup', 'dice humerus', 'dice biceps'))
+    for result in results:
+        print("%-8s %9d %9.1f %7.2fx %13.3f %12.3f" % (result['method'], result['processes'], result['seconds'], results[0]['seconds'] / result['seconds'],
+                                                     result['dice_humerus'], result['dice_biceps']))
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Synthetic ultrasound-like volumes for benchmarking. Nothing here reads real data, so benchmarks can run offline.
+"""
+
+import numpy as np
+
+
+# Label values follow the ground truth segmentations (see pipeline.load_data).
+HUMERUS_LABEL = 7
+BICEPS_LABEL = 52
+
+
+def make_volume(num_slices, height, width, seed=0):
+    """
+    Builds a (num_slices, height, width) volume and matching label map. Each slice holds a bright humerus disk
+    and a biceps ellipse on a speckled background, drifting slowly along the sweep like a real scan.
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray): float32 intensities in [0, 255] and int16 labels.
+    """
+    rng = np.random.RandomState(seed)
+    rows = np.arange(height, dtype=np.float32)[:, None]
+    cols = np.arange(width, dtype=np.float32)[None, :]
+
+    volume = np.empty((num_slices, height, width), dtype=np.float32)
+    labels = np.zeros((num_slices, height, width), dtype=np.int16)
+
+    for i in range(num_slices):
+        phase = 2 * np.pi * i / max(num_slices, 1)
+        bone_r, bone_c = height * (0.65 + 0.03 * np.sin(phase)), width * (0.5 + 0.03 * np.cos(phase))
+        muscle_r, muscle_c = height * (0.35 + 0.02 * np.cos(phase)), width * 0.5
+
+        bone = ((rows - bone_r) ** 2 + (cols - bone_c) ** 2) < (0.08 * min(height, width)) ** 2
+        muscle = (((rows - muscle_r) / (0.18 * height)) ** 2 + ((cols - muscle_c) / (0.3 * width)) ** 2) < 1
+        muscle &= ~bone
+
+        labels[i][muscle] = BICEPS_LABEL
+        labels[i][bone] = HUMERUS_LABEL
+
+        speckle = rng.rayleigh(scale=25.0, size=(height, width)).astype(np.float32)
+        volume[i] = speckle + 60.0 * muscle + 160.0 * bone
+
+    np.clip(volume, 0, 255, out=volume)
+    return volume, labels
+
+
+def make_batch(num_slices, height, width, seed=0):
+    """
+    Network-ready input of shape (num_slices, height, width, 1).
+    """
+    volume, _ = make_volume(num_slices, height, width, seed)
+    return volume[..., np.newaxis]
@@ -7,6 +7,8 @@ sys.path.append('src/')
 import nibabel as nib
 from math import floor, ceil
 import pipeline
+import splits
+from accuracy_metrics import bicep_percent, bicep_iou, humerus_percent, humerus_iou, percent_correct, average_iou_accuracy
 import Unet
 import logging
 import pickle
@@ -65,6 +67,12 @@ groups = 		  ['group_1_1_final_sub', 'group_1_4_final_sub', 'group_1_5_final_sub
 		  		   'group_4_4_final_sub', 'group_4_5_final_sub']
 
 
+# Optional second argument: directory holding the group models. Groups trained with split_by = trial have a
+# [group]_split.json manifest there, and cells of trials the group trained or validated on are marked instead of
+# scored, so the table only reports held-out accuracy.
+models_dir = sys.argv[2] if len(sys.argv) > 2 else None
+
+
 def main():
 	table = PrettyTable()
 
@@ -90,10 +98,18 @@ def main():
 					continue
 
 				print("\t", curr_group)
+				manifest = splits.get_group_manifest(models_dir, curr_group)
 				predictions_path = os.path.join(groups_path, curr_group)
 				for pred_seg_name in os.listdir(predictions_path):
 					print("\t\t", pred_seg_name, end=' ')
 
+					trial_name = pred_seg_name.split("_")[0]
+					split = splits.get_split_of_trial(manifest, splits.get_prediction_trial(pred_seg_name), sub) if manifest else None
+					if split in ('train', 'val'):
+						print(split)
+						set_table_value(table_data, curr_group, trial_mapping[trial_name + sub], split)
+						continue
+
 					prediction_data = nib.load(os.path.join(predictions_path, pred_seg_name)).get_fdata()
 					prediction_data = np.swapaxes(prediction_data, 0, 2)
 					prediction_data = prediction_data[prediction_data.shape[0]-650:]
@@ -137,15 +153,7 @@ def main():
 
 					print(acc_val)
 
-					# Find place to put accuracy value in table
-					target_row = 0
-					target_col = trial_mapping[trial_name + sub]
-					for row in range(len(table_data)):
-						if table_data[row][0] == curr_group:
-							target_row = row
-							break
-
-					table_data[target_row][target_col] = acc_val
+					set_table_value(table_data, curr_group, trial_mapping[trial_name + sub], acc_val)
 
 
 
@@ -155,6 +163,17 @@ def main():
 	save_table(table, table_data, acc_sel)
 
 
+def set_table_value(table_data, group, target_col, value):
+	# Find place to put accuracy value in table
+	target_row = 0
+	for row in range(len(table_data)):
+		if table_data[row][0] == group:
+			target_row = row
+			break
+
+	table_data[target_row][target_col] = value
+
+
 def save_table(table, table_data, metric):
 	table_str = table.get_string()
 	save_name = "accuracy_table_" + metric + datetime.datetime.now().isoformat()
@@ -166,61 +185,6 @@ def save_table(table, table_data, metric):
 		pickle.dump(table_data, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
 
-def bicep_percent(prediction, reference):
-	total_bicep = np.sum(reference == 52)
-	prediction[prediction != 52] = 0
-	reference[reference != 52] = 0
-
-	return np.sum(np.logical_and(prediction, reference)) / total_bicep
-
-
-def bicep_iou(prediction, reference):
-    prediction_52 = (prediction == 52) * 52
-    reference_52 = (reference == 52) * 52
-
-    iou_52 = iou_accuracy(prediction_52, reference_52)
-
-    return iou_52
-
-
-def humerus_percent(prediction, reference):
-	total_humerus = np.sum(reference == 7)
-	prediction[prediction != 7] = 0
-	reference[reference != 7] = 0
-
-	return np.sum(np.logical_and(prediction, reference)) / total_humerus
-
-def humerus_iou(prediction, reference):
-    prediction_7 = (prediction == 7) * 7
-    reference_7 = (reference == 7) * 7
-
-    iou_7 = iou_accuracy(prediction_7, reference_7)
-
-    return iou_7
-
-def percent_correct(prediction, reference):
-    return np.sum(prediction == reference) / reference.size
-
-def iou_accuracy(prediction, reference):
-    intersection = np.logical_and(prediction, reference)
-    union = np.logical_or(prediction, reference)
-    iou_score = np.sum(intersection) / np.sum(union)
-
-    return iou_score
-
-def average_iou_accuracy(prediction, reference):
-    prediction_7 = (prediction == 7) * 7
-    reference_7 = (reference == 7) * 7
-    
-    prediction_52 = (prediction == 52) * 52
-    reference_52 = (reference == 52) * 52
-    
-    iou_7 = iou_accuracy(prediction_7, reference_7)
-    iou_52 = iou_accuracy(prediction_52, reference_52)
-    average_iou = (iou_7 + iou_52) / 2
-    
-    return average_iou
-
 if __name__ == '__main__':
 	logger = logging.getLogger('__name__')
 	stream = logging.StreamHandler(stream=sys.stdout)
@@ -0,0 +1,189 @@
+"""
+Segments one image by registering several segmented atlases to it and fusing their mapped segmentations.
+
+Usage:
+    python multi_atlas.py target_volume.nii atlases.csv --output target_seg.nii --top 5 --processes 5 --threads 2
+    python multi_atlas.py target_volume.nii atlases.csv --output target_seg.nii --weighted --transform-cache-dir cache
+
+atlases.csv lists one atlas per row as atlas_image,atlas_segmentation (relative paths are relative to the CSV; lines
+starting with # are ignored). With --top N, atlases are first ranked by the similarity of heavily downsampled
+images (label_fusion.rank_atlases) and only the N most similar are registered. Registrations run in parallel worker
+processes; the mapped segmentations (and, with --weighted, the registered atlas images) are kept as .npy arrays in
+<output>_atlases/, so a rerun only registers atlases that are missing there. An atlas whose registration fails is
+logged and left out of the fusion. The rest are fused by majority vote, with --weighted weighting every atlas per
+voxel by its local similarity to the target; the vote memory-maps the arrays and reads a chunk of slices at a time.
+"""
+
+import os
+import sys
+import csv
+import time
+import hashlib
+import argparse
+import multiprocessing
+import logging
+import numpy as np
+import SimpleITK as sitk
+import registration
+sys.path.append('src/')
+import label_fusion
+
+
+logger = logging.getLogger('__name__')
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Multi-atlas registration-based segmentation.')
+    parser.add_argument('target', action='store', help='Image to segment.')
+    parser.add_argument('atlases', action='store', help='CSV of atlas_image,atlas_segmentation rows.')
+    parser.add_argument('--output', '-o', action='store', required=True)
+    parser.add_argument('--top', action='store', type=int, default=0, help='Register only the N atlases most similar to the target (default: all).')
+    parser.add_argument('--weighted', action='store_true', help='Weight votes by local similarity to the target.')
+    parser.add_argument('--radius', action='store', type=int, default=2, help='Neighborhood radius of the local similarity, in voxels.')
+    parser.add_argument('--processes', '-p', action='store', type=int, default=None, help='Concurrent registrations (default: cores / threads).')
+    parser.add_argument('--threads', '-t', action='store', type=int, default=1, help='Elastix threads per registration.')
+    parser.add_argument('--transform-cache-dir', action='store', default=None)
+    parser.add_argument('--verbose', action='store_true', help='Print Elastix output.')
+    args = parser.parse_args()
+    if args.processes is None:
+        args.processes = max(1, multiprocessing.cpu_count() // args.threads)
+    return args
+
+
+def read_atlases(atlases_path):
+    base_dir = os.path.dirname(os.path.abspath(atlases_path))
+    resolve = lambda path: os.path.abspath(path if os.path.isabs(path) else os.path.join(base_dir, path))
+    atlases = []
+    with open(atlases_path) as f:
+        reader = csv.reader(f)
+        for row in reader:
+            row = [value.strip() for value in row]
+            if not row or not row[0] or row[0].startswith('#'):
+                continue
+            if len(row) < 2 or not row[1]:
+                raise ValueError("%s, line %d: expected atlas_image,atlas_segmentation, got %s" % (atlases_path, reader.line_num, ",".join(row)))
+            atlases.append((resolve(row[0]), resolve(row[1])))
+    return atlases
+
+
+def get_atlas_id(index, atlas_image, atlas_segmentation):
+    """
+    Name of an atlas' files in the work directory. Trial file names repeat across subjects, so the name combines the
+    atlas' row in the CSV with a hash of its absolute paths.
+    """
+    digest = hashlib.sha1((atlas_image + "\n" + atlas_segmentation).encode('utf-8')).hexdigest()[:8]
+    return "%03d_%s_%s" % (index, os.path.basename(atlas_image).split('.nii')[0], digest)
+
+
+def read_array(path, ultrasound=True):
+    return sitk.GetArrayFromImage(registration.read_image(path, ultrasound))
+
+
+def register_atlas(job):
+    """
+    Registers one atlas to the target in a pool worker, writes its mapped segmentation (and image) and returns the job
+    with its status.
+    """
+    start = time.time()
+    try:
+        target = registration.read_image(job['target'])
+        atlas_image = registration.read_image(job['atlas_image'])
+        atlas_segmentation = registration.read_image(job['atlas_segmentation'])
+        parameter_maps = registration.get_default_parameter_maps()
+        if job['cache_dir']:
+            transform_parameter_maps = registration.register_cached(target, atlas_image, parameter_maps, job['cache_dir'],
+                                                                    verbose=job['verbose'], num_threads=job['threads'])
+        else:
+            _, transform_parameter_maps = registration.register(target, atlas_image, parameter_maps, verbose=job['verbose'], num_threads=job['threads'])
+
+        outputs = [(job['segmentation_path'], atlas_segmentation, True)]
+        if job['image_path']:
+            outputs.append((job['image_path'], atlas_image, False))
+        for path, image, labels in outputs:
+            warped = registration.transform_all([image], transform_parameter_maps, labels=labels, verbose=job['verbose'], num_threads=job['threads'])[0]
+            warped = sitk.GetArrayFromImage(warped)
+            warped = np.rint(warped).astype(np.int16) if labels else warped.astype(np.float32)
+            tmp_path = os.path.join(os.path.dirname(path), ".tmp" + str(os.getpid()) + "_" + os.path.basename(path))
+            try:
+                np.save(tmp_path, warped)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        job['status'] = 'done'
+    except Exception as e:
+        job.update(status='failed', error=str(e))
+    job['wall_time'] = time.time() - start
+    return job
+
+
+def load_array(path):
+    """
+    Memory-maps an array written by register_atlas, so fusion only reads the slices it votes on.
+    """
+    return np.load(path, mmap_mode='r')
+
+
+def main():
+    args = get_args()
+    atlases = [(get_atlas_id(index, *atlas),) + atlas for index, atlas in enumerate(read_atlases(args.atlases))]
+    atlases = [atlas for atlas in atlases if atlas[1] != os.path.abspath(args.target)]
+
+    if args.top and args.top < len(atlases):
+        ranking = label_fusion.rank_atlases(read_array(args.target), (read_array(image) for _, image, _ in atlases))
+        for index, score in ranking:
+            logger.info("%.4f %s", score, atlases[index][1])
+        atlases = [atlases[index] for index, _ in ranking[:args.top]]
+    logger.info("Fusing %d atlases.", len(atlases))
+
+    work_dir = args.output.split('.nii')[0] + "_atlases"
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    jobs = []
+    for atlas_id, atlas_image, atlas_segmentation in atlases:
+        jobs.append({'target': args.target, 'atlas_image': atlas_image, 'atlas_segmentation': atlas_segmentation,
+                     'segmentation_path': os.path.join(work_dir, atlas_id + "_seg.npy"),
+                     'image_path': os.path.join(work_dir, atlas_id + "_image.npy") if args.weighted else None,
+                     'threads': args.threads, 'cache_dir': args.transform_cache_dir, 'verbose': args.verbose})
+    pending = [job for job in jobs if not all(os.path.isfile(path) for path in (job['segmentation_path'], job['image_path']) if path)]
+
+    start = time.time()
+    failed = []
+    if pending:
+        # One task per child: Elastix does not always release its memory between registrations.
+        with multiprocessing.Pool(min(args.processes, len(pending)), maxtasksperchild=1) as pool:
+            for job in pool.imap_unordered(register_atlas, pending):
+                if job['status'] == 'done':
+                    logger.info("Registered %s in %.1f s", job['atlas_image'], job['wall_time'])
+                else:
+                    logger.error("Failed %s after %.1f s: %s", job['atlas_image'], job['wall_time'], job['error'])
+                    failed.append(job['segmentation_path'])
+    logger.info("Registration took %.1f s", time.time() - start)
+    jobs = [job for job in jobs if job['segmentation_path'] not in failed]
+    if not jobs:
+        logger.error("No atlas was registered; nothing to fuse.")
+        sys.exit(1)
+    if failed:
+        logger.warning("Fusing the %d atlases registered, without the %d that failed.", len(jobs), len(failed))
+
+    start = time.time()
+    target = registration.read_image(args.target)
+    label_maps = [load_array(job['segmentation_path']) for job in jobs]
+    if args.weighted:
+        fused = label_fusion.majority_vote(label_maps, target=sitk.GetArrayFromImage(target),
+                                           warped_images=[load_array(job['image_path']) for job in jobs], radius=args.radius)
+    else:
+        fused = label_fusion.majority_vote(label_maps)
+    result = sitk.GetImageFromArray(fused)
+    result.CopyInformation(target)
+    registration.write_image(result, args.output)
+    logger.info("Fusion took %.1f s; wrote %s", time.time() - start, args.output)
+
+
+if __name__ == '__main__':
+    stream = logging.StreamHandler(stream=sys.stdout)
+    stream.setFormatter(logging.Formatter("%(levelname)-8s %(message)s"))
+    logger.handlers = []
+    logger.addHandler(stream)
+    logger.setLevel(logging.INFO)
+    main()
@@ -5,8 +5,11 @@ import sys
 sys.path.append('src/')
 import pipeline
 import Unet
+import session_config
 import logging
 import time
+import configparser
+import profiling
 
 
 # over_512_configs reference block: using this block will predict on all > 512 scans in the data set.
@@ -50,9 +53,30 @@ under_512_configs = [("/media/jessica/Storage1/SubC/prediction_sources/under_512
 group_whitelist = ['G_augs_group', 'H_augs_group', 'C_augs_group', 'K_augs_group']
 
 
+def get_config_params():
+	# Session and profiling settings are shared with training and read from the DEFAULT section of trainingconfig.ini.
+	params = {}
+	if os.path.isfile('trainingconfig.ini'):
+		config = configparser.ConfigParser()
+		config.read('trainingconfig.ini')
+		params = dict(config.items('DEFAULT'))
+	return params
+
+
+def get_session_params():
+	return session_config.get_session_params(get_config_params())
+
+
 def main():
 	args = sys.argv[1:]
 
+	session_params = get_session_params()
+	session_config.apply_visible_devices(session_params)
+
+	profile_trace = get_config_params().get('profile_trace', '')
+	if profile_trace:
+		profiling.enable(profile_trace)
+
 	models_dir = args[0] if len(args) != 0 else "/media/jessica/Storage1/models/u-net_v1-0/"
 
 	group_folders = []
@@ -73,8 +97,9 @@ def main():
 		print(group)
 		for size in [512, 1024]:
 			tf.reset_default_graph()
-			sess = tf.Session()
-			model = Unet.Unet(0, 0.5, 0.5, h = size, w = size) # Mostly arbitrary initialization with correct size
+			sess = session_config.create_session(session_params)
+			with session_config.device_scope(session_params):
+				model = Unet.Unet(0, 0.5, 0.5, h = size, w = size) # Mostly arbitrary initialization with correct size
 			sess.run(tf.global_variables_initializer())
 			saver = tf.train.Saver()
 
@@ -85,6 +110,8 @@ def main():
 			for config in configs:
 				pipeline.predict_all_segs(config[0], config[1] + "/" + group, config[2], model, sess, reorient = True, predict_lower = False)
 
+	profiling.finish()
+
 
 
 
@@ -0,0 +1,176 @@
+"""
+Segments many images by registration in parallel (batch counterpart of registration.run_amsaf).
+
+Usage:
+    python register_batch.py manifest.csv --output-dir /path/to/registered --processes 4 --threads 4
+
+The manifest is a CSV file with one job per row:
+
+    target,atlas_image,atlas_segmentation[,output]
+
+where target is the unsegmented image, atlas_image/atlas_segmentation are an already segmented image and its
+segmentation, and the optional output is where the mapped segmentation is written (default:
+<output-dir>/<target>_from_<atlas_image>_seg.nii.gz). Relative paths are relative to the manifest; lines starting
+with # are ignored. Jobs whose output exists are skipped, so an interrupted batch resumes where it stopped. The wall
+time of every job is printed, summarized in a table and appended to <output-dir>/register_batch_times.jsonl.
+
+With --transform-cache-dir, registration results are kept (see registration.register_cached), so rerunning a job
+with a corrected atlas segmentation, or with --force, only repeats the final warp.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import datetime
+import argparse
+import multiprocessing
+import logging
+from prettytable import PrettyTable
+import registration
+
+
+logger = logging.getLogger('__name__')
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Segment images by registration to atlases, in parallel.')
+    parser.add_argument('manifest', action='store')
+    parser.add_argument('--output-dir', '-o', action='store', default='registered')
+    parser.add_argument('--processes', '-p', action='store', type=int, default=None, help='Concurrent registrations (default: cores / threads).')
+    parser.add_argument('--threads', '-t', action='store', type=int, default=1, help='Elastix threads per registration.')
+    parser.add_argument('--force', action='store_true', help='Redo jobs whose output already exists.')
+    parser.add_argument('--profile', action='store', default=None, choices=sorted(registration.REGISTRATION_PROFILES),
+                        help='Use a registration profile (registration.segment_profile) instead of the default parameter maps.')
+    parser.add_argument('--transform-cache-dir', action='store', default=None,
+                        help='Store registration results here and reuse them for jobs with the same images and parameter maps.')
+    parser.add_argument('--verbose', action='store_true', help='Print Elastix output.')
+    parser.add_argument('--stats', action='store', default=None,
+                        help='Append per-stage Elastix timing and convergence records to this JSON lines file.')
+    args = parser.parse_args()
+    if args.profile and args.transform_cache_dir:
+        parser.error("--transform-cache-dir only applies to the default parameter maps, not to --profile.")
+    if args.processes is None:
+        args.processes = max(1, multiprocessing.cpu_count() // args.threads)
+    return args
+
+
+def get_stem(path):
+    return os.path.basename(path).split('.nii')[0].split('.mha')[0]
+
+
+def read_manifest(manifest_path, output_dir):
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    resolve = lambda path: path if os.path.isabs(path) else os.path.join(base_dir, path)
+    jobs = []
+    with open(manifest_path) as f:
+        for row in csv.reader(f):
+            row = [value.strip() for value in row]
+            if not row or not row[0] or row[0].startswith('#'):
+                continue
+            if len(row) < 3:
+                raise ValueError("Manifest row needs target, atlas_image and atlas_segmentation: %s" % row)
+            target, atlas_image, atlas_segmentation = [resolve(path) for path in row[:3]]
+            if len(row) > 3 and row[3]:
+                output = resolve(row[3])
+            else:
+                output = os.path.join(output_dir, get_stem(target) + "_from_" + get_stem(atlas_image) + "_seg.nii.gz")
+            jobs.append({'target': target, 'atlas_image': atlas_image, 'atlas_segmentation': atlas_segmentation, 'output': output})
+    return jobs
+
+
+def run_job(job):
+    """
+    Runs one registration in a pool worker and returns the job with its status and timings.
+    """
+    start = time.time()
+    try:
+        unsegmented_image = registration.read_image(job['target'])
+        segmented_image = registration.read_image(job['atlas_image'])
+        segmentation = registration.read_image(job['atlas_segmentation'])
+        read_time = time.time() - start
+
+        if job['profile']:
+            result = registration.segment_profile(unsegmented_image, segmented_image, segmentation, job['profile'],
+                                                  verbose=job['verbose'], num_threads=job['threads'])
+        else:
+            result = registration.segment(unsegmented_image, segmented_image, segmentation, registration.get_default_parameter_maps(),
+                                          verbose=job['verbose'], num_threads=job['threads'], cache_dir=job['transform_cache_dir'])
+        segment_time = time.time() - start - read_time
+
+        # Written under a hidden name (keeping the extension, which selects the format) so a partial file is never
+        # mistaken for a finished job.
+        tmp_path = os.path.join(os.path.dirname(job['output']), ".tmp" + str(os.getpid()) + "_" + os.path.basename(job['output']))
+        registration.write_image(result, tmp_path)
+        os.replace(tmp_path, job['output'])
+        job.update(status='done', read_time=read_time, segment_time=segment_time)
+    except Exception as e:
+        job.update(status='failed', error=str(e))
+    job['wall_time'] = time.time() - start
+    return job
+
+
+def format_seconds(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def summarize(jobs):
+    table = PrettyTable(['Target', 'Atlas', 'Status', 'Wall time'])
+    for job in jobs:
+        table.add_row([get_stem(job['target']), get_stem(job['atlas_image']), job['status'],
+                       format_seconds(job['wall_time']) if 'wall_time' in job else '-'])
+    return table
+
+
+def main():
+    args = get_args()
+    jobs = read_manifest(args.manifest, args.output_dir)
+    if args.stats:
+        # Set before the pool starts, so the workers inherit it.
+        registration.enable_stats(args.stats)
+
+    pending = []
+    for job in jobs:
+        if not args.force and os.path.isfile(job['output']):
+            job['status'] = 'skipped'
+            continue
+        if not os.path.isdir(os.path.dirname(job['output'])):
+            os.makedirs(os.path.dirname(job['output']), exist_ok=True)
+        job.update(threads=args.threads, verbose=args.verbose, transform_cache_dir=args.transform_cache_dir, profile=args.profile)
+        pending.append(job)
+    logger.info("%d jobs, %d already done; running %d processes with %d Elastix threads each.",
+                len(jobs), len(jobs) - len(pending), args.processes, args.threads)
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    log_path = os.path.join(args.output_dir, "register_batch_times.jsonl")
+
+    start = time.time()
+    finished = {}
+    # One task per child: Elastix does not always release its memory between registrations.
+    with multiprocessing.Pool(max(1, min(args.processes, len(pending))), maxtasksperchild=1) as pool:
+        for job in pool.imap_unordered(run_job, pending):
+            finished[job['output']] = job
+            if job['status'] == 'done':
+                logger.info("Finished %s in %s", job['output'], format_seconds(job['wall_time']))
+            else:
+                logger.error("Failed %s after %s: %s", job['output'], format_seconds(job['wall_time']), job['error'])
+            with open(log_path, 'a') as f:
+                f.write(json.dumps(dict(job, finished=datetime.datetime.now().isoformat())) + "\n")
+
+    jobs = [finished.get(job['output'], job) for job in jobs]
+    print(summarize(jobs))
+    logger.info("Total wall time: %s", format_seconds(time.time() - start))
+
+    if any(job['status'] == 'failed' for job in jobs):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    stream = logging.StreamHandler(stream=sys.stdout)
+    stream.setFormatter(logging.Formatter("%(levelname)-8s %(message)s"))
+    logger.handlers = []
+    logger.addHandler(stream)
+    logger.setLevel(logging.INFO)
+    main()
@@ -1,6 +1,17 @@
 import SimpleITK as sitk
 import numpy as np
 import os, sys, time
+import json
+import resource
+import tempfile
+import hashlib
+import shutil
+import multiprocessing
+from scipy.ndimage import affine_transform
+sys.path.append('src/')
+import mask_alignment
+import label_fusion
+from elastix_log import parse_elastix_log
 
 
 
@@ -14,6 +25,13 @@ def run_amsaf():
     segmentation = read_image("")
     new_segmentation = "test_seg.nii"
 
+    # Optional JSON lines file for per-stage timing and convergence statistics (see enable_stats)
+    stats_path = None
+
+    # Optional Unet prediction for unsegmented_image (e.g. from predict_all_groups.py), set as read_image("", False).
+    # If given, the registration is initialized by aligning it with segmentation, and A and t below are ignored.
+    predicted_segmentation = None
+
 
 
     # Affine manual pre-registration/initialization such that x' = Ax + t
@@ -27,10 +45,16 @@ def run_amsaf():
     '''
     DO NOT EDIT BELOW HERE
     '''
+    if stats_path:
+        enable_stats(stats_path)
 
+    if predicted_segmentation is not None:
+        result = segment_initialized(unsegmented_image, segmented_image, segmentation, predicted_segmentation, verbose=verbose)
+        write_image(result, new_segmentation)
+        return
 
-    segmentation = transform(segmentation, init_affine_transform(segmentation, A, t), verbose)
-    segmented_image = transform(segmented_image, init_affine_transform(segmented_image, A, t), verbose)
+    segmentation = affine_resample(segmentation, A, t, labels=True)
+    segmented_image = affine_resample(segmented_image, A, t)
 
 
     result = segment(unsegmented_image, segmented_image, segmentation, get_default_parameter_maps(), verbose=verbose)
@@ -69,11 +93,66 @@ def init_affine_transform(img, A, t):
     return affine
 
 
+def affine_resample(image, A, t, labels=False, chunk_size=32, processes=None):
+    """Apply the affine transform of init_affine_transform in memory, without
+    Transformix.
+
+    As with Transformix, the output has the grid (size, spacing, origin,
+    direction) of image, and the output voxel at physical point x takes the
+    value of image at A x + t; points outside image are 0. The output is
+    computed in chunks of slices, each from the part of image it needs, in
+    parallel processes. To resample onto the grid of another image, use
+    resample_affine_onto.
+
+    :param A: 3x3 numpy array
+    :param t: 1x3 numpy array consisting of the translational values
+    :param labels: Use nearest neighbor interpolation (for segmentations)
+                   instead of linear interpolation
+    :param chunk_size: Number of output slices per job
+    :param processes: Optional. Number of worker processes (default: all cores)
+    :type image: SimpleITK.Image
+    :type A: numpy.ndarray
+    :type t: numpy.ndarray
+    :type labels: bool
+    :returns: Transformed image, with the pixel type of image
+    :rtype: SimpleITK.Image
+    """
+    arr = sitk.GetArrayFromImage(image)
+    matrix, offset = _affine_index_map(image, np.asarray(A, dtype=np.float64), np.ravel(t).astype(np.float64))
+    order = 0 if labels else 1
+
+    jobs = []
+    for start in range(0, arr.shape[0], chunk_size):
+        end = min(start + chunk_size, arr.shape[0])
+        chunk_offset = offset + matrix[:, 0] * start
+        chunk_shape = (end - start,) + arr.shape[1:]
+        # Only the part of the input that the chunk samples from (plus a voxel on each side) goes to the worker.
+        corners = np.array(np.meshgrid(*[[0, dim - 1] for dim in chunk_shape], indexing='ij')).reshape(3, -1)
+        sampled = matrix.dot(corners) + chunk_offset[:, None]
+        lower = np.clip(np.floor(sampled.min(axis=1)).astype(int) - 1, 0, arr.shape)
+        upper = np.clip(np.ceil(sampled.max(axis=1)).astype(int) + 2, 0, arr.shape)
+        source = arr[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]]
+        jobs.append((source, matrix, chunk_offset - lower, chunk_shape, order))
+
+    if processes == 1 or len(jobs) == 1:
+        chunks = [_affine_chunk(job) for job in jobs]
+    else:
+        with multiprocessing.Pool(min(processes or multiprocessing.cpu_count(), len(jobs))) as pool:
+            chunks = pool.map(_affine_chunk, jobs)
+
+    result = sitk.GetImageFromArray(np.concatenate(chunks))
+    result.CopyInformation(image)
+    return result
+
+
 def register(fixed_image,
              moving_image,
              parameter_maps,
              auto_init=True,
-             verbose=False):
+             verbose=False,
+             num_threads=None,
+             fixed_mask=None,
+             moving_mask=None):
     """Register images using Elastix.
 
     :param parameter_maps: Vector of 3 parameter maps to be used for
@@ -82,27 +161,62 @@ def register(fixed_image,
     :param auto_init: Auto-initialize images. This helps with flexibility when
                       using images with little overlap.
     :param verbose: Flag to toggle stdout printing from Elastix
+    :param num_threads: Optional. Number of threads Elastix may use (default: all cores)
+    :param fixed_mask: Optional. Binary mask restricting where the metric is
+                       sampled in fixed_image (see get_foreground_mask)
+    :param moving_mask: Optional. Binary mask for moving_image
     :type fixed_image: SimpleITK.Image
     :type moving_image: SimpleITK.Image
     :type parameter_maps: [SimpleITK.ParameterMap]
     :type auto_init: bool
     :type verbose: bool
+    :type num_threads: int
+    :type fixed_mask: SimpleITK.Image
+    :type moving_mask: SimpleITK.Image
     :returns: Tuple of (result_image, transform_parameter_maps)
     :rtype: (SimpleITK.Image, [SimpleITK.ParameterMap])
     """
+    start = time.time()
     registration_filter = sitk.ElastixImageFilter()
     if not verbose:
         registration_filter.LogToConsoleOff()
+    if num_threads:
+        registration_filter.SetNumberOfThreads(num_threads)
+    log_dir = None
+    if _STATS_PATH:
+        log_dir = tempfile.mkdtemp(prefix="elastix_")
+        registration_filter.SetOutputDirectory(log_dir)
+        registration_filter.LogToFileOn()
     registration_filter.SetFixedImage(fixed_image)
     registration_filter.SetMovingImage(moving_image)
+    if fixed_mask is not None:
+        registration_filter.SetFixedMask(fixed_mask)
+    if moving_mask is not None:
+        registration_filter.SetMovingMask(moving_mask)
 
     if auto_init:
         parameter_maps = _auto_init_assoc(parameter_maps)
+    if log_dir:
+        # Only the last stage's result image is returned; resampling and
+        # writing the others would be counted in their stage times.
+        parameter_maps = _no_result_image_assoc(parameter_maps)
     registration_filter.SetParameterMap(parameter_maps)
     for m in parameter_maps[1:]:
         registration_filter.AddParameterMap(m)
 
-    registration_filter.Execute()
+    try:
+        registration_filter.Execute()
+        if log_dir:
+            with open(os.path.join(log_dir, "elastix.log")) as f:
+                stages = parse_elastix_log(f.read())
+            for stage, pm in zip(stages, parameter_maps):
+                stage['transform'] = pm['Transform'][0]
+                stage['max_iterations'] = int(float(pm['MaximumNumberOfIterations'][0]))
+            _write_stats('register', start, stages=stages, fixed_size=list(fixed_image.GetSize()),
+                         moving_size=list(moving_image.GetSize()), num_threads=num_threads)
+    finally:
+        if log_dir:
+            shutil.rmtree(log_dir, ignore_errors=True)
     result_image = registration_filter.GetResultImage()
     transform_parameter_maps = registration_filter.GetTransformParameterMap()
 
@@ -113,7 +227,9 @@ def segment(unsegmented_image,
             segmented_image,
             segmentation,
             parameter_maps,
-            verbose=False):
+            verbose=False,
+            num_threads=None,
+            cache_dir=None):
     """Segment image using Elastix
 
     :param segmented_image: Image with corresponding segmentation passed as
@@ -124,43 +240,409 @@ def segment(unsegmented_image,
                            registration. If none are provided, a default vector
                            of [rigid, affine, bspline] parameter maps is used.
     :param verbose: Flag to toggle stdout printing from Elastix
+    :param num_threads: Optional. Number of threads Elastix and Transformix may use (default: all cores)
+    :param cache_dir: Optional. Transform cache directory; see register_cached
     :type unsegmented_image: SimpleITK.Image
     :type segmented_image: SimpleITK.Image
     :type segmentation: SimpleITK.Image
     :type parameter_maps: [SimpleITK.ParameterMap]
     :type verbose: bool
+    :type num_threads: int
+    :type cache_dir: str
     :returns: Segmentation mapped from segmented_image to unsegmented_image
     :rtype: SimpleITK.Image
     """
-    _, transform_parameter_maps = register(
-        unsegmented_image, segmented_image, parameter_maps, verbose=verbose)
+    start = time.time()
+    if cache_dir:
+        transform_parameter_maps = register_cached(
+            unsegmented_image, segmented_image, parameter_maps, cache_dir,
+            verbose=verbose, num_threads=num_threads)
+    else:
+        _, transform_parameter_maps = register(
+            unsegmented_image, segmented_image, parameter_maps, verbose=verbose,
+            num_threads=num_threads)
+
+    result = transform(
+        segmentation, _nn_assoc(transform_parameter_maps), verbose=verbose,
+        num_threads=num_threads)
+    _write_stats('segment', start, size=list(unsegmented_image.GetSize()))
+    return result
+
+
+
+def segment_initialized(unsegmented_image,
+                        segmented_image,
+                        segmentation,
+                        predicted_segmentation,
+                        parameter_maps=None,
+                        labels=None,
+                        scale=False,
+                        verbose=False,
+                        num_threads=None,
+                        cache_dir=None):
+    """Segment image using Elastix, initialized from a CNN segmentation
+
+    The segmented image and its segmentation are first brought into rough
+    alignment with unsegmented_image by matching the centroid and principal
+    axes of the humerus and biceps in predicted_segmentation (a Unet
+    prediction for unsegmented_image) and in segmentation. Starting from
+    there, the rigid stage is unnecessary and the remaining stages need far
+    fewer iterations (see get_initialized_parameter_maps).
+
+    :param predicted_segmentation: Segmentation of unsegmented_image predicted
+                                   by the network, on the same voxel grid
+    :param parameter_maps: Optional. Defaults to get_initialized_parameter_maps()
+    :param labels: Optional. Label values used for the alignment (default:
+                   humerus and biceps)
+    :param scale: Also match the extent of the structures (affine instead of
+                  rigid initialization)
+    :type predicted_segmentation: SimpleITK.Image
+    :type labels: [int]
+    :type scale: bool
+    :returns: Segmentation mapped from segmented_image to unsegmented_image
+    :rtype: SimpleITK.Image
+    """
+    if parameter_maps is None:
+        parameter_maps = get_initialized_parameter_maps()
+    A, t = mask_alignment.align_segmentations(
+        sitk.GetArrayViewFromImage(predicted_segmentation), _geometry(unsegmented_image),
+        sitk.GetArrayViewFromImage(segmentation), _geometry(segmentation),
+        labels=labels, scale=scale)
+    segmented_image = resample_affine_onto(segmented_image, unsegmented_image, A, t)
+    segmentation = resample_affine_onto(segmentation, unsegmented_image, A, t, labels=True)
+
+    if cache_dir:
+        transform_parameter_maps = register_cached(
+            unsegmented_image, segmented_image, parameter_maps, cache_dir,
+            auto_init=False, verbose=verbose, num_threads=num_threads)
+    else:
+        _, transform_parameter_maps = register(
+            unsegmented_image, segmented_image, parameter_maps, auto_init=False,
+            verbose=verbose, num_threads=num_threads)
 
     return transform(
-        segmentation, _nn_assoc(transform_parameter_maps), verbose=verbose)
+        segmentation, _nn_assoc(transform_parameter_maps), verbose=verbose,
+        num_threads=num_threads)
+
+
+def resample_affine_onto(image, reference_image, A, t, labels=False):
+    """Resample image onto the grid of reference_image through the affine
+    map x -> Ax + t from reference to image physical coordinates, with
+    SimpleITK. Unlike affine_resample, which keeps the grid of image, the
+    output has the size and geometry of reference_image.
+
+    :param labels: Use nearest neighbor interpolation (for segmentations)
+    :type image: SimpleITK.Image
+    :type reference_image: SimpleITK.Image
+    :type A: numpy.ndarray
+    :type t: numpy.ndarray
+    :rtype: SimpleITK.Image
+    """
+    affine = sitk.AffineTransform(3)
+    affine.SetMatrix([float(a) for a in np.ravel(A)])
+    affine.SetTranslation([float(v) for v in np.ravel(t)])
+    interpolator = sitk.sitkNearestNeighbor if labels else sitk.sitkLinear
+    return sitk.Resample(image, reference_image, affine, interpolator, 0.0, image.GetPixelID())
+
+
+def segment_slabs(unsegmented_image,
+                  segmented_image,
+                  segmentation,
+                  parameter_maps=None,
+                  slab_size=256,
+                  overlap=32,
+                  processes=None,
+                  num_threads=1,
+                  verbose=False):
+    """Segment a long sweep by registering overlapping slabs in parallel
+
+    unsegmented_image is cut into slabs of slab_size slices along its longest
+    axis (the arm), overlapping by overlap slices. Each slab is registered to
+    the matching part of segmented_image (the same fraction of its length,
+    extended by overlap slices on both sides) in its own process, so a
+    worker only holds one slab of each image. Where two slabs overlap, their
+    labels are fused by a vote weighted by a linear ramp across the overlap
+    and by the local similarity of each registered image to the target (see
+    label_fusion.majority_vote).
+
+    :param slab_size: Slices per slab of unsegmented_image
+    :param overlap: Slices shared by consecutive slabs, at most half of slab_size
+    :param processes: Optional. Number of slabs registered at once (default: all cores)
+    :param num_threads: Elastix threads per slab
+    :type slab_size: int
+    :type overlap: int
+    :type processes: int
+    :type num_threads: int
+    :returns: Segmentation mapped from segmented_image to unsegmented_image
+    :rtype: SimpleITK.Image
+    """
+    assert 0 <= overlap <= slab_size // 2
+    if parameter_maps is None:
+        parameter_maps = get_default_parameter_maps()
+    fixed_size = list(unsegmented_image.GetSize())
+    moving_size = list(segmented_image.GetSize())
+    axis = int(np.argmax(fixed_size))
+    length = fixed_size[axis]
+
+    starts = list(range(0, max(length - overlap, 1), slab_size - overlap))
+    slabs = [(start, min(start + slab_size, length)) for start in starts]
+    jobs = []
+    for start, end in slabs:
+        moving_start = max(int(np.floor(start * moving_size[axis] / float(length))) - overlap, 0)
+        moving_end = min(int(np.ceil(end * moving_size[axis] / float(length))) + overlap, moving_size[axis])
+        jobs.append((_extract_slab(unsegmented_image, axis, start, end),
+                     _extract_slab(segmented_image, axis, moving_start, moving_end),
+                     _extract_slab(segmentation, axis, moving_start, moving_end),
+                     parameter_maps, verbose, num_threads))
+
+    if processes == 1 or len(jobs) == 1:
+        results = [_register_slab(job) for job in jobs]
+    else:
+        # One task per child: Elastix does not always release its memory between registrations.
+        with multiprocessing.Pool(min(processes or multiprocessing.cpu_count(), len(jobs)), maxtasksperchild=1) as pool:
+            results = pool.map(_register_slab, jobs)
+
+    # Work in array order with the slab axis first.
+    array_axis = 2 - axis
+    target = np.moveaxis(sitk.GetArrayFromImage(unsegmented_image), array_axis, 0)
+    labels = [np.moveaxis(r[0], array_axis, 0) for r in results]
+    images = [np.moveaxis(r[1], array_axis, 0) for r in results]
+    fused = np.empty(target.shape, dtype=labels[0].dtype)
+    for i, (start, end) in enumerate(slabs):
+        core_start = slabs[i - 1][1] if i > 0 else start
+        core_end = slabs[i + 1][0] if i + 1 < len(slabs) else end
+        fused[core_start:core_end] = labels[i][core_start - start:core_end - start]
+        if core_end < end:
+            # Overlap with the next slab, which starts at core_end.
+            n = end - core_end
+            ramp = np.linspace(1, 0, n + 2, dtype=np.float32)[1:-1].reshape((n,) + (1,) * (target.ndim - 1))
+            fused[core_end:end] = label_fusion.majority_vote(
+                [labels[i][core_end - start:], labels[i + 1][:n]],
+                target=target[core_end:end], warped_images=[images[i][core_end - start:], images[i + 1][:n]],
+                atlas_weights=[ramp, 1 - ramp])
+
+    result = sitk.GetImageFromArray(np.moveaxis(fused, 0, array_axis))
+    result.CopyInformation(unsegmented_image)
+    return result
+
+
+def _extract_slab(image, axis, start, end):
+    size = list(image.GetSize())
+    index = [0] * image.GetDimension()
+    size[axis] = end - start
+    index[axis] = start
+    # The slab keeps its physical position (origin), so slabs register in the coordinates of the full images.
+    return sitk.RegionOfInterest(image, size, index)
+
+
+def _register_slab(job):
+    fixed_slab, moving_slab, segmentation_slab, parameter_maps, verbose, num_threads = job
+    result_image, transform_parameter_maps = register(
+        fixed_slab, moving_slab, parameter_maps, verbose=verbose, num_threads=num_threads)
+    labels = transform(segmentation_slab, _nn_assoc(transform_parameter_maps), verbose=verbose,
+                       num_threads=num_threads)
+    return (np.rint(sitk.GetArrayFromImage(labels)).astype(np.int16),
+            sitk.GetArrayFromImage(result_image).astype(np.float32))
+
+
+def segment_profile(unsegmented_image,
+                    segmented_image,
+                    segmentation,
+                    profile='balanced',
+                    verbose=False,
+                    num_threads=None,
+                    **overrides):
+    """Segment image using Elastix with one of the REGISTRATION_PROFILES
+
+    Depending on the profile, the metric is only sampled inside the nonzero
+    (swept) region of both images, and the registration runs on
+    unsegmented_image cropped to that region, so the bspline grid does not
+    spend control points on empty space. The grid itself is still a single
+    grid over the cropped image; it is not split into chunks. The result is
+    returned on the full grid of unsegmented_image.
+
+    :param profile: 'fast', 'balanced', 'accurate' or 'full'
+    :param overrides: Optional. Settings replacing those of the profile, see
+                      get_profile_parameter_maps, and masks or crop (e.g.
+                      masks=False, crop=False to register the full images)
+    :type profile: str
+    :returns: Segmentation mapped from segmented_image to unsegmented_image
+    :rtype: SimpleITK.Image
+    """
+    settings = _get_profile(profile, overrides)
+    parameter_maps = get_profile_parameter_maps(profile, **overrides)
+
+    fixed_image = unsegmented_image
+    if settings['crop']:
+        fixed_image = crop_to_foreground(unsegmented_image)
+    fixed_mask, moving_mask = None, None
+    if settings['masks']:
+        fixed_mask = get_foreground_mask(fixed_image)
+        moving_mask = get_foreground_mask(segmented_image)
+
+    _, transform_parameter_maps = register(
+        fixed_image, segmented_image, parameter_maps, verbose=verbose,
+        num_threads=num_threads, fixed_mask=fixed_mask, moving_mask=moving_mask)
+    result = transform(
+        segmentation, _nn_assoc(transform_parameter_maps), verbose=verbose,
+        num_threads=num_threads)
+
+    if settings['crop']:
+        result = sitk.Resample(result, unsegmented_image, sitk.Transform(),
+                               sitk.sitkNearestNeighbor, 0.0, result.GetPixelID())
+    return result
+
+
+def get_foreground_mask(image, threshold=0, erode=1):
+    """Binary mask of the voxels above threshold, i.e. the region covered by
+    the ultrasound sweep, eroded by erode voxels so that interpolation at its
+    border does not mix in the empty surroundings
+
+    :rtype: SimpleITK.Image
+    """
+    mask = sitk.Cast(image > threshold, sitk.sitkUInt8)
+    if erode:
+        mask = sitk.BinaryErode(mask, [erode] * image.GetDimension())
+    return mask
 
 
+def crop_to_foreground(image, threshold=0, margin=2):
+    """Crop image to the bounding box of its voxels above threshold, plus
+    margin voxels on every side
 
-def transform(image, parameter_maps, verbose=False):
+    :rtype: SimpleITK.Image
+    """
+    arr = sitk.GetArrayViewFromImage(image) > threshold
+    if not arr.any():
+        return image
+    # Array axes are (z, y, x), image indices are (x, y, z).
+    lower, upper = [], []
+    for axis in range(arr.ndim):
+        other = tuple(a for a in range(arr.ndim) if a != axis)
+        nonzero = np.where(arr.any(axis=other))[0]
+        lower.insert(0, max(int(nonzero[0]) - margin, 0))
+        upper.insert(0, max(arr.shape[axis] - 1 - int(nonzero[-1]) - margin, 0))
+    return sitk.Crop(image, lower, upper)
+
+
+def transform(image, parameter_maps, verbose=False, num_threads=None):
     """Transform an image according to some vector of parameter maps
 
     :param image: Image to be transformed
     :param parameter_maps: Vector of 3 parameter maps used to dictate the
                            image transformation
+    :param verbose: Flag to toggle stdout printing from Transformix
+    :param num_threads: Optional. Number of threads Transformix may use (default: all cores)
     :type image: SimpleITK.Image
     :type parameter_maps: [SimpleITK.ParameterMap]
+    :type verbose: bool
+    :type num_threads: int
     :returns: Transformed image
     :rtype: SimpleITK.Image
     """
+    start = time.time()
     transform_filter = sitk.TransformixImageFilter()
     if not verbose:
         transform_filter.LogToConsoleOff()
+    if num_threads:
+        transform_filter.SetNumberOfThreads(num_threads)
     transform_filter.SetTransformParameterMap(parameter_maps)
     transform_filter.SetMovingImage(image)
     transform_filter.Execute()
     image = transform_filter.GetResultImage()
+    _write_stats('transform', start, size=list(image.GetSize()), num_threads=num_threads)
     return image
 
 
+def transform_all(images, transform_parameter_maps, labels=True, verbose=False, num_threads=None):
+    """Apply one registration result to any number of images, e.g. several
+    label maps of the same moving image
+
+    :param images: Images in the space of the registration's moving image
+    :param transform_parameter_maps: Transform parameter maps returned by
+                                     register or register_cached
+    :param labels: If True, resample with nearest neighbor interpolation so
+                   label values are preserved; use False for intensity images
+    :type images: [SimpleITK.Image]
+    :type transform_parameter_maps: [SimpleITK.ParameterMap]
+    :type labels: bool
+    :returns: Transformed images, in the order given
+    :rtype: [SimpleITK.Image]
+    """
+    if labels:
+        transform_parameter_maps = _nn_assoc(transform_parameter_maps)
+    return [transform(image, transform_parameter_maps, verbose=verbose, num_threads=num_threads)
+            for image in images]
+
+
+def register_cached(fixed_image,
+                    moving_image,
+                    parameter_maps,
+                    cache_dir,
+                    auto_init=True,
+                    verbose=False,
+                    num_threads=None):
+    """Register images using Elastix, reusing a stored result when the same
+    images were registered with the same parameter maps before.
+
+    Results are stored as Elastix transform parameter files in
+    cache_dir/<key>/, where the key hashes the pixel data and geometry of both
+    images and the parameter maps (see get_transform_key). A cached result
+    costs a file read instead of an Elastix optimization.
+
+    :returns: Transform parameter maps, as returned by register
+    :rtype: [SimpleITK.ParameterMap]
+    """
+    if auto_init:
+        parameter_maps = _auto_init_assoc(parameter_maps)
+    key = get_transform_key(fixed_image, moving_image, parameter_maps)
+    cache_path = os.path.join(cache_dir, key)
+    if os.path.isdir(cache_path):
+        return read_transform_parameter_maps(cache_path)
+
+    _, transform_parameter_maps = register(
+        fixed_image, moving_image, parameter_maps, auto_init=False,
+        verbose=verbose, num_threads=num_threads)
+    write_transform_parameter_maps(transform_parameter_maps, cache_path)
+    return transform_parameter_maps
+
+
+def get_transform_key(fixed_image, moving_image, parameter_maps):
+    """Cache key of a registration: hashes of both images and of the
+    parameter maps
+
+    :rtype: str
+    """
+    return "_".join([_image_hash(fixed_image), _image_hash(moving_image),
+                     _parameter_maps_hash(parameter_maps)])
+
+
+def write_transform_parameter_maps(transform_parameter_maps, path):
+    """Write transform parameter maps as TransformParameters.<i>.txt files
+    into the directory path. The directory only appears once complete.
+    """
+    tmp_path = path + ".tmp" + str(os.getpid())
+    if not os.path.isdir(tmp_path):
+        os.makedirs(tmp_path)
+    for i, pm in enumerate(transform_parameter_maps):
+        sitk.WriteParameterFile(pm, os.path.join(tmp_path, "TransformParameters.%d.txt" % i))
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process stored the same registration first.
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def read_transform_parameter_maps(path):
+    """Read transform parameter maps written by write_transform_parameter_maps
+
+    :rtype: [SimpleITK.ParameterMap]
+    """
+    files = sorted((f for f in os.listdir(path) if f.startswith("TransformParameters.")),
+                   key=lambda f: int(f.split(".")[1]))
+    return [sitk.ReadParameterFile(os.path.join(path, f)) for f in files]
+
+
 def read_image(path, ultrasound=True):
     """Load image from filepath as SimpleITK.Image
 
@@ -189,6 +671,41 @@ def write_image(image, path):
     sitk.WriteImage(image, path)
 
 
+##########################
+# Instrumentation        #
+##########################
+
+_STATS_PATH = None
+
+
+def enable_stats(path):
+    """Append a JSON line per register, transform and segment call to path
+    (None turns this off). Registration records hold, for every stage, the
+    transform, its time and, per resolution, the time, iteration count,
+    final metric value and stopping condition, parsed from the Elastix log.
+    Every record has the wall time and the peak memory (resident set size)
+    of the process so far; worker processes started afterwards inherit the
+    setting. While this is on, only the last stage of a registration writes
+    its result image, so the stage times leave out resampling and image I/O.
+
+    :type path: str
+    """
+    global _STATS_PATH
+    _STATS_PATH = path
+
+
+def _write_stats(event, start, **values):
+    if not _STATS_PATH:
+        return
+    record = {'event': event, 'seconds': time.time() - start, 'pid': os.getpid(),
+              # ru_maxrss is in kilobytes on Linux
+              'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    record.update(values)
+    with open(_STATS_PATH, 'a') as f:
+        f.write(json.dumps(record) + "\n")
+
+
 ##########################
 # Private module helpers #
 ##########################
@@ -210,6 +727,51 @@ def _to_elastix(pm, ttype):
 
 
 
+def _image_hash(image):
+    digest = hashlib.sha1()
+    digest.update(repr((image.GetSize(), image.GetSpacing(), image.GetOrigin(),
+                        image.GetDirection(), image.GetPixelIDValue())).encode())
+    digest.update(np.ascontiguousarray(sitk.GetArrayViewFromImage(image)).data)
+    return digest.hexdigest()[:16]
+
+
+def _parameter_maps_hash(pms):
+    items = [sorted((k, tuple(v)) for k, v in pm.items()) for pm in pms]
+    return hashlib.sha1(repr(items).encode()).hexdigest()[:16]
+
+
+def _geometry(image):
+    return image.GetOrigin(), image.GetSpacing(), image.GetDirection()
+
+
+def _affine_index_map(image, A, t):
+    # Physical point of array index (z, y, x): p = O + D S [x, y, z]. Composing
+    # index -> point -> A p + t -> index gives an affine map of array indices.
+    D = np.array(image.GetDirection(), dtype=np.float64).reshape(3, 3)
+    S = np.diag(image.GetSpacing())
+    O = np.array(image.GetOrigin(), dtype=np.float64)
+    to_index = np.linalg.inv(D.dot(S))
+    matrix = to_index.dot(A).dot(D).dot(S)
+    offset = to_index.dot(A.dot(O) + t - O)
+    # Reverse (x, y, z) to array order (z, y, x).
+    return matrix[::-1, ::-1], offset[::-1]
+
+
+def _affine_chunk(job):
+    source, matrix, offset, shape, order = job
+    if source.size == 0:
+        return np.zeros(shape, dtype=source.dtype)
+    # Like ITK, a point is inside the image within half a voxel of its edge voxels, where linear interpolation
+    # repeats the edge value; points further out are 0.
+    inside = affine_transform(np.ones(source.shape, dtype=np.uint8), matrix, offset, output_shape=shape, order=0, mode='grid-constant', cval=0)
+    if order == 0:
+        result = affine_transform(source, matrix, offset, output_shape=shape, order=0, mode='grid-constant', cval=0)
+    else:
+        result = affine_transform(source, matrix, offset, output_shape=shape, order=order, mode='nearest')
+    result[inside == 0] = 0
+    return result
+
+
 def _nn_assoc(pms):
     return _pm_vec_assoc('ResampleInterpolator',
                          'FinalNearestNeighborInterpolator', pms)
@@ -217,6 +779,12 @@ def _nn_assoc(pms):
 def _auto_init_assoc(pms):
     return _pm_vec_assoc('AutomaticTransformInitialization', 'true', pms)
 
+def _no_result_image_assoc(pms):
+    pms = [dict(pm) for pm in pms]
+    for pm in pms[:-1]:
+        pm['WriteResultImage'] = ['false']
+    return pms
+
 def _pm_assoc(k, v, pm):
     result = {}
     if sys.version_info[0] >=3:
@@ -240,6 +808,52 @@ def get_default_parameter_maps():
     return [DEFAULT_RIGID, DEFAULT_AFFINE, DEFAULT_BSPLINE]
 
 
+def get_initialized_parameter_maps(iterations=256):
+    """Parameter maps for images that are already roughly aligned (see
+    segment_initialized): no rigid stage and no automatic initialization, a
+    two-resolution affine stage and a bspline stage, each limited to
+    iterations iterations per resolution.
+    """
+    affine = _pm_assoc('MaximumNumberOfIterations', '%f' % iterations, DEFAULT_AFFINE)
+    affine = _pm_assoc('NumberOfResolutions', '2.000000', affine)
+    affine['AutomaticTransformInitialization'] = ['false']
+    bspline = _pm_assoc('MaximumNumberOfIterations', '%f' % iterations, DEFAULT_BSPLINE)
+    return [affine, bspline]
+
+
+def get_profile_parameter_maps(profile='balanced', **overrides):
+    """[rigid, affine, bspline] parameter maps of one of the
+    REGISTRATION_PROFILES
+
+    :param profile: 'fast', 'balanced', 'accurate' or 'full'
+    :param overrides: Optional. Replace profile settings: iterations,
+                      resolutions (one per stage), spatial_samples and
+                      grid_spacing (final bspline control point spacing in
+                      physical units)
+    :rtype: [dict]
+    """
+    settings = _get_profile(profile, overrides)
+    parameter_maps = []
+    for pm, resolutions in zip(get_default_parameter_maps(), settings['resolutions']):
+        pm = _pm_assoc('MaximumNumberOfIterations', '%f' % settings['iterations'], pm)
+        pm = _pm_assoc('NumberOfResolutions', '%f' % resolutions, pm)
+        pm = _pm_assoc('NumberOfSpatialSamples', '%f' % settings['spatial_samples'], pm)
+        if 'GridSpaceSchedule' in pm:
+            pm = _pm_assoc('FinalGridSpacingInPhysicalUnits', '%f' % settings['grid_spacing'], pm)
+            # One factor per resolution, halving the grid spacing every other resolution as in DEFAULT_BSPLINE.
+            pm = _pm_assoc('GridSpaceSchedule', ' '.join('%f' % (2 ** ((resolutions - 1 - r) / 2.0)) for r in range(resolutions)), pm)
+        parameter_maps.append(pm)
+    return parameter_maps
+
+
+def _get_profile(profile, overrides):
+    if profile not in REGISTRATION_PROFILES:
+        raise ValueError("Unknown registration profile: %s" % profile)
+    settings = dict(REGISTRATION_PROFILES[profile])
+    settings.update((k, v) for k, v in overrides.items() if v is not None)
+    return settings
+
+
 def get_default_affine_transform():
     return DEFAULT_AFFINE_TRANSFORM
 
@@ -337,6 +951,22 @@ DEFAULT_BSPLINE = {
   }
 
 
+# Presets for segment_profile. resolutions has one entry per stage (rigid,
+# affine, bspline); masks restricts sampling to the swept region and crop
+# registers on the fixed image cropped to it. 'full' keeps the default
+# sampling over the whole field of view, as a baseline for the other three.
+REGISTRATION_PROFILES = {
+    'fast': {'iterations': 256, 'resolutions': (2, 2, 3), 'spatial_samples': 1024,
+             'grid_spacing': 16.0, 'masks': True, 'crop': True},
+    'balanced': {'iterations': 512, 'resolutions': (3, 3, 3), 'spatial_samples': 2048,
+                 'grid_spacing': 8.0, 'masks': True, 'crop': True},
+    'accurate': {'iterations': 1024, 'resolutions': (3, 4, 4), 'spatial_samples': 2048,
+                 'grid_spacing': 4.0, 'masks': True, 'crop': True},
+    'full': {'iterations': 512, 'resolutions': (3, 3, 3), 'spatial_samples': 2048,
+             'grid_spacing': 8.0, 'masks': False, 'crop': False},
+}
+
+
 DEFAULT_AFFINE_TRANSFORM = {
     'AutomaticScalesEstimation': ('True'),
     'CenterOfRotationPoint': ('0.0', '0.0', '0.0'), 
@@ -0,0 +1,257 @@
+"""
+Trains a queue of trainingconfig.ini sections concurrently across GPUs or CPU slots (replaces the serial
+trainmultiple.sh loop).
+
+Usage:
+    python schedule_training.py C_augs_group F_augs_group G_augs_group --devices 0,1 --data-cache-dir /path/to/cache
+    python schedule_training.py --sections-file groups.txt --cpu-slots 4 --job-memory-gb 24
+
+Every section is trained as `python training.py [section] -s [section] --resume` (model name == section name, as
+in trainmultiple.sh). Jobs whose final model already exists are skipped, failed jobs are retried from their last
+epoch checkpoint, and a summary table of wall time and throughput per group is printed and saved at the end.
+"""
+
+import os
+import sys
+import time
+import json
+import datetime
+import argparse
+import subprocess
+import configparser
+import multiprocessing
+import logging
+from collections import deque
+from prettytable import PrettyTable
+
+
+logger = logging.getLogger('__name__')
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Train several config sections as a concurrent queue.')
+    parser.add_argument('sections', nargs='*', help='trainingconfig.ini sections to train, in queue order.')
+    parser.add_argument('--sections-file', action='store', help='File with one section name per line.')
+    parser.add_argument('--devices', action='store', default=None, help='Comma separated GPU ids, e.g. 0,1.')
+    parser.add_argument('--jobs-per-device', action='store', type=int, default=1)
+    parser.add_argument('--cpu-slots', action='store', type=int, default=0, help='Run on CPU with this many concurrent jobs.')
+    parser.add_argument('--job-memory-gb', action='store', type=float, default=0, help='Host memory budget per job.')
+    parser.add_argument('--data-cache-dir', action='store', default=None, help='Preprocessed data cache shared by all jobs.')
+    parser.add_argument('--retries', action='store', type=int, default=1)
+    parser.add_argument('--force', action='store_true', help='Retrain sections that already have a final model.')
+    parser.add_argument('--log-dir', action='store', default='schedule_logs')
+    parser.add_argument('--poll-seconds', action='store', type=float, default=10)
+    parser.add_argument('--debug', '-de', action='store_true')
+    args = parser.parse_args()
+
+    if args.sections_file:
+        with open(args.sections_file) as f:
+            args.sections.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+    if not args.sections:
+        parser.error("no sections to train.")
+    if not args.devices and not args.cpu_slots:
+        args.devices = '0'
+    return args
+
+
+def get_slots(args):
+    """
+    A slot is one place a job can run, described by the session flags handed to training.py.
+    """
+    slots = []
+    if args.cpu_slots:
+        threads = max(multiprocessing.cpu_count() // args.cpu_slots, 1)
+        for i in range(args.cpu_slots):
+            slots.append({'name': 'cpu%d' % i,
+                          'args': ['--visible-devices', '', '--intra-op-threads', str(threads), '--inter-op-threads', '2']})
+    else:
+        for device in args.devices.split(','):
+            for i in range(args.jobs_per_device):
+                slot_args = ['--visible-devices', device.strip()]
+                if args.jobs_per_device > 1:
+                    slot_args += ['--gpu-memory-fraction', '%.3f' % (0.95 / args.jobs_per_device)]
+                slots.append({'name': 'gpu%s' % device.strip() + ('.%d' % i if args.jobs_per_device > 1 else ''),
+                              'args': slot_args})
+    return slots
+
+
+def get_available_memory_gb():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / (1024.0 ** 2)
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def get_process_memory_gb(pid):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / (1024.0 ** 2)
+    except (IOError, OSError):
+        pass
+    return 0.0
+
+
+def has_memory_for_job(args, running):
+    """
+    Checks the memory available right now against --job-memory-gb. Running jobs that have not yet grown to their
+    budget (e.g. still loading data) keep the rest of it reserved, so jobs launched in quick succession are not all
+    admitted against the same free memory.
+    """
+    if not args.job_memory_gb:
+        return True
+    available = get_available_memory_gb()
+    if available is None:
+        return True
+    reserved = sum(max(args.job_memory_gb - get_process_memory_gb(job['process'].pid), 0) for job in running.values())
+    return available - reserved >= args.job_memory_gb
+
+
+def get_model_dir(section):
+    config = configparser.ConfigParser()
+    config.read('trainingconfig.ini')
+    return os.path.join(config[section]['models_dir'], section)
+
+
+def is_trained(section):
+    model_dir = get_model_dir(section)
+    return os.path.isfile(os.path.join(model_dir, section + '.index'))
+
+
+def read_train_stats(section):
+    stats_path = os.path.join(get_model_dir(section), section + '_train_stats.json')
+    if not os.path.isfile(stats_path):
+        return {}
+    with open(stats_path) as f:
+        return json.load(f)
+
+
+def build_command(job, slot, args):
+    command = [sys.executable, 'training.py', job['section'], '-s', job['section']] + slot['args']
+    if args.data_cache_dir:
+        command += ['--data-cache-dir', args.data_cache_dir]
+    # Retries (and, without --force, first attempts) pick up from the last complete epoch checkpoint.
+    if job['attempts'] > 1 or not args.force:
+        command.append('--resume')
+    if args.debug:
+        command.append('-de')
+    return command
+
+
+def launch(job, slot, args):
+    job['attempts'] += 1
+    job['slot'] = slot['name']
+    log_path = os.path.join(args.log_dir, "%s_attempt%d.log" % (job['section'], job['attempts']))
+    job['log'] = open(log_path, 'w')
+    command = build_command(job, slot, args)
+    logger.info("Starting %s on %s (attempt %d): %s", job['section'], slot['name'], job['attempts'], " ".join(command))
+    job['start'] = time.time()
+    job['process'] = subprocess.Popen(command, stdout=job['log'], stderr=subprocess.STDOUT)
+
+
+def run_queue(jobs, slots, args):
+    if args.job_memory_gb and get_available_memory_gb() is None:
+        logger.warning("Cannot read available memory; ignoring --job-memory-gb.")
+    pending = deque(job for job in jobs if job['status'] == 'pending')
+    running = {}
+    waiting_for_memory = False
+
+    while pending or running:
+        for slot_index, job in list(running.items()):
+            code = job['process'].poll()
+            if code is None:
+                continue
+            job['log'].close()
+            job['wall_time'] += time.time() - job['start']
+            del running[slot_index]
+            if code == 0:
+                job['status'] = 'done'
+                logger.info("Finished %s in %.0f s.", job['section'], job['wall_time'])
+            elif job['attempts'] <= args.retries:
+                job['status'] = 'pending'
+                logger.warning("%s failed with exit code %d; requeueing.", job['section'], code)
+                pending.append(job)
+            else:
+                job['status'] = 'failed (%d)' % code
+                logger.error("%s failed with exit code %d; giving up.", job['section'], code)
+
+        free_slots = [i for i in range(len(slots)) if i not in running]
+        while pending and free_slots:
+            # Memory is checked before every launch; with nothing running, the next job starts regardless.
+            if running and not has_memory_for_job(args, running):
+                if not waiting_for_memory:
+                    logger.info("Less than %.1f GB of memory available; %s waits for a running job to finish.",
+                                args.job_memory_gb, pending[0]['section'])
+                waiting_for_memory = True
+                break
+            waiting_for_memory = False
+            slot_index = free_slots.pop(0)
+            job = pending.popleft()
+            job['status'] = 'running'
+            launch(job, slots[slot_index], args)
+            running[slot_index] = job
+
+        if pending or running:
+            time.sleep(args.poll_seconds)
+
+
+def format_seconds(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def summarize(jobs):
+    table = PrettyTable()
+    table.field_names = ['Group', 'Status', 'Attempts', 'Slot', 'Wall time', 'Epochs', 'Slices', 'Slices/sec']
+    for job in jobs:
+        stats = read_train_stats(job['section']) if job['status'] == 'done' else {}
+        slices = stats.get('slices', 0)
+        train_seconds = stats.get('train_seconds', 0)
+        throughput = "%.2f" % (slices / train_seconds) if train_seconds else '-'
+        table.add_row([job['section'], job['status'], job['attempts'], job['slot'] or '-',
+                       format_seconds(job['wall_time']), stats.get('epochs', '-'), slices or '-', throughput])
+    return table
+
+
+def main():
+    args = get_args()
+    if not os.path.isdir(args.log_dir):
+        os.makedirs(args.log_dir)
+
+    jobs = []
+    for section in args.sections:
+        job = {'section': section, 'status': 'pending', 'attempts': 0, 'slot': None, 'wall_time': 0.0}
+        if not args.force and is_trained(section):
+            logger.info("Skipping %s: final model already exists.", section)
+            job['status'] = 'skipped'
+        jobs.append(job)
+
+    slots = get_slots(args)
+    logger.info("Scheduling %d jobs on %d slots: %s", len(jobs), len(slots), ", ".join(slot['name'] for slot in slots))
+
+    start = time.time()
+    run_queue(jobs, slots, args)
+
+    table = summarize(jobs)
+    print(table)
+    logger.info("Total wall time: %s", format_seconds(time.time() - start))
+
+    save_name = os.path.join(args.log_dir, "training_schedule_" + datetime.datetime.now().isoformat())
+    with open(save_name, 'w') as f:
+        f.write(table.get_string())
+
+    if any(job['status'].startswith('failed') for job in jobs):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    stream = logging.StreamHandler(stream=sys.stdout)
+    stream.setFormatter(logging.Formatter("%(levelname)-8s %(message)s"))
+    logger.handlers = []
+    logger.addHandler(stream)
+    logger.setLevel(logging.INFO)
+    main()
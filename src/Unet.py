@@ -2,7 +2,7 @@ import tensorflow as tf
 import nn
 
 class Unet(object):        
-    def __init__(self, mean, weight_decay, learning_rate, label_dim = 8, dropout = 0.9, h = 512, w = 512):
+    def __init__(self, mean, weight_decay, learning_rate, label_dim = 8, dropout = 0.9, h = 512, w = 512, devices = None):
         self.x_train = tf.placeholder(tf.float32, [None, h, w, 1])
         self.y_train = tf.placeholder(tf.float32, [None, h, w, 9])
         self.x_test = tf.placeholder(tf.float32, [None, h, w, 1])
@@ -11,24 +11,71 @@ class Unet(object):
         self.label_dim = label_dim
         self.weight_decay = weight_decay
         self.learning_rate = learning_rate
+        # Fed by fit_batch when a learning rate schedule is used; a placeholder rather than a variable keeps the
+        # checkpointed variables unchanged.
+        self.lr = tf.placeholder_with_default(tf.constant(learning_rate, tf.float32), [])
         self.dropout = dropout
 
-        self.output = self.unet(self.x_train, mean, keep_prob=self.dropout)
-        self.loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits = self.output, labels = self.y_train))
-        self.opt = tf.train.AdamOptimizer(self.learning_rate).minimize(self.loss)
-        
-        self.pred = self.unet(self.x_test, mean, reuse = True, keep_prob = 1.0)
+        self.devices = devices if devices and len(devices) > 1 else None
+
+        if self.devices:
+            self.output, self.loss, self.opt = self.data_parallel(self.x_train, self.y_train, mean, self.devices)
+            with tf.device(self.devices[0]):
+                self.pred = self.unet(self.x_test, mean, reuse = True, keep_prob = 1.0)
+        else:
+            self.output = self.unet(self.x_train, mean, keep_prob=self.dropout)
+            self.loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits = self.output, labels = self.y_train))
+            self.opt = tf.train.AdamOptimizer(self.lr).minimize(self.loss)
+
+            self.pred = self.unet(self.x_test, mean, reuse = True, keep_prob = 1.0)
         self.loss_summary = tf.summary.scalar('loss', self.loss)
     
     # Gradient Descent on mini-batch
-    def fit_batch(self, sess, x_train, y_train):
-        _, loss, loss_summary = sess.run((self.opt, self.loss, self.loss_summary), feed_dict={self.x_train: x_train, self.y_train: y_train})
+    def fit_batch(self, sess, x_train, y_train, learning_rate = None):
+        feed_dict = {self.x_train: x_train, self.y_train: y_train}
+        if learning_rate is not None:
+            feed_dict[self.lr] = learning_rate
+        _, loss, loss_summary = sess.run((self.opt, self.loss, self.loss_summary), feed_dict=feed_dict)
         return loss, loss_summary
     
     def predict(self, sess, x):
         prediction = sess.run((self.pred), feed_dict={self.x_test: x})
         return prediction
 
+    # Replicated towers: each device gets a slice of the global batch and shares the 'vgg' variables, so checkpoints
+    # keep the same variable names as the single-device graph. Each tower's loss is normalized by the pixel count of
+    # the *global* batch; summing the tower gradients therefore gives exactly the gradient of the single-device
+    # mean loss, even when the batch does not divide evenly across devices.
+    def data_parallel(self, x, y, mean, devices):
+        num_towers = len(devices)
+        batch = tf.shape(x)[0]
+        shard = batch // num_towers
+        sizes = tf.stack([shard] * (num_towers - 1) + [batch - shard * (num_towers - 1)])
+        x_shards = tf.split(x, sizes, num=num_towers)
+        y_shards = tf.split(y, sizes, num=num_towers)
+        num_pixels = tf.cast(batch * tf.shape(y)[1] * tf.shape(y)[2], tf.float32)
+
+        optimizer = tf.train.AdamOptimizer(self.lr)
+        outputs, tower_losses, tower_grads = [], [], []
+        for i, device in enumerate(devices):
+            with tf.device(device), tf.name_scope('tower_%d' % i):
+                output = self.unet(x_shards[i], mean, keep_prob=self.dropout, reuse=True if i > 0 else None)
+                loss = tf.reduce_sum(tf.nn.softmax_cross_entropy_with_logits(logits = output, labels = y_shards[i])) / num_pixels
+                outputs.append(output)
+                tower_losses.append(loss)
+                tower_grads.append(optimizer.compute_gradients(loss))
+
+        with tf.device(devices[0]):
+            grads = []
+            for grad_and_vars in zip(*tower_grads):
+                var = grad_and_vars[0][1]
+                tower_var_grads = [g for g, _ in grad_and_vars if g is not None]
+                grads.append((tf.add_n(tower_var_grads) if tower_var_grads else None, var))
+            output = tf.concat(outputs, 0)
+            loss = tf.add_n(tower_losses)
+            opt = optimizer.apply_gradients(grads)
+        return output, loss, opt
+
     # def conv_(x, output_depth, name, padding = 'SAME', relu = True, filter_size = 3):
     #             result = nn.conv(x, filter_size, output_depth, 1, self.weight_decay, name=name, padding=padding, relu=relu)
     #             tf.summary.histogram(name, result[1])
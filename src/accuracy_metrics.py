@@ -0,0 +1,63 @@
+"""
+Segmentation accuracy metrics used by generate_accuracy_table.py. Only numpy is needed, so benchmarks and other
+tools can use them without TensorFlow. Label values follow the ground truth segmentations: 7 is the humerus and 52
+the biceps.
+"""
+
+import numpy as np
+
+
+def bicep_percent(prediction, reference):
+    total_bicep = np.sum(reference == 52)
+    prediction[prediction != 52] = 0
+    reference[reference != 52] = 0
+
+    return np.sum(np.logical_and(prediction, reference)) / total_bicep
+
+
+def bicep_iou(prediction, reference):
+    prediction_52 = (prediction == 52) * 52
+    reference_52 = (reference == 52) * 52
+
+    iou_52 = iou_accuracy(prediction_52, reference_52)
+
+    return iou_52
+
+
+def humerus_percent(prediction, reference):
+    total_humerus = np.sum(reference == 7)
+    prediction[prediction != 7] = 0
+    reference[reference != 7] = 0
+
+    return np.sum(np.logical_and(prediction, reference)) / total_humerus
+
+def humerus_iou(prediction, reference):
+    prediction_7 = (prediction == 7) * 7
+    reference_7 = (reference == 7) * 7
+
+    iou_7 = iou_accuracy(prediction_7, reference_7)
+
+    return iou_7
+
+def percent_correct(prediction, reference):
+    return np.sum(prediction == reference) / reference.size
+
+def iou_accuracy(prediction, reference):
+    intersection = np.logical_and(prediction, reference)
+    union = np.logical_or(prediction, reference)
+    iou_score = np.sum(intersection) / np.sum(union)
+
+    return iou_score
+
+def average_iou_accuracy(prediction, reference):
+    prediction_7 = (prediction == 7) * 7
+    reference_7 = (reference == 7) * 7
+    
+    prediction_52 = (prediction == 52) * 52
+    reference_52 = (reference == 52) * 52
+    
+    iou_7 = iou_accuracy(prediction_7, reference_7)
+    iou_52 = iou_accuracy(prediction_52, reference_52)
+    average_iou = (iou_7 + iou_52) / 2
+    
+    return average_iou
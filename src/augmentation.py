@@ -0,0 +1,366 @@
+import os
+import shutil
+from collections import deque
+import logging
+import multiprocessing
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import gaussian_filter, map_coordinates
+
+
+logger = logging.getLogger('__name__')
+
+##################################
+# ONLINE AUGMENTATION
+##################################
+
+def _parse_floats(value):
+    return [float(v) for v in str(value).split(',') if v.strip()]
+
+
+class OnlineAugmenter(object):
+    '''
+    Random elastic deformation and in-plane rotation of training minibatches, replacing the _ed/_rot NIfTI copies
+    written by elastic_deform_nifti.ipynb and rotate_nifti.ipynb.
+
+    Every slice gets its own transform: a rotation angle drawn uniformly from [-max_rotation, max_rotation] degrees,
+    and an elastic displacement field (as in the notebook, after Simard et al. 2003) with alpha drawn uniformly from
+    [min(alphas), max(alphas)] and sigma chosen from sigmas. Rotation and displacement are folded into one set of
+    sampling coordinates, so image and label are each resampled once, with exactly the same transform: linear
+    interpolation for the image, nearest neighbor for the label. Random numbers come from np.random, so the
+    sequence of augmentations follows the training seed and resumes with it.
+    '''
+    def __init__(self, probability=0.5, max_rotation=30.0, alphas=(5, 15), sigmas=(1, 3), elastic=True, rotate=True):
+        self.probability = probability
+        self.max_rotation = max_rotation
+        self.alpha_range = (min(alphas), max(alphas)) if alphas else (0, 0)
+        self.sigmas = list(sigmas)
+        self.elastic = elastic and bool(self.sigmas) and self.alpha_range[1] > 0
+        self.rotate = rotate and max_rotation > 0
+        self.grids = {}
+
+    def describe(self):
+        return "p=%.2f, rotation=+-%g deg, alpha=%g-%g, sigma in %s" % (self.probability, self.max_rotation if self.rotate else 0,
+                                                                         self.alpha_range[0], self.alpha_range[1], self.sigmas if self.elastic else [])
+
+    def get_grid(self, h, w):
+        '''
+        Identity sampling coordinates (rows, cols) centered on the slice, cached per slice size.
+        '''
+        if (h, w) not in self.grids:
+            rows, cols = np.meshgrid(np.arange(h, dtype=np.float32) - (h - 1) / 2.0,
+                                     np.arange(w, dtype=np.float32) - (w - 1) / 2.0, indexing='ij')
+            self.grids[(h, w)] = (rows, cols)
+        return self.grids[(h, w)]
+
+    def sample_coordinates(self, n, h, w):
+        '''
+        Draws n random transforms and returns their sampling coordinates with shape (2, n, h, w).
+        '''
+        rows, cols = self.get_grid(h, w)
+        coords = np.empty((2, n, h, w), dtype=np.float32)
+
+        if self.rotate:
+            angles = np.deg2rad(np.random.uniform(-self.max_rotation, self.max_rotation, size=n)).astype(np.float32)
+            cos, sin = np.cos(angles)[:, None, None], np.sin(angles)[:, None, None]
+            coords[0] = cos * rows - sin * cols
+            coords[1] = sin * rows + cos * cols
+        else:
+            coords[0] = rows
+            coords[1] = cols
+
+        if self.elastic:
+            alphas = np.random.uniform(self.alpha_range[0], self.alpha_range[1], size=n).astype(np.float32)
+            sigmas = np.array(self.sigmas)[np.random.randint(len(self.sigmas), size=n)]
+            fields = np.random.rand(2, n, h, w).astype(np.float32) * 2 - 1
+            # Slices sharing a sigma are smoothed together; the filter does not mix slices (sigma 0 on that axis).
+            for sigma in np.unique(sigmas):
+                selected = np.where(sigmas == sigma)[0]
+                fields[:, selected] = gaussian_filter(fields[:, selected], (0, 0, sigma, sigma), mode="constant", cval=0)
+            coords += fields * alphas[None, :, None, None]
+
+        coords[0] += (h - 1) / 2.0
+        coords[1] += (w - 1) / 2.0
+        return coords
+
+    def warp(self, x, y, coords):
+        '''
+        Resamples images x (n, h, w, 1) and one-hot labels y (n, h, w, classes) at coords (2, n, h, w).
+        '''
+        n, h, w = coords.shape[1:]
+        # A third coordinate selects the slice itself, so a whole batch is resampled in one call per array.
+        batch_coords = np.empty((3, n, h, w), dtype=np.float32)
+        batch_coords[0] = np.arange(n, dtype=np.float32)[:, None, None]
+        batch_coords[1:] = coords
+
+        x_warped = map_coordinates(x[..., 0], batch_coords, order=1, mode='nearest')[..., None].astype(x.dtype)
+        labels = np.argmax(y, axis=3).astype(np.uint8)
+        labels = map_coordinates(labels, batch_coords, order=0, mode='nearest')
+        y_warped = np.eye(y.shape[3], dtype=y.dtype)[labels]
+        return x_warped, y_warped
+
+    def augment_batch(self, x, y):
+        '''
+        Returns augmented copies of a minibatch; each slice is transformed with the configured probability.
+        '''
+        selected = np.where(np.random.rand(x.shape[0]) < self.probability)[0]
+        if len(selected) == 0 or not (self.elastic or self.rotate):
+            return x, y
+        x, y = np.array(x), np.array(y)
+        coords = self.sample_coordinates(len(selected), x.shape[1], x.shape[2])
+        x[selected], y[selected] = self.warp(x[selected], y[selected], coords)
+        return x, y
+
+
+def get_augmenter(params):
+    '''
+    Builds the OnlineAugmenter configured in a trainingconfig.ini section, or returns None when
+    online_augmentation is off.
+    '''
+    if str(params.get('online_augmentation', 'false')).strip().lower() != 'true':
+        return None
+    return OnlineAugmenter(probability=float(params.get('aug_probability', 0.5)),
+                           max_rotation=float(params.get('aug_max_rotation', 30)),
+                           alphas=_parse_floats(params.get('aug_alphas', '5,15')),
+                           sigmas=_parse_floats(params.get('aug_sigmas', '1,3')))
+
+
+##################################
+# VOLUME AUGMENTATION
+##################################
+
+# Identity coordinate grids, cached per slice size (and per worker process).
+_GRID_CACHE = {}
+
+
+def get_identity_grid(h, w):
+    if (h, w) not in _GRID_CACHE:
+        _GRID_CACHE[(h, w)] = np.meshgrid(np.arange(h, dtype=np.float32), np.arange(w, dtype=np.float32), indexing='ij')
+    return _GRID_CACHE[(h, w)]
+
+
+def elastic_coordinates(n, h, w, alpha, sigma, rng):
+    '''
+    Sampling coordinates (slice, row, col) of n elastically deformed slices, shape (3, n, h, w). Matches
+    elastic_transform in elastic_deform_nifti.ipynb: uniform noise in [-1, 1], a Gaussian filter with zero padding,
+    scaled by alpha, added to the identity grid.
+    '''
+    rows, cols = get_identity_grid(h, w)
+    fields = rng.rand(2, n, h, w).astype(np.float32) * 2 - 1
+    fields = gaussian_filter(fields, (0, 0, sigma, sigma), mode="constant", cval=0) * alpha
+
+    coords = np.empty((3, n, h, w), dtype=np.float32)
+    coords[0] = np.arange(n, dtype=np.float32)[:, None, None]
+    coords[1] = rows + fields[0]
+    coords[2] = cols + fields[1]
+    return coords
+
+
+def _deform_chunk(job):
+    vol_chunk, seg_chunk, alpha, sigma, seed = job
+    coords = elastic_coordinates(vol_chunk.shape[0], vol_chunk.shape[1], vol_chunk.shape[2], alpha, sigma, np.random.RandomState(seed))
+    # Volume and segmentation share one set of coordinates; labels use nearest neighbor so values stay valid.
+    vol_warped = map_coordinates(vol_chunk, coords, order=1)
+    seg_warped = map_coordinates(seg_chunk, coords, order=0) if seg_chunk is not None else None
+    return vol_warped, seg_warped
+
+
+def elastic_deform_volume(vol, seg, alpha, sigma, seed=None, chunk_size=32, processes=1, pool=None):
+    '''
+    Elastically deforms every slice (along axis 0) of a volume and its segmentation.
+
+    Displacement fields are generated and applied a chunk of slices at a time (one gaussian_filter and one
+    map_coordinates call per chunk and array). Chunks are converted to float32 only when they are submitted, at most
+    two per worker are in flight, and results are written straight into the output arrays, so besides the outputs
+    memory holds a few chunk-sized buffers per worker. Chunks are independent, each with its own seed derived from
+    seed, so the output is the same for any processes/pool.
+
+    @params vol: Array (slices, h, w)
+    @params seg: Matching label array, or None
+    @params alpha: Displacement scale in pixels
+    @params sigma: Smoothing of the displacement field in pixels
+    @params seed: Seed for the displacement fields (random if None)
+    @params chunk_size: Slices per chunk
+    @params processes: Worker processes to use when no pool is given, or the size of the given pool
+    @params pool: Optional multiprocessing.Pool to reuse across volumes
+    @returns: (deformed volume, deformed segmentation or None), with the input dtypes; integer volumes are rounded
+    '''
+    if seed is None:
+        seed = np.random.randint(0, 2 ** 31 - 1)
+    starts = list(range(0, vol.shape[0], chunk_size))
+    chunk_seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1, size=len(starts))
+    jobs = ((start, (vol[start:start+chunk_size].astype(np.float32),
+                     seg[start:start+chunk_size] if seg is not None else None,
+                     alpha, sigma, int(chunk_seed))) for start, chunk_seed in zip(starts, chunk_seeds))
+
+    vol_out = np.empty_like(vol)
+    seg_out = np.empty_like(seg) if seg is not None else None
+    round_vol = np.issubdtype(vol.dtype, np.integer)
+
+    def store(start, result):
+        vol_warped, seg_warped = result
+        vol_out[start:start+vol_warped.shape[0]] = np.rint(vol_warped) if round_vol else vol_warped
+        if seg_out is not None:
+            seg_out[start:start+seg_warped.shape[0]] = seg_warped
+
+    local_pool = multiprocessing.Pool(processes) if pool is None and processes > 1 else None
+    try:
+        workers = local_pool or pool
+        if workers is None:
+            for start, job in jobs:
+                store(start, _deform_chunk(job))
+        else:
+            pending = deque()
+            for start, job in jobs:
+                pending.append((start, workers.apply_async(_deform_chunk, (job,))))
+                if len(pending) >= 2 * max(processes, 1):
+                    start, result = pending.popleft()
+                    store(start, result.get())
+            while pending:
+                start, result = pending.popleft()
+                store(start, result.get())
+    finally:
+        if local_pool is not None:
+            local_pool.close()
+            local_pool.join()
+    return vol_out, seg_out
+
+
+def elastic_deform_nifti(vol_path, seg_path, save_dir, alphas=(5, 10, 15), sigmas=(1, 3), seed=None, chunk_size=32, processes=1):
+    '''
+    Library version of elastic_transform_all in elastic_deform_nifti.ipynb: writes one deformed volume/segmentation
+    pair per alpha-sigma combination into save_dir, named <name>_elastic_a<alpha>_s<sigma>.nii, with the source
+    headers. A single process pool is shared by all combinations.
+
+    @returns: List of written (volume path, segmentation path)
+    '''
+    vol_nii, seg_nii = nib.load(vol_path), nib.load(seg_path)
+    vol = np.asanyarray(vol_nii.dataobj)
+    seg = np.asanyarray(seg_nii.dataobj)
+    rng = np.random.RandomState(seed)
+    if not os.path.isdir(save_dir):
+        os.makedirs(save_dir)
+
+    written = []
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    try:
+        for alpha in alphas:
+            for sigma in sigmas:
+                vol_def, seg_def = elastic_deform_volume(vol, seg, alpha, sigma, seed=rng.randint(0, 2 ** 31 - 1), chunk_size=chunk_size, processes=processes, pool=pool)
+                suffix = "_elastic_a" + str(alpha) + "_s" + str(sigma) + ".nii"
+                paths = []
+                for nii, arr, path in ((vol_nii, vol_def, vol_path), (seg_nii, seg_def, seg_path)):
+                    out_path = os.path.join(save_dir, os.path.basename(path).split(".nii")[0] + suffix)
+                    nib.save(nib.Nifti1Image(arr, nii.affine, nii.header), out_path)
+                    paths.append(out_path)
+                logger.info("Wrote %s", paths[0])
+                written.append(tuple(paths))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return written
+
+
+##################################
+# ROTATION
+##################################
+
+def get_rotation_coordinates(rows, cols, degrees):
+    '''
+    Sampling coordinates (rows, cols) of a slice rotated by degrees about its center, with the direction of the
+    imgaug Affine(rotate=degrees) used in rotate_nifti.ipynb.
+    '''
+    theta = np.deg2rad(degrees)
+    r, c = np.meshgrid(np.arange(rows, dtype=np.float64) - (rows - 1) / 2.0,
+                       np.arange(cols, dtype=np.float64) - (cols - 1) / 2.0, indexing='ij')
+    r_in = -np.sin(theta) * c + np.cos(theta) * r + (rows - 1) / 2.0
+    c_in = np.cos(theta) * c + np.sin(theta) * r + (cols - 1) / 2.0
+    return np.array([r_in, c_in], dtype=np.float32)
+
+
+def rotate_volume(arr, degrees, order):
+    '''
+    Rotates every cross section of a NIfTI array in its stored orientation (slices along the last axis) and keeps
+    its dtype. Equivalent to rotate_nifti.ipynb, which swaps axes 0 and 2 first and so rotates each slice with axis
+    1 as rows and axis 0 as columns; edge pixels are repeated as with imgaug's mode='edge'.
+
+    @params order: Interpolation order, 1 for volumes and 0 (nearest neighbor) for segmentations
+    '''
+    # Coordinates are computed once per volume and shared by all of its slices.
+    coords = get_rotation_coordinates(arr.shape[1], arr.shape[0], degrees)[::-1].transpose(0, 2, 1)
+    rotated = np.empty_like(arr)
+    for k in range(arr.shape[2]):
+        rotated[:, :, k] = map_coordinates(arr[:, :, k], coords, order=order, mode='nearest', output=arr.dtype)
+    return rotated
+
+
+def get_rotation_dir(save_dir, trial_dir, degrees):
+    '''
+    Output folder of one rotated trial: <trial>_r<degrees>_rot, which pipeline.find_scan_paths treats as an
+    augmented copy and splits.get_trial_id maps back to its source trial.
+    '''
+    return os.path.join(save_dir, os.path.basename(os.path.normpath(trial_dir)) + "_r" + str(degrees) + "_rot")
+
+
+def load_native(nii):
+    '''
+    Voxel data in its stored dtype; any scaling stays in the header, which is copied to the output.
+    '''
+    if hasattr(nii.dataobj, 'get_unscaled'):
+        return np.asarray(nii.dataobj.get_unscaled())
+    return np.asanyarray(nii.dataobj)
+
+
+def _rotate_trial(job):
+    trial_dir, degrees, save_dir, compress = job
+    out_dir = get_rotation_dir(save_dir, trial_dir, degrees)
+    # Hidden while incomplete, so neither find_scan_paths nor a rerun mistakes it for a finished trial.
+    tmp_dir = os.path.join(save_dir, "." + os.path.basename(out_dir) + ".tmp" + str(os.getpid()))
+    os.makedirs(tmp_dir, exist_ok=True)
+    for item in sorted(os.listdir(trial_dir)):
+        item_path = os.path.join(trial_dir, item)
+        if not os.path.isfile(item_path) or item.startswith('.') or ('vol' not in item and 'seg' not in item):
+            continue
+        nii = nib.load(item_path)
+        rotated = rotate_volume(load_native(nii), degrees, order=1 if 'vol' in item else 0)
+        out_name = item.split(".nii")[0] + "_r" + str(degrees) + (".nii.gz" if compress else ".nii")
+        nib.save(nib.Nifti1Image(rotated, nii.affine, nii.header), os.path.join(tmp_dir, out_name))
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+def rotate_trials(trial_dirs, angles, save_dir, processes=1, compress=True, overwrite=False):
+    '''
+    Writes a rotated copy of every trial folder for every angle, one (trial, angle) job per worker process.
+
+    @params trial_dirs: Trial folders, each holding a *vol* and (optionally) a *seg* NIfTI
+    @params angles: Integer rotations in degrees
+    @params save_dir: Parent folder of the <trial>_r<angle>_rot outputs, usually the training directory
+    @params compress: Write .nii.gz instead of .nii
+    @params overwrite: Redo jobs whose output folder already exists
+    @returns: List of written folders
+    '''
+    jobs = []
+    for trial_dir in trial_dirs:
+        for degrees in angles:
+            if not overwrite and os.path.isdir(get_rotation_dir(save_dir, trial_dir, degrees)):
+                logger.info("Skipping %s: already rotated by %d degrees.", os.path.basename(trial_dir), degrees)
+                continue
+            jobs.append((trial_dir, degrees, save_dir, compress))
+    for trial_dir, degrees, _, _ in jobs:
+        out_dir = get_rotation_dir(save_dir, trial_dir, degrees)
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+
+    written = []
+    if processes > 1 and len(jobs) > 1:
+        with multiprocessing.Pool(min(processes, len(jobs))) as pool:
+            for out_dir in pool.imap_unordered(_rotate_trial, jobs):
+                logger.info("Wrote %s", out_dir)
+                written.append(out_dir)
+    else:
+        for job in jobs:
+            written.append(_rotate_trial(job))
+            logger.info("Wrote %s", written[-1])
+    return written
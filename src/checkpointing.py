@@ -0,0 +1,227 @@
+import os
+import time
+import json
+import shutil
+import logging
+import datetime
+import threading
+from queue import Queue
+from collections import deque
+import tensorflow as tf
+from tensorflow.python.ops import gen_io_ops
+import nn
+
+
+logger = logging.getLogger('__name__')
+
+
+class AsyncCheckpointer(object):
+    '''
+    Writes epoch checkpoints on a background thread so the training loop only pays for copying the variables to
+    host memory.
+
+    Checkpoints keep the layout produced by a synchronous tf.train.Saver: <checkpoint_dir>/<model_name>.index,
+    .data-00000-of-00001 and .meta. The meta graph is exported once; later checkpoints get a hard link (or copy) of
+    the previous one instead of serializing the graph again.
+
+    Retention mirrors tf.train.Saver, applied to whole epoch folders: only the newest max_to_keep folders are kept,
+    except that one folder per keep_checkpoint_every_n_hours is preserved indefinitely.
+    '''
+    def __init__(self, saver, var_list=None, max_to_keep=None, keep_checkpoint_every_n_hours=10000.0):
+        self.saver = saver
+        self.var_list = var_list if var_list is not None else tf.global_variables()
+        self.max_to_keep = max_to_keep
+        self.keep_every_seconds = keep_checkpoint_every_n_hours * 3600
+        self.meta_graph_path = None
+        self.kept = deque([])
+        self.last_preserved = time.time()
+        self.error = None
+
+        # A CPU graph writing fed arrays straight to a checkpoint: the same SaveV2 op tf.train.Saver runs, with
+        # placeholders instead of variables, so the snapshot is the only host copy of the variables.
+        self.save_graph = tf.Graph()
+        with self.save_graph.as_default(), tf.device('/cpu:0'):
+            self.prefix_placeholder = tf.placeholder(tf.string, [])
+            self.placeholders = [tf.placeholder(var.dtype.base_dtype, var.get_shape()) for var in self.var_list]
+            self.save_op = gen_io_ops.save_v2(self.prefix_placeholder, [var.op.name for var in self.var_list],
+                                              [''] * len(self.var_list), self.placeholders)
+        self.save_sess = tf.Session(graph=self.save_graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+
+        self.queue = Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self, sess, checkpoint_dir, model_name, on_complete=None):
+        '''
+        Snapshots the variables and queues the write. Blocks only if the previous checkpoint is still waiting to be
+        written. At most three snapshots are in host memory at once: one being written, one queued and the one
+        being taken; each is dropped as soon as it is on disk.
+
+        @params checkpoint_dir: Epoch folder to write into (created if missing)
+        @params on_complete: Optional callable run on the writer thread once the checkpoint is on disk
+        '''
+        self._raise_pending_error()
+        if not os.path.isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        prefix = os.path.join(checkpoint_dir, model_name)
+
+        if self.meta_graph_path is None:
+            # Must run on the thread that owns the default graph.
+            self.meta_graph_path = prefix + '.meta'
+            self.saver.export_meta_graph(self.meta_graph_path)
+
+        values = sess.run(self.var_list)
+        self.queue.put([values, checkpoint_dir, prefix, on_complete])
+
+    def wait(self):
+        self.queue.join()
+        self._raise_pending_error()
+
+    def close(self):
+        self.queue.join()
+        self.queue.put(None)
+        self.thread.join()
+        self.save_sess.close()
+        self._raise_pending_error()
+
+    def _raise_pending_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            try:
+                self._write(job)
+            except Exception as e:
+                logger.error("Asynchronous checkpoint failed: %s", e)
+                self.error = e
+            finally:
+                job = None
+                self.queue.task_done()
+
+    def _write(self, job):
+        # Emptying the queued list leaves the feed as the only reference to the snapshot, so it is freed as soon as
+        # it is on disk rather than when the next checkpoint arrives.
+        values, checkpoint_dir, prefix, on_complete = job
+        del job[:]
+        start = time.time()
+        feed_dict = dict(zip(self.placeholders, values))
+        feed_dict[self.prefix_placeholder] = prefix
+        del values
+        self.save_sess.run(self.save_op, feed_dict=feed_dict)
+        del feed_dict
+        # The checkpoint state file a synchronous tf.train.Saver writes next to the checkpoint.
+        tf.train.update_checkpoint_state(checkpoint_dir, prefix)
+
+        # Link from the newest meta file rather than the first one, which retention may already have removed.
+        meta_path = prefix + '.meta'
+        if meta_path != self.meta_graph_path and not os.path.exists(meta_path):
+            try:
+                os.link(self.meta_graph_path, meta_path)
+            except OSError:
+                shutil.copyfile(self.meta_graph_path, meta_path)
+        self.meta_graph_path = meta_path
+
+        logger.debug("Wrote checkpoint %s in %.1f s.", checkpoint_dir, time.time() - start)
+        if on_complete:
+            on_complete()
+        self._apply_retention(checkpoint_dir)
+
+    def _apply_retention(self, checkpoint_dir):
+        self.kept.append((checkpoint_dir, time.time()))
+        if not self.max_to_keep:
+            return
+        while len(self.kept) > self.max_to_keep:
+            old_dir, saved_at = self.kept.popleft()
+            if saved_at - self.last_preserved >= self.keep_every_seconds:
+                self.last_preserved = saved_at
+                continue
+            logger.debug("Removing old checkpoint %s", old_dir)
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+
+class CheckpointManager(object):
+    '''
+    Keeps the best epoch checkpoints by validation Dice and records which epoch gets deployed.
+
+    Scores (from nn.validate) and checkpoints (once fully written) may arrive in either order. Among epochs that have
+    both, only the keep_best highest scoring folders survive; the latest checkpoint is always kept so training can
+    resume. Epochs without a score yet are never removed.
+    '''
+    def __init__(self, models_dir, model_name, keep_best=3, selection_labels=None):
+        self.model_path = os.path.join(models_dir, model_name)
+        self.model_name = model_name
+        self.keep_best = keep_best
+        self.selection_labels = selection_labels
+        self.checkpoints = {}
+        self.scores = {}
+        self.lock = threading.Lock()
+
+    def add_checkpoint(self, epoch, checkpoint_dir):
+        with self.lock:
+            self.checkpoints[epoch] = checkpoint_dir
+            self._prune()
+
+    def add_score(self, epoch, acc):
+        with self.lock:
+            self.scores[epoch] = (nn.dice_score(acc, self.selection_labels), [float(a) for a in acc])
+            self._prune()
+
+    def restore(self, checkpoints, accs):
+        '''
+        Re-registers the state of an interrupted run.
+
+        @params checkpoints: Dict of epoch -> folder, as returned by pipeline.list_epoch_checkpoints
+        @params accs: Validation accuracies of the epochs already run, indexed by epoch
+        '''
+        for epoch, acc in enumerate(accs):
+            self.add_score(epoch, acc)
+        for epoch in sorted(checkpoints):
+            self.add_checkpoint(epoch, checkpoints[epoch])
+
+    def best_epoch(self):
+        with self.lock:
+            candidates = [epoch for epoch in self.checkpoints if epoch in self.scores]
+            if not candidates:
+                return None
+            return max(candidates, key=lambda epoch: self.scores[epoch][0])
+
+    def _prune(self):
+        if not self.keep_best or not self.checkpoints:
+            return
+        latest = max(self.checkpoints)
+        scored = [epoch for epoch in self.checkpoints if epoch in self.scores]
+        ranked = sorted(scored, key=lambda epoch: self.scores[epoch][0], reverse=True)
+        keep = set(ranked[:self.keep_best])
+        keep.add(latest)
+        for epoch in scored:
+            if epoch not in keep:
+                logger.debug("Pruning epoch %d checkpoint (score %.4f).", epoch, self.scores[epoch][0])
+                shutil.rmtree(self.checkpoints.pop(epoch), ignore_errors=True)
+
+    def write_manifest(self, deployed_epoch, test_acc=None):
+        '''
+        Writes <model_name>_manifest.json next to the canonical checkpoint, recording the epoch it came from.
+        '''
+        with self.lock:
+            manifest = {'model_name': self.model_name,
+                        'deployed_epoch': deployed_epoch,
+                        'deployed_checkpoint': os.path.basename(self.checkpoints[deployed_epoch]) if deployed_epoch in self.checkpoints else None,
+                        'selection_metric': 'mean validation dice',
+                        'selection_labels': self.selection_labels,
+                        'score': self.scores[deployed_epoch][0] if deployed_epoch in self.scores else None,
+                        'val_acc': self.scores[deployed_epoch][1] if deployed_epoch in self.scores else None,
+                        'test_acc': [float(a) for a in test_acc] if test_acc is not None else None,
+                        'kept_epochs': sorted(self.checkpoints),
+                        'scores': {str(epoch): score for epoch, (score, _) in sorted(self.scores.items())},
+                        'updated': datetime.datetime.now().isoformat()}
+        manifest_path = os.path.join(self.model_path, self.model_name + "_manifest.json")
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        return manifest_path
@@ -0,0 +1,151 @@
+"""
+Converts the MHA volumes of many subjects to NIfTI in parallel (mha_to_nii.py converts a single trial).
+
+Usage: python convert_mha_to_nii.py [subject_dir ...] [--compress] [--processes N] [--all] [--force]
+
+subject_dir
+|-- US-mocap
+|   |-- trial1_30_fs_volume.mha
+|   `-- ...
+|-- trial1_30_fs_volume.nii(.gz)    <- written here
+`-- dataset_index.json              <- shape and size bucket of every converted file
+
+Files whose output is newer than their MHA source are skipped, as are subjects without an US-mocap folder. The index
+lets sort_by_size.py sort scans into over_512/under_512 without opening them.
+"""
+
+import os
+import json
+import time
+import argparse
+import multiprocessing
+import SimpleITK as sitk
+
+
+INDEX_NAME = "dataset_index.json"
+
+
+def get_args():
+	parser = argparse.ArgumentParser(description='Convert MHA volumes of several subjects to NIfTI.')
+	parser.add_argument('subject_dirs', nargs='+')
+	parser.add_argument('--input-subdir', default='US-mocap', help='Folder of each subject holding the .mha files.')
+	parser.add_argument('--all', action='store_true', help='Convert every .mha file, not only volumes.')
+	parser.add_argument('--compress', action='store_true', help='Write .nii.gz instead of .nii.')
+	parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+	parser.add_argument('--force', action='store_true', help='Convert even if the output is up to date.')
+	return parser.parse_args()
+
+
+def get_size_bucket(shape):
+	# As in sort_by_size.py: the largest dimension runs along the arm; the other two decide the bucket.
+	in_plane = sorted(shape, reverse=True)[1:]
+	return "under_512" if all(dim <= 512 for dim in in_plane) else "over_512"
+
+
+def get_index_entry(source_path, shape):
+	return {'source': os.path.abspath(source_path),
+			'shape': [int(dim) for dim in shape],
+			'size_bucket': get_size_bucket(shape)}
+
+
+def read_index(save_dir):
+	index_path = os.path.join(save_dir, INDEX_NAME)
+	if not os.path.isfile(index_path):
+		return {}
+	with open(index_path) as f:
+		return json.load(f)
+
+
+def write_index(save_dir, index):
+	index_path = os.path.join(save_dir, INDEX_NAME)
+	with open(index_path + ".tmp", 'w') as f:
+		json.dump(index, f, indent=2, sort_keys=True)
+	os.replace(index_path + ".tmp", index_path)
+
+
+def is_current(source_path, save_path):
+	return os.path.isfile(save_path) and os.path.getmtime(save_path) >= os.path.getmtime(source_path)
+
+
+def read_shape(path):
+	# Header only; the voxel data is not decoded.
+	reader = sitk.ImageFileReader()
+	reader.SetFileName(path)
+	reader.ReadImageInformation()
+	return reader.GetSize()
+
+
+def init_worker():
+	# Parallelism comes from the process pool; one ITK thread per process avoids oversubscribing the cores.
+	sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
+
+
+def convert(job):
+	source_path, save_path = job
+	start = time.time()
+	# Written under a hidden name with the same extension (which selects the format) and renamed when complete.
+	tmp_path = os.path.join(os.path.dirname(save_path), ".tmp" + str(os.getpid()) + "_" + os.path.basename(save_path))
+	try:
+		img = sitk.ReadImage(source_path)
+		sitk.WriteImage(img, tmp_path, save_path.endswith(".gz"))
+		os.replace(tmp_path, save_path)
+	except Exception as e:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+		return save_path, None, str(e)
+	return save_path, get_index_entry(source_path, img.GetSize()), time.time() - start
+
+
+def find_jobs(subject_dir, input_subdir, convert_all, compress):
+	source_dir = os.path.join(subject_dir, input_subdir)
+	if not os.path.isdir(source_dir):
+		print("Warning: skipping", subject_dir, "(no", input_subdir, "folder)")
+		return None
+	jobs = []
+	for file in sorted(os.listdir(source_dir)):
+		if file.endswith('.mha') and not file.startswith('.') and (convert_all or 'volume' in file):
+			save_name = file.split('.mha')[0] + ('.nii.gz' if compress else '.nii')
+			jobs.append((os.path.join(source_dir, file), os.path.join(subject_dir, save_name)))
+	return jobs
+
+
+def main():
+	args = get_args()
+
+	indices = {}
+	pending = []
+	for subject_dir in args.subject_dirs:
+		subject_dir = os.path.normpath(subject_dir)
+		jobs = find_jobs(subject_dir, args.input_subdir, args.all, args.compress)
+		if jobs is None:
+			continue
+		index = read_index(subject_dir)
+		indices[subject_dir] = index
+		for source_path, save_path in jobs:
+			save_name = os.path.basename(save_path)
+			if not args.force and is_current(source_path, save_path):
+				if save_name not in index:
+					index[save_name] = get_index_entry(source_path, read_shape(save_path))
+				print("Up to date:", save_path)
+				continue
+			pending.append((source_path, save_path))
+
+	print("Converting", len(pending), "files with", args.processes, "processes")
+	failed = []
+	start = time.time()
+	with multiprocessing.Pool(max(1, min(args.processes, len(pending))), initializer=init_worker) as pool:
+		for save_path, entry, result in pool.imap_unordered(convert, pending):
+			if entry is None:
+				print("Failed to convert", save_path, ":", result)
+				failed.append(save_path)
+				continue
+			print("Converted", save_path, "in %.1f s" % result)
+			indices[os.path.dirname(save_path)][os.path.basename(save_path)] = entry
+
+	for subject_dir, index in indices.items():
+		write_index(subject_dir, index)
+	print("Converted %d files in %.1f s, %d failed" % (len(pending) - len(failed), time.time() - start, len(failed)))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,83 @@
+import re
+
+
+# "Running elastix with parameter file N" (elastix command line) or "... parameter map N" (the elastix library,
+# used by SimpleITK's ElastixImageFilter).
+STAGE_START = re.compile(r'Running elastix with parameter (?:file|map) (\d+)')
+STAGE_TIME = re.compile(r'Time used for running elastix with this parameter (?:file|map):\s*(.+)$')
+RESOLUTION_START = re.compile(r'Resolution: (\d+)')
+RESOLUTION_TIME = re.compile(r'Time spent in resolution (\d+) \(ITK initialization and iterating\):\s*(.+)$')
+STOPPING_CONDITION = re.compile(r'Stopping condition: (.*?)\.?$')
+FINAL_METRIC = re.compile(r'Final metric value\s*=\s*([-\d.eE+]+)')
+DURATION_PART = re.compile(r'([\d.]+(?:[eE][-+]?\d+)?)\s*([dhms])')
+DURATION_UNITS = {'d': 86400, 'h': 3600, 'm': 60, 's': 1}
+
+
+def parse_duration(text):
+    '''
+    Seconds of a duration as elastix prints it: plain seconds ('1.234 s') or days, hours, minutes and seconds
+    ('7m43.2s', '1h2m3.0s', see elastix's ConvertSecondsToDhms).
+
+    @returns: float, or None if text holds no duration
+    '''
+    text = text.strip().rstrip('.').strip()
+    parts = DURATION_PART.findall(text)
+    if parts:
+        return float(sum(float(value) * DURATION_UNITS[unit] for value, unit in parts))
+    return to_float(text)
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def parse_elastix_log(text):
+    '''
+    Extracts per-stage and per-resolution statistics from an elastix.log.
+
+    @returns: One dict per parameter map (stage), in order, with 'stage', 'seconds', 'final_metric' and
+        'resolutions'; each resolution has 'resolution', 'iterations', 'final_metric', 'seconds' and
+        'stopping_condition' (keys missing from the log are left out)
+    '''
+    stages = []
+    resolution = None
+    for line in text.splitlines():
+        line = line.strip()
+        match = STAGE_START.match(line)
+        if match:
+            stages.append({'stage': int(match.group(1)), 'resolutions': []})
+            resolution = None
+            continue
+        if not stages:
+            continue
+        stage = stages[-1]
+        match = RESOLUTION_START.match(line)
+        if match:
+            resolution = {'resolution': int(match.group(1)), 'iterations': 0}
+            stage['resolutions'].append(resolution)
+            continue
+        values = line.split('\t')
+        if resolution is not None and len(values) > 2 and values[0].isdigit():
+            # A row of the iteration table: iteration number, metric value, ...
+            resolution['iterations'] = int(values[0]) + 1
+            resolution['final_metric'] = to_float(values[1])
+            continue
+        match = RESOLUTION_TIME.match(line)
+        if match and resolution is not None:
+            resolution['seconds'] = parse_duration(match.group(2))
+            continue
+        match = STOPPING_CONDITION.match(line)
+        if match and resolution is not None:
+            resolution['stopping_condition'] = match.group(1)
+            continue
+        match = FINAL_METRIC.match(line)
+        if match:
+            stage['final_metric'] = float(match.group(1))
+            continue
+        match = STAGE_TIME.match(line)
+        if match:
+            stage['seconds'] = parse_duration(match.group(1))
+    return stages
@@ -7,6 +7,7 @@ sys.path.append('src/')
 import nibabel as nib
 from math import floor, ceil
 import pipeline
+import splits
 import Unet
 import logging
 import pickle
@@ -75,6 +76,11 @@ groups = ['group_1_1', 'group_1_2', 'group_1_3', 'group_1_4',
 
 		  'group_10_1']
 
+# Optional argument: directory holding the group models. Cells of trials a group trained or validated on (see the
+# [group]_split.json manifest of groups trained with split_by = trial) are marked instead of scored.
+models_dir = sys.argv[1] if len(sys.argv) > 1 else None
+
+
 def main():
 	table = PrettyTable()
 
@@ -96,10 +102,17 @@ def main():
 			print(ground_truth_path)
 			for curr_group in groups_with_preds:
 				print("\t", curr_group)
+				manifest = splits.get_group_manifest(models_dir, curr_group)
 				predictions_path = os.path.join(groups_path, curr_group)
 				for pred_seg_name in os.listdir(predictions_path):
 					print("\t\t", pred_seg_name, end=' ')
 
+					split = splits.get_split_of_trial(manifest, splits.get_prediction_trial(pred_seg_name), sub) if manifest else None
+					if split in ('train', 'val'):
+						print(split)
+						set_table_value(table_data, curr_group, trial_mapping[pred_seg_name.split("_")[0] + sub], split)
+						continue
+
 					prediction_data = nib.load(os.path.join(predictions_path, pred_seg_name)).get_fdata()
 					prediction_data = np.swapaxes(prediction_data, 0, 2)
 					prediction_data = prediction_data[prediction_data.shape[0]-650:]
@@ -127,15 +140,7 @@ def main():
 
 					print(acc_val)
 
-					# find place to put accuracy value in table
-					target_row = 0
-					target_col = trial_mapping[trial_name + sub]
-					for row in range(len(table_data)):
-						if table_data[row][0] == curr_group:
-							target_row = row
-							break
-
-					table_data[target_row][target_col] = acc_val
+					set_table_value(table_data, curr_group, trial_mapping[trial_name + sub], acc_val)
 
 
 
@@ -146,6 +151,17 @@ def main():
 
 
 
+def set_table_value(table_data, group, target_col, value):
+	# Find place to put accuracy value in table
+	target_row = 0
+	for row in range(len(table_data)):
+		if table_data[row][0] == group:
+			target_row = row
+			break
+
+	table_data[target_row][target_col] = value
+
+
 def save_table(table, table_data):
 	table_str = table.get_string()
 	save_name = "accuracy_table_mean_iou_" + datetime.datetime.now().isoformat()
@@ -0,0 +1,100 @@
+import numpy as np
+from scipy.ndimage import uniform_filter, zoom
+
+
+##################################
+# LABEL FUSION
+##################################
+
+def local_similarity_weights(target, warped_image, radius=2, power=1.0, eps=1e-6):
+    '''
+    Per-voxel weight of one atlas: the inverse local mean squared intensity difference between the target and the
+    registered atlas image, over a (2 * radius + 1)^3 neighborhood, raised to power.
+    '''
+    diff = np.square(target.astype(np.float32) - warped_image.astype(np.float32))
+    return np.power(uniform_filter(diff, size=2 * radius + 1, mode='nearest') + eps, -power, dtype=np.float32)
+
+
+def majority_vote(label_maps, labels=None, target=None, warped_images=None, radius=2, power=1.0, chunk_size=16, atlas_weights=None):
+    '''
+    Fuses registered atlas segmentations into one by voting at every voxel.
+
+    Voting is vectorized over a chunk of slices (along axis 0) at a time, so temporary memory is bounded by about
+    (number of labels + number of atlases) float32 copies of one chunk rather than of the volume. The label maps and
+    warped images are only read a chunk at a time, so they may be memory-mapped (np.load(path, mmap_mode='r')).
+    Ties go to the smallest label value.
+
+    @params label_maps: List of K label arrays of the same shape, each registered to the target
+    @params labels: Label values to vote on (default: all values present)
+    @params target: Optional target image; together with warped_images, each atlas' vote is weighted per voxel by
+        its local similarity to the target (see local_similarity_weights), otherwise every atlas has one vote
+    @params warped_images: The K registered atlas images, in the order of label_maps
+    @params atlas_weights: Optional K prior weights (scalars or arrays shaped like the label maps) multiplied into
+        each atlas' votes, e.g. ramps that hand over from one registration to the next
+    @returns: Fused label array with the shape and dtype of label_maps[0]
+    '''
+    shape = label_maps[0].shape
+    assert all(label_map.shape == shape for label_map in label_maps)
+    weighted = target is not None and warped_images is not None
+    if weighted:
+        assert len(warped_images) == len(label_maps) and target.shape == shape
+    if labels is None:
+        labels = np.unique(np.concatenate([np.unique(label_map[start:start + chunk_size])
+                                           for label_map in label_maps for start in range(0, shape[0], chunk_size)]))
+    labels = np.sort(np.asarray(labels))
+
+    fused = np.empty(shape, dtype=label_maps[0].dtype)
+    for start in range(0, shape[0], chunk_size):
+        end = min(start + chunk_size, shape[0])
+        votes = np.zeros((len(labels),) + (end - start,) + shape[1:], dtype=np.float32)
+        for k, label_map in enumerate(label_maps):
+            weights = np.float32(1)
+            if weighted:
+                # The neighborhood of the chunk's edge slices reaches radius slices into the adjacent chunks.
+                lo, hi = max(start - radius, 0), min(end + radius, shape[0])
+                weights = local_similarity_weights(target[lo:hi], warped_images[k][lo:hi], radius, power)[start - lo:end - lo]
+            if atlas_weights is not None:
+                prior = atlas_weights[k]
+                weights = weights * (prior[start:end] if np.ndim(prior) else np.float32(prior))
+            chunk = label_map[start:end]
+            for i, label in enumerate(labels):
+                if weighted or atlas_weights is not None:
+                    votes[i] += np.where(chunk == label, weights, 0)
+                else:
+                    votes[i] += chunk == label
+        fused[start:end] = labels[np.argmax(votes, axis=0)]
+    return fused
+
+
+##################################
+# ATLAS SELECTION
+##################################
+
+def downsample(image, shape=(32, 32, 32)):
+    '''
+    Resizes an image to a small common shape (linear interpolation), so images of different sizes can be compared.
+    '''
+    # Striding first keeps the cost of zoom independent of the input size.
+    strides = [max(1, dim // (2 * target)) for dim, target in zip(image.shape, shape)]
+    image = image[tuple(slice(None, None, stride) for stride in strides)].astype(np.float32)
+    return zoom(image, [target / float(dim) for dim, target in zip(image.shape, shape)], order=1)
+
+
+def normalized_cross_correlation(a, b):
+    a = a - a.mean()
+    b = b - b.mean()
+    denominator = np.sqrt(np.sum(a * a) * np.sum(b * b))
+    return float(np.sum(a * b) / denominator) if denominator > 0 else 0.0
+
+
+def rank_atlases(target, atlas_images, shape=(32, 32, 32)):
+    '''
+    Orders atlases by a cheap similarity to the target: normalized cross correlation of the images resized to
+    shape, without any registration. Used to pick the atlases worth a full registration.
+
+    @params atlas_images: Iterable of atlas image arrays of any shapes; a generator keeps one full-size image in memory
+    @returns: List of (atlas index, similarity), most similar first
+    '''
+    target_small = downsample(target, shape)
+    scores = [normalized_cross_correlation(target_small, downsample(image, shape)) for image in atlas_images]
+    return sorted(enumerate(scores), key=lambda score: -score[1])
@@ -0,0 +1,81 @@
+import numpy as np
+
+
+# Humerus and biceps, the structures the Unet segments most reliably (see selection_labels in trainingconfig.ini).
+ALIGNMENT_LABELS = [7, 52]
+
+
+def get_physical_points(mask, origin, spacing, direction, max_points=200000):
+    '''
+    Physical coordinates of the voxels of a mask.
+
+    @params mask: Boolean array in SimpleITK array order (z, y, x), e.g. from sitk.GetArrayFromImage
+    @params origin, spacing, direction: Image geometry as returned by GetOrigin/GetSpacing/GetDirection
+    @params max_points: Voxels are subsampled evenly to at most this many; moments barely change
+    @returns: float64 array (num_points, 3) of (x, y, z) points
+    '''
+    indices = np.argwhere(mask)
+    if len(indices) > max_points:
+        indices = indices[::int(np.ceil(len(indices) / float(max_points)))]
+    # Array order is (z, y, x); image indices are (x, y, z).
+    indices = indices[:, ::-1].astype(np.float64)
+    direction = np.array(direction, dtype=np.float64).reshape(3, 3)
+    return np.array(origin, dtype=np.float64) + (indices * np.array(spacing, dtype=np.float64)).dot(direction.T)
+
+
+def get_moments(points):
+    '''
+    Centroid, principal axes (columns, by decreasing extent) and extents (standard deviations along the axes).
+    '''
+    centroid = points.mean(axis=0)
+    covariance = np.cov((points - centroid).T)
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    order = np.argsort(eigenvalues)[::-1]
+    return centroid, eigenvectors[:, order], np.sqrt(np.maximum(eigenvalues[order], 0))
+
+
+def align_moments(fixed_points, moving_points, scale=False):
+    '''
+    Coarse alignment of two point clouds by matching centroids and principal axes.
+
+    The sign of each principal axis is ambiguous; moving axes are flipped towards the corresponding fixed axes,
+    which picks the smallest rotation that matches them (scans of the arm are acquired in similar orientations),
+    and one axis is flipped back if needed to keep a proper rotation.
+
+    @params scale: Also scale along the principal axes to match extents (affine instead of rigid)
+    @returns: (A, t) with moving point = A.dot(fixed point) + t, the direction in which Elastix transforms map
+    '''
+    fixed_centroid, fixed_axes, fixed_extents = get_moments(fixed_points)
+    moving_centroid, moving_axes, moving_extents = get_moments(moving_points)
+
+    signs = np.sign(np.sum(fixed_axes * moving_axes, axis=0))
+    signs[signs == 0] = 1
+    moving_axes = moving_axes * signs
+    if np.linalg.det(moving_axes.dot(fixed_axes.T)) < 0:
+        moving_axes[:, 2] *= -1
+
+    if scale:
+        ratios = np.where(fixed_extents > 0, moving_extents / np.maximum(fixed_extents, 1e-12), 1)
+        A = moving_axes.dot(np.diag(ratios)).dot(fixed_axes.T)
+    else:
+        A = moving_axes.dot(fixed_axes.T)
+    t = moving_centroid - A.dot(fixed_centroid)
+    return A, t
+
+
+def align_segmentations(fixed_seg, fixed_geometry, moving_seg, moving_geometry, labels=None, scale=False):
+    '''
+    Coarse alignment of two scans from their segmentations of the same structures, e.g. a Unet prediction of the
+    target (pipeline.predict_whole_seg) and the ground truth of an atlas.
+
+    @params fixed_seg, moving_seg: Label arrays in SimpleITK array order
+    @params fixed_geometry, moving_geometry: (origin, spacing, direction) of each image
+    @params labels: Label values that form the mask (default ALIGNMENT_LABELS)
+    @returns: (A, t) as in align_moments
+    '''
+    labels = ALIGNMENT_LABELS if labels is None else labels
+    fixed_points = get_physical_points(np.isin(fixed_seg, labels), *fixed_geometry)
+    moving_points = get_physical_points(np.isin(moving_seg, labels), *moving_geometry)
+    if len(fixed_points) < 4 or len(moving_points) < 4:
+        raise ValueError("Segmentations contain too few voxels of labels %s to align." % (labels,))
+    return align_moments(fixed_points, moving_points, scale)
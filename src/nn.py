@@ -3,7 +3,13 @@ import tensorflow as tf
 import numpy as np
 import timeit
 import os
+import pickle
+import logging
 from collections import deque
+import profiling
+
+logger = logging.getLogger('__name__')
+
 ############################
 # Neural Network Functions #
 ############################
@@ -96,6 +102,20 @@ def dropout(x, keep_prob):
 # Training/Validation Functions #
 #################################
 
+# Label values of the classes scored by validate(), in order (background is not scored).
+VALIDATION_LABELS = [7, 8, 9, 45, 51, 52, 53, 68]
+
+def dice_score(acc, labels=None):
+    '''
+    Reduces the per-class Dice list returned by validate() to one number.
+
+    @params acc: List of per-class Dice scores from validate()
+    @params labels: Optional list of label values (e.g. [7, 52] for humerus and biceps) to average; all classes if None
+    '''
+    if not labels:
+        return float(np.mean(acc))
+    return float(np.mean([acc[VALIDATION_LABELS.index(label)] for label in labels]))
+
 def create_seg(output, label):
     output = output.copy()
     output[output != label] = -1
@@ -103,7 +123,8 @@ def create_seg(output, label):
     output[output == -1] = 0
     return output
 
-def validate(sess, model, x_test, y_test, verbose=False):
+@profiling.traced('validate')
+def validate(sess, model, x_test, y_test, verbose=False, indices=None):
     '''
     Calculates accuracy of validation set
     
@@ -112,12 +133,16 @@ def validate(sess, model, x_test, y_test, verbose=False):
     @params x_test: Numpy array of validation images
     @params y_test: Numpy array of validation labels
     @params batch_size: Integer defining mini-batch size
+    @params indices: Optional array of slice positions in x_test/y_test to validate on (e.g. a split of a
+        slice_store.SliceStore); all slices if None
     '''
     print("Calculating validation accuracy.")
+    if indices is None:
+        indices = np.arange(x_test.shape[0])
     scores = [0] * int(y_test.shape[3]-1)
-    for i in range(int(x_test.shape[0])):
+    for n, i in enumerate(indices):
         if verbose:
-            print("Accuracy calculation step:", i)
+            logger.debug("Accuracy calculation step: %d", n)
         for j in range(int(y_test.shape[3]-1)):
             gt = np.argmax(y_test[i,:,:,:], 2)
             gt = create_seg(gt, j+1)
@@ -127,7 +152,26 @@ def validate(sess, model, x_test, y_test, verbose=False):
             dice = 2*np.sum(overlap)/(np.sum(gt) + np.sum(pred) + 1)
             scores[j] = scores[j] + dice 
             
-    return [score/float(x_test.shape[0]) for score in scores]
+    return [score/float(len(indices)) for score in scores]
+
+def validate_by_trial(sess, model, x_test, y_test, trial_ids, verbose=False, indices=None):
+    '''
+    Calculates validation accuracy separately for every trial, e.g. for the test trials of a split manifest.
+
+    @params trial_ids: List with the trial id of every validated slice (in the order of indices, if given)
+    @params indices: Optional array of slice positions in x_test/y_test, as in validate()
+    @returns: Dict of trial id -> list of per-class Dice, as returned by validate()
+    '''
+    if indices is None:
+        indices = np.arange(x_test.shape[0])
+    indices = np.asarray(indices)
+    trial_ids = np.array(trial_ids)
+    accs = {}
+    for trial in sorted(set(trial_ids)):
+        if verbose:
+            logger.debug("Validating trial %s", trial)
+        accs[trial] = validate(sess, model, x_test, y_test, indices=indices[trial_ids == trial])
+    return accs
 
 def train_print(i, j, loss, batch, batch_total, time):
     '''
@@ -170,7 +214,19 @@ def train(sess,
           train_validation = 5,
           start_step = 0,
           models_dir = None,
-          model_name = None):
+          model_name = None,
+          stats = None,
+          start_epoch = 0,
+          history = None,
+          checkpointer = None,
+          checkpoint_manager = None,
+          lr_schedule = None,
+          early_stopping = None,
+          validator = None,
+          sampler = None,
+          train_indices = None,
+          val_indices = None,
+          augmenter = None):
     '''
     Main function for training neural network model. 
     
@@ -178,27 +234,84 @@ def train(sess,
     @params summary_writer: Tf.summary.FileWriter used for Tensorboard variables
     @params batch_size: Integer defining mini-batch size
     @params train_validation: Integer defining how many train steps before running accuracy on training mini-batch
+    @params stats: Optional dict, filled with the number of slices trained on and the time spent in training steps
+    @params start_epoch: Integer index of the first epoch to run (non-zero when resuming)
+    @params history: Optional dict restored by load_train_state, holding losses/accs from the epochs already run
+    @params checkpointer: Optional checkpointing.AsyncCheckpointer; epoch checkpoints are then written in the background
+    @params checkpoint_manager: Optional checkpointing.CheckpointManager tracking validation Dice and pruning checkpoints
+    @params lr_schedule: Optional schedules.*Schedule giving each epoch's learning rate (model default otherwise)
+    @params early_stopping: Optional schedules.EarlyStopping; training ends once validation Dice stops improving
+    @params validator: Optional validation_worker.ValidationWorker; every epoch is then checkpointed and validated in the
+        background, and the scores are recorded as they arrive instead of after each epoch
+    @params sampler: Optional sampler.SliceSampler choosing each epoch's slices; uniform shuffle otherwise
+    @params train_indices, val_indices: Optional slice positions in x_train/y_train and x_test/y_test, so both can be
+        one shared slice_store.SliceStore; every slice is used if None
+    @params augmenter: Optional augmentation.OnlineAugmenter applied to every training minibatch
     '''
     losses = deque([])
     epoch_losses = []
     train_accs = deque([])
     step = start_step
 
+    num_train = len(train_indices) if train_indices is not None else x_train.shape[0]
+
+    if history:
+        losses = deque(history.get('recent_losses', []))
+        epoch_losses = list(history['losses'])
+        train_accs = deque(history['accs'])
 
+    def on_validated(epoch, val_step, acc):
+        # Records one epoch's validation Dice; returns True when early stopping says training should end.
+        train_accs.append(acc)
+        summary = tf.Summary()
+        for k in range(len(acc)):
+            summary.value.add(tag="validation_acc_" + str(k), simple_value=acc[k])
+        if summary_writer:
+            summary_writer.add_summary(summary, val_step)
+        if validator:
+            print("Epoch {:1} | Acc: {}".format(epoch, np.round(acc,3)))
+        if checkpoint_manager:
+            checkpoint_manager.add_score(epoch, acc)
+        if lr_schedule:
+            lr_schedule.update(epoch, acc)
+        if early_stopping and early_stopping.update(epoch, acc):
+            print("Early stopping after epoch %d: no validation Dice improvement since epoch %d." % (epoch, early_stopping.best_epoch))
+            return True
+        return False
 
-    for i in range(epochs):
+    if validator and models_dir and model_name:
+        # Epochs checkpointed before an interruption but never scored are validated again before training continues.
+        for epoch in range(len(train_accs), start_epoch):
+            checkpoint_path = get_checkpoint_path(models_dir, model_name, epoch)
+            validator.submit(epoch, load_train_state(checkpoint_path, model_name)['step'], checkpoint_path)
+        for epoch, val_step, acc in validator.poll(block=True):
+            on_validated(epoch, val_step, acc)
+
+    for i in range(start_epoch, epochs):
+        if early_stopping and early_stopping.should_stop():
+            break
+        learning_rate = lr_schedule.learning_rate(i) if lr_schedule else None
 
         # Shuffle indicies
-        indicies = list(np.arange(x_train.shape[0]))
-        np.random.shuffle(indicies)
+        if sampler:
+            indicies = sampler.epoch_indices()
+        else:
+            indicies = list(np.arange(num_train))
+            np.random.shuffle(indicies)
+        if train_indices is not None:
+            indicies = np.asarray(train_indices)[indicies]
         # Start timer
         start = timeit.default_timer()
 
-        for j in range(int(x_train.shape[0]/batch_size)):
+        for j in range(int(num_train/batch_size)):
             # Shuffle Data
             temp_indicies = indicies[j*batch_size:(j+1)*batch_size]
             x_train_temp, y_train_temp = x_train[temp_indicies], y_train[temp_indicies]
-            loss, loss_summary = model.fit_batch(sess,x_train_temp, y_train_temp)
+            if augmenter:
+                x_train_temp, y_train_temp = augmenter.augment_batch(x_train_temp, y_train_temp)
+            with profiling.span('fit_batch'):
+                loss, loss_summary = model.fit_batch(sess,x_train_temp, y_train_temp, learning_rate)
+            profiling.count('slices_trained', len(temp_indicies))
             if summary_writer:
                 summary_writer.add_summary(loss_summary, step)
             if len(losses) == 20:
@@ -207,42 +320,109 @@ def train(sess,
             # How often to test accuracy on training batch
             stop = timeit.default_timer()
             
-            train_print(i, j, np.mean(losses), j*batch_size, x_train.shape[0], stop - start)
+            train_print(i, j, np.mean(losses), j*batch_size, num_train, stop - start)
             step = step + 1
 
         # Tail case 
-        if x_train.shape[0] % batch_size != 0:
+        if num_train % batch_size != 0:
             temp_indicies = indicies[(j+1)*batch_size:]
             x_train_temp, y_train_temp = x_train[temp_indicies], y_train[temp_indicies]
-            loss, loss_summary = model.fit_batch(sess,x_train_temp, y_train_temp)
+            if augmenter:
+                x_train_temp, y_train_temp = augmenter.augment_batch(x_train_temp, y_train_temp)
+            with profiling.span('fit_batch'):
+                loss, loss_summary = model.fit_batch(sess,x_train_temp, y_train_temp, learning_rate)
+            profiling.count('slices_trained', len(temp_indicies))
             if summary_writer:
                 summary_writer.add_summary(loss_summary, step)
             if len(losses) == 20:
                 losses.popleft()
             losses.append(loss)
             stop = timeit.default_timer()
-            train_print(i, j, np.mean(losses), j*batch_size, x_train.shape[0], stop - start)
+            train_print(i, j, np.mean(losses), j*batch_size, num_train, stop - start)
             step = step + 1
 
         stop = timeit.default_timer()
-        acc = validate(sess, model, x_test, y_test)
-        train_accs.append(acc)
-        summary = tf.Summary()
-        for k in range(len(acc)):
-            summary.value.add(tag="validation_acc_" + str(k), simple_value=acc[k])
-        if summary_writer:    
+        if stats is not None:
+            stats['slices'] = stats.get('slices', 0) + num_train
+            stats['train_seconds'] = stats.get('train_seconds', 0.0) + (stop - start)
+            stats['epochs'] = stats.get('epochs', 0) + 1
+        if summary_writer and learning_rate is not None:
+            summary = tf.Summary()
+            summary.value.add(tag="learning_rate", simple_value=learning_rate)
             summary_writer.add_summary(summary, step)
-        val_print(i, j, np.mean(losses), acc, stop - start)
-        print()
 
         epoch_losses.append(np.mean(losses))
+
+        if validator:
+            stop_training = False
+            for epoch, val_step, acc in validator.poll():
+                stop_training = on_validated(epoch, val_step, acc) or stop_training
+        else:
+            acc = validate(sess, model, x_test, y_test, indices=val_indices)
+            val_print(i, j, np.mean(losses), acc, stop - start)
+            print()
+            stop_training = on_validated(i, step, acc)
         
-        if i % auto_save_interval == 0:
+        # The last epoch before an early stop is always saved so a resumed run sees that training has finished.
+        # Asynchronous validation reads every epoch from its checkpoint.
+        if i % auto_save_interval == 0 or stop_training or validator:
             if models_dir and model_name:
-                checkpoint_name = model_name + "_epoch_" + str(i)
+                checkpoint_path = get_checkpoint_path(models_dir, model_name, i)
                 if not os.path.isdir(os.path.join(models_dir, model_name)):
                     os.mkdir(os.path.join(models_dir, model_name))
-                checkpoint_path = os.path.join(os.path.join(models_dir, model_name), checkpoint_name)
-                os.mkdir(checkpoint_path)
-                saver.save(sess, os.path.join(checkpoint_path, model_name))
+                state = {'epoch': i,
+                         'step': step,
+                         'rng_state': np.random.get_state(),
+                         'recent_losses': list(losses),
+                         'losses': list(epoch_losses),
+                         'accs': list(train_accs),
+                         'stats': dict(stats) if stats is not None else None,
+                         'lr_schedule': lr_schedule.get_state() if lr_schedule else None,
+                         'early_stopping': early_stopping.get_state() if early_stopping else None}
+                # The state is written after the variables, so its presence marks the checkpoint as complete and resumable.
+                def on_saved(path=checkpoint_path, state=state, epoch=i, saved_step=step):
+                    save_train_state(path, model_name, state)
+                    if checkpoint_manager:
+                        checkpoint_manager.add_checkpoint(epoch, path)
+                    if validator:
+                        validator.submit(epoch, saved_step, path)
+
+                if checkpointer:
+                    checkpointer.save(sess, checkpoint_path, model_name, on_complete=on_saved)
+                else:
+                    if not os.path.isdir(checkpoint_path):
+                        os.mkdir(checkpoint_path)
+                    saver.save(sess, os.path.join(checkpoint_path, model_name))
+                    on_saved()
+        if stop_training:
+            break
+
+    if validator:
+        # Results of the last epochs are still in flight; wait for them before the history is returned.
+        if checkpointer:
+            checkpointer.wait()
+        for epoch, val_step, acc in validator.poll(block=True):
+            on_validated(epoch, val_step, acc)
     return epoch_losses, train_accs
+
+def get_checkpoint_path(models_dir, model_name, epoch):
+    return os.path.join(models_dir, model_name, model_name + "_epoch_" + str(epoch))
+
+def save_train_state(checkpoint_path, model_name, state):
+    '''
+    Pickles everything besides the variables (which the Saver writes) needed to continue training after an epoch.
+
+    @params checkpoint_path: String path of the epoch checkpoint folder
+    @params state: Dict with epoch, step, rng_state, recent_losses, losses, accs, stats and schedule states
+    '''
+    state_path = os.path.join(checkpoint_path, model_name + "_train_state.pickle")
+    with open(state_path + ".tmp", "wb") as fp:
+        pickle.dump(state, fp)
+    os.replace(state_path + ".tmp", state_path)
+
+def load_train_state(checkpoint_path, model_name):
+    state_path = os.path.join(checkpoint_path, model_name + "_train_state.pickle")
+    if not os.path.isfile(state_path):
+        return None
+    with open(state_path, "rb") as fp:
+        return pickle.load(fp)
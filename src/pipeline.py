@@ -5,12 +5,16 @@ import tensorflow as tf
 import sys
 sys.path.append('src/')
 import nn
+import profiling
 import nibabel as nib
 import scipy.sparse
 from scipy.misc import imresize
 import Unet
 import logging
 import gc
+import time
+import hashlib
+from contextlib import contextmanager
 
 
 logger = logging.getLogger('__name__')
@@ -22,46 +26,17 @@ logger.setLevel(logging.DEBUG)
 
 def split_data(raw_data, seg_data, percent_train, percent_val, percent_test, percent_keep, total_keep = 0):
     assert len(raw_data) == len(seg_data)
-    assert percent_train + percent_val + percent_test == 100
-
-    x_train, y_train = [], []
-    x_val, y_val = [], []
-    x_test, y_test = [], []
 
     height, width = raw_data[0].shape
 
-    reduced_range = floor(percent_keep/100*len(raw_data))
-    logger.debug(reduced_range)
-    num_train = np.round(reduced_range * percent_train/100).astype(np.int)
-    num_val = np.round(num_train + reduced_range * percent_val/100).astype(np.int)
-    num_test = np.round(num_val + reduced_range * percent_test/100).astype(np.int)
-
-    rand_indices = list(np.random.choice(floor((percent_keep/100)*len(raw_data)), floor((percent_keep/100)*len(raw_data)), replace=False))
-
-    
-    logger.debug("Randomizing data sets (in split_data).")
-
-    for i in rand_indices[:num_train]:
-        x_train.append(raw_data[i])
-        y_train.append(seg_data[i])
-    for j in rand_indices[num_train:num_val]:
-        x_val.append(raw_data[j])
-        y_val.append(seg_data[j])
-    for k in rand_indices[num_val:num_test]:
-        x_test.append(raw_data[k])
-        y_test.append(seg_data[k])
-
-    x_train = np.array(x_train).reshape((len(x_train), height, width, 1))
-    x_val = np.array(x_val).reshape((len(x_val), height, width, 1))
-    x_test = np.array(x_test).reshape((len(x_test), height, width, 1))
-    y_train = np.array(y_train)
-    y_val = np.array(y_val)
-    y_test = np.array(y_test)
-
-    if total_keep != 0:
-        x_train = x_train[:total_keep]
-        y_train = y_train[:total_keep]
+    train_indices, val_indices, test_indices = split_indices(len(raw_data), percent_train, percent_val, percent_test, percent_keep, total_keep)
 
+    x_train = np.array([raw_data[i] for i in train_indices]).reshape((len(train_indices), height, width, 1))
+    x_val = np.array([raw_data[j] for j in val_indices]).reshape((len(val_indices), height, width, 1))
+    x_test = np.array([raw_data[k] for k in test_indices]).reshape((len(test_indices), height, width, 1))
+    y_train = np.array([seg_data[i] for i in train_indices])
+    y_val = np.array([seg_data[j] for j in val_indices])
+    y_test = np.array([seg_data[k] for k in test_indices])
 
     logger.debug(x_train.shape)
     logger.debug(x_test.shape)
@@ -72,6 +47,34 @@ def split_data(raw_data, seg_data, percent_train, percent_val, percent_test, per
 
     return x_train, x_val, x_test, y_train, y_val, y_test
 
+@profiling.traced('split')
+def split_indices(num_slices, percent_train, percent_val, percent_test, percent_keep, total_keep = 0):
+    """
+    Index-only version of split_data: draws the same random split, but returns positions instead of copying the
+    slices, so callers holding one backing array (see slice_store.SliceStore) can index into it.
+
+    Returns:
+        tuple: Integer arrays (train, val, test) of positions in range(num_slices).
+    """
+    assert percent_train + percent_val + percent_test == 100
+
+    reduced_range = floor(percent_keep/100*num_slices)
+    logger.debug(reduced_range)
+    num_train = np.round(reduced_range * percent_train/100).astype(np.int)
+    num_val = np.round(num_train + reduced_range * percent_val/100).astype(np.int)
+    num_test = np.round(num_val + reduced_range * percent_test/100).astype(np.int)
+
+    rand_indices = np.random.choice(floor((percent_keep/100)*num_slices), floor((percent_keep/100)*num_slices), replace=False)
+
+    logger.debug("Randomizing data sets (in split_indices).")
+
+    train_indices = rand_indices[:num_train]
+    if total_keep != 0:
+        train_indices = train_indices[:total_keep]
+
+    return train_indices, rand_indices[num_train:num_val], rand_indices[num_val:num_test]
+
+@profiling.traced('encode')
 def one_hot_encode(L, class_labels):
     """
     TODO: ensure encoding remains consistent
@@ -80,7 +83,7 @@ def one_hot_encode(L, class_labels):
     # One Hot Encode the label 2d array -> .npy files with dim (h, w, len(class_labels))
     # num classes will be 8? but currently dynamically allocated based on num colors in all scans.
     """
-    print("L shape:", L.shape)
+    logger.debug("L shape: %s", L.shape)
     h, w = L.shape
     try:
         encoded = np.array([list(map(class_labels.index, L.flatten()))])
@@ -93,7 +96,7 @@ def one_hot_encode(L, class_labels):
                 Lhot[i,j,L[i,j]] = 1
         return Lhot
     except Exception as e:
-        print("Error during one hot encoding:", e)
+        logger.error("Error during one hot encoding: %s", e)
 
 def save_one_hot_encoded(nii_data_arr, class_labels, save_local=False, save_name=None, save_dir=None):
     """
@@ -212,6 +215,7 @@ def batch_img_resize(images, h = 256, w = 256):
         images_resized = np.append(images_resized, np.expand_dims(temp, axis=0), axis=0)
     return images_resized
 
+@profiling.traced('crop')
 def crop_image(img, height, width):
     orig_height, orig_width = img.shape
     height_remove = (orig_height - height) / 2
@@ -225,14 +229,14 @@ def crop_image(img, height, width):
     
     return cropped
 
+@profiling.traced('pad')
 def pad_image(orig_img, height, width):    
     orig_height, orig_width = orig_img.shape
     
     height_pad = (height - orig_height) / 2
     width_pad = (width - orig_width) / 2
-    print("new height:", height, "orig height:", orig_height)
-    print("new width:", width, "orig width", orig_width)
-    print("height_pad:", height_pad, "width_pad:", width_pad)
+    logger.debug("new height: %s orig height: %s new width: %s orig width: %s height_pad: %s width_pad: %s",
+                 height, orig_height, width, orig_width, height_pad, width_pad)
     
     height_top_pad = floor(height_pad)
     height_bot_pad =  ceil(height_pad)
@@ -251,29 +255,31 @@ def find_training_dim(scan_paths):
     # This is actually the second largest in the dims of the niftis (we want the largest dimension not along the arm)
     max_dim = 0
     for scan_path in scan_paths:
-        print("curr scan_path:", scan_path)
+        logger.debug("curr scan_path: %s", scan_path)
         for item in os.listdir(scan_path):
             # Assume any non hidden file in the scan path is a nifti we're looking for. Set directories so this is true.
             item_path = os.path.join(scan_path, item)
-            print(item_path)
+            logger.debug(item_path)
             if os.path.isfile(item_path) and not item.startswith('.'):
+                # The header holds the shape; there is no need to decode the voxel data here.
                 nifti = nib.load(item_path)
-                nifti_shape = nifti.get_fdata().shape
+                nifti_shape = nifti.shape
                 curr_max = sorted(nifti_shape, reverse=True)[1] # Second largest
                 if curr_max > max_dim:
                     max_dim = curr_max
     gc.collect()
-    print("the max dim is: ", max_dim)
+    logger.debug("the max dim is: %s", max_dim)
 
     # return 512 if max_dim <= 512 else 1024
     return max_dim
 
-def load_all_data(training_dir, encode_segs=False, use_pre_encoded=True, no_empty=False, reorient=True, predicting=False, include_lower=True, load_augmented=False):
-    raw_images = []
-    segmentations = []    
+def find_scan_paths(training_dir, load_augmented=False):
+    """
+    Lists the trial folders of training_dir: the original scans, or with load_augmented=True only the augmented
+    copies (folders ending in _ed or _rot).
+    """
     scan_paths = []
-    
-    print(os.listdir(training_dir))
+    logger.debug(os.listdir(training_dir))
     for folder in os.listdir(training_dir):
         if os.path.isdir(os.path.join(training_dir, folder)) and not folder.startswith('.') and 'trial' in folder.lower():
             if folder.lower().endswith("_ed") or folder.lower().endswith("_rot"):
@@ -288,26 +294,43 @@ def load_all_data(training_dir, encode_segs=False, use_pre_encoded=True, no_empt
                     scan_paths.append(scan_folder_path)
                 else:
                     continue
+    return scan_paths
 
+def load_all_data(training_dir, encode_segs=False, use_pre_encoded=True, no_empty=False, reorient=True, predicting=False, include_lower=True, load_augmented=False, cache_dir=None, return_trials=False):
+    """
+    Loads every trial folder in training_dir. With return_trials=True, a fourth value lists the trial folder name
+    of every slice, which splits.get_trial_id maps to the ids used by splits.split_indices_by_trial.
+    """
+    raw_images = []
+    segmentations = []    
+    trial_names = []
+    
+    scan_paths = find_scan_paths(training_dir, load_augmented)
     
     logger.debug("%s", scan_paths)
 
     if len(scan_paths) == 0:
-        return [], [], None
+        return ([], [], None, []) if return_trials else ([], [], None)
 
     max_dim = find_training_dim(scan_paths)
 
     training_dim = 512 if max_dim <= 512 else 1024
     
     for scan_path in scan_paths:
-        scan_data_raw, scan_data_labels, orig_dims = load_data(scan_path, reorient, training_dim, training_dim, encode_segs, use_pre_encoded, no_empty, predicting, include_lower)
+        scan_data_raw, scan_data_labels, orig_dims = load_data(scan_path, reorient, training_dim, training_dim, encode_segs, use_pre_encoded, no_empty, predicting, include_lower, cache_dir=cache_dir)
         raw_images.extend(scan_data_raw)
         segmentations.extend(scan_data_labels)
+        trial_names.extend([os.path.basename(scan_path)] * len(scan_data_raw))
     
+    if return_trials:
+        return raw_images, segmentations, orig_dims, trial_names
     return raw_images, segmentations, orig_dims
 
 
-def load_data(nifti_training_dir, reorient, height, width, encode_segs=False, use_pre_encoded=True, no_empty=False, predicting=False, include_lower=True):
+def load_data(nifti_training_dir, reorient, height, width, encode_segs=False, use_pre_encoded=True, no_empty=False, predicting=False, include_lower=True, cache_dir=None):
+    if cache_dir:
+        return load_data_cached(cache_dir, nifti_training_dir, reorient, height, width, encode_segs, use_pre_encoded, no_empty, predicting, include_lower)
+
     # Label casting is done to attempt to fix mislabeling of one class. 
     label_cast_source = 1
     label_cast_dest = 7
@@ -344,11 +367,11 @@ def load_data(nifti_training_dir, reorient, height, width, encode_segs=False, us
     # ASSUMPTION: Apply same transformation to all niftis to get proper orientation, that is, swap (x, y) dimensions. This is to match the orientation of our new data
     # to previous data. Reorienting is not required in general.
     if reorient:
-        print("reorienting")
-        print("before dims:", raw_nifti_arr.shape, seg_nifti_arr.shape)
+        logger.debug("reorienting")
+        logger.debug("before dims: %s %s", raw_nifti_arr.shape, seg_nifti_arr.shape)
         raw_nifti_arr = np.swapaxes(raw_nifti_arr, 0, 2)
         seg_nifti_arr = np.swapaxes(seg_nifti_arr, 0, 2)
-        print("new dims:", raw_nifti_arr.shape, seg_nifti_arr.shape)
+        logger.debug("new dims: %s %s", raw_nifti_arr.shape, seg_nifti_arr.shape)
 
     if not include_lower:
         raw_nifti_arr = raw_nifti_arr[raw_nifti_arr.shape[0]-650:]
@@ -359,31 +382,135 @@ def load_data(nifti_training_dir, reorient, height, width, encode_segs=False, us
             logger.debug("Slice skipped due to being empty: %s", i)
             continue
 
-        print("Padding and encoding from", nifti_training_dir, ":", i)
+        logger.debug("Padding and encoding from %s : %d", nifti_training_dir, i)
         raw_images.append(pad_image(raw_nifti_arr[i], height, width))
+        profiling.count('slices_loaded')
 
         if not predicting:
-            print("ADDED SEG")
+            logger.debug("ADDED SEG")
             padded_image = pad_image(seg_nifti_arr[i], height, width)
             casted_image = cast_label_numbers(padded_image, label_cast_source, label_cast_dest)
             encoded_seg = one_hot_encode(casted_image, default_raw_pixel_classes)
-            print("ENCODED SEG SHAPE:", encoded_seg.shape)
+            logger.debug("ENCODED SEG SHAPE: %s", encoded_seg.shape)
             segmentations.append(encoded_seg)
 
         
     return raw_images, segmentations, orig_dims
 
 
+##################################
+# DATA CACHE
+##################################
+
+# Bump when the cached representation or the preprocessing in load_data changes.
+DATA_CACHE_VERSION = 1
+DATA_CACHE_CLASSES = [0, 7, 8, 9, 45, 51, 52, 53, 68]
+
+def get_data_cache_path(cache_dir, nifti_training_dir, reorient, height, width, no_empty, predicting, include_lower):
+    """
+    Returns the cache file for one scan folder. The key covers the folder contents (names, sizes and modification
+    times) and every argument that changes the preprocessed output, so edited scans are never served stale.
+    """
+    entries = []
+    for item in sorted(os.listdir(nifti_training_dir)):
+        item_path = os.path.join(nifti_training_dir, item)
+        if os.path.isfile(item_path) and not item.startswith('.'):
+            stat = os.stat(item_path)
+            entries.append((item, stat.st_size, int(stat.st_mtime)))
+    key = repr((os.path.abspath(nifti_training_dir), entries, reorient, height, width, no_empty, predicting, include_lower, DATA_CACHE_VERSION))
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, os.path.basename(os.path.normpath(nifti_training_dir)) + "_" + digest + ".npz")
+
+def load_data_cached(cache_dir, nifti_training_dir, reorient, height, width, encode_segs=False, use_pre_encoded=True, no_empty=False, predicting=False, include_lower=True):
+    """
+    Same contract as load_data, backed by a preprocessed cache shared between training runs (and between concurrent
+    jobs of the training scheduler). Raw slices are stored as float32 and segmentations as uint8 class indices, and
+    are one-hot encoded again on the way out.
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    cache_path = get_data_cache_path(cache_dir, nifti_training_dir, reorient, height, width, no_empty, predicting, include_lower)
+
+    cached = read_data_cache(cache_path)
+    if cached is not None:
+        return cached
+
+    with data_cache_lock(cache_path):
+        # Another job may have filled the cache while this one waited for the lock.
+        cached = read_data_cache(cache_path)
+        if cached is not None:
+            return cached
+
+        raw_images, segmentations, orig_dims = load_data(nifti_training_dir, reorient, height, width, encode_segs, use_pre_encoded, no_empty, predicting, include_lower)
+        write_data_cache(cache_path, raw_images, segmentations, orig_dims)
+
+    return raw_images, segmentations, orig_dims
+
+def read_data_cache(cache_path):
+    if not os.path.isfile(cache_path):
+        return None
+    logger.debug("Loading cached scan data from %s", cache_path)
+    with np.load(cache_path) as cached:
+        raw = cached['raw']
+        labels = cached['labels']
+        orig_dims = tuple(int(d) for d in cached['orig_dims'])
+    encoder = np.eye(len(DATA_CACHE_CLASSES))
+    raw_images = list(raw)
+    segmentations = [encoder[label] for label in labels]
+    return raw_images, segmentations, orig_dims
+
+def write_data_cache(cache_path, raw_images, segmentations, orig_dims):
+    if any(seg is None for seg in segmentations):
+        logger.warning("Not caching %s: a segmentation slice failed to encode.", cache_path)
+        return
+    raw = np.array(raw_images, dtype=np.float32)
+    if segmentations:
+        labels = np.array([np.argmax(seg, axis=2) for seg in segmentations], dtype=np.uint8)
+    else:
+        labels = np.empty((0,), dtype=np.uint8)
+
+    # Write to a temporary file and rename so readers never see a partial cache entry.
+    tmp_path = cache_path + ".tmp" + str(os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, raw=raw, labels=labels, orig_dims=np.array(orig_dims))
+    os.replace(tmp_path, cache_path)
+    logger.debug("Cached scan data to %s", cache_path)
+
+@contextmanager
+def data_cache_lock(cache_path, poll_seconds=5, stale_seconds=6*3600):
+    lock_path = cache_path + ".lock"
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > stale_seconds:
+                    logger.warning("Removing stale cache lock %s", lock_path)
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                continue
+            time.sleep(poll_seconds)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+
 def cast_label_numbers(seg_image_slice, src, dst):
     np.place(seg_image_slice, seg_image_slice == src, dst)
     return seg_image_slice
     
 
 
+@profiling.traced('decode')
 def load_nifti_data(nifti_path):
     nifti = nib.load(nifti_path)
     return nifti.get_fdata()
 
+@profiling.traced('save')
 def save_arr_as_nifti(arr, orig_nifti_name, save_name, nii_data_dir, save_dir):
     '''
     orig_nifti_name should include file extension .nii.
@@ -435,6 +562,7 @@ def reorient_nifti_arr(nifti_arr):
 # PREDICTION FUNCTIONS
 ##################################
 
+@profiling.traced('predict')
 def predict_image(img, model, sess):
     prediction = model.predict(sess, img)
     pred_classes = np.argmax(prediction[0], axis=2)
@@ -515,8 +643,8 @@ def predict_all_segs(to_segment_dir, save_dir, nii_data_dir, model, sess, reorie
         logger.debug("Predicting segmentation for %s", trial_name)
         pred_seg = predict_whole_seg(raw_scan_data_arr, model, sess, predict_lower=predict_lower)
 
-        print("orig dims:", orig_dims)
-        print("pred_seg dims:", pred_seg.shape)
+        logger.debug("orig dims: %s", orig_dims)
+        logger.debug("pred_seg dims: %s", pred_seg.shape)
         restore_height, restore_width = orig_dims[1], orig_dims[2]
         if reorient:
             restore_height, restore_width = orig_dims[1], orig_dims[0]
@@ -526,10 +654,10 @@ def predict_all_segs(to_segment_dir, save_dir, nii_data_dir, model, sess, reorie
         for i in range(pred_seg.shape[0]):
             cropped_pred_seg[i] = crop_image(pred_seg[i], restore_height, restore_width)
 
-        print("cropped_pred_seg dims:", cropped_pred_seg.shape)
+        logger.debug("cropped_pred_seg dims: %s", cropped_pred_seg.shape)
         if reorient:
             cropped_pred_seg = reorient_nifti_arr(cropped_pred_seg)
-            print("reoriented cropped_pred_seg dims:", cropped_pred_seg.shape)
+            logger.debug("reoriented cropped_pred_seg dims: %s", cropped_pred_seg.shape)
         
         pred_seg = cropped_pred_seg
 
@@ -546,6 +674,43 @@ def predict_all_segs(to_segment_dir, save_dir, nii_data_dir, model, sess, reorie
 def save_model(models_dir, model_name, saver, sess):
     saver.save(sess, os.path.join(os.path.join(models_dir, model_name), model_name))
 
+def list_epoch_checkpoints(models_dir, model_name):
+    """
+    Lists the complete epoch checkpoints of a model, i.e. the folders <models_dir>/<model_name>/<model_name>_epoch_N
+    that hold both the variables and the training state written by nn.train.
+
+    Returns:
+        dict: Maps each epoch N to the path of its checkpoint folder.
+    """
+    model_path = os.path.join(models_dir, model_name)
+    if not os.path.isdir(model_path):
+        return {}
+
+    prefix = model_name + "_epoch_"
+    checkpoints = {}
+    for folder in os.listdir(model_path):
+        if not folder.startswith(prefix) or not folder[len(prefix):].isdigit():
+            continue
+        checkpoint_path = os.path.join(model_path, folder)
+        complete = os.path.isfile(os.path.join(checkpoint_path, model_name + ".index")) and \
+                   os.path.isfile(os.path.join(checkpoint_path, model_name + "_train_state.pickle"))
+        if complete:
+            checkpoints[int(folder[len(prefix):])] = checkpoint_path
+    return checkpoints
+
+def find_latest_checkpoint(models_dir, model_name):
+    """
+    Finds the most recent resumable epoch checkpoint of a model.
+
+    Returns:
+        (str, int): Path of the epoch folder and its epoch, or (None, None) if there is nothing to resume.
+    """
+    checkpoints = list_epoch_checkpoints(models_dir, model_name)
+    if not checkpoints:
+        return None, None
+    latest_epoch = max(checkpoints)
+    return checkpoints[latest_epoch], latest_epoch
+
 def load_model(models_dir, model_name, saver, sess):
     model_path = os.path.join(models_dir, model_name)
     meta_file = model_name + '.meta'
@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import logging
+import threading
+import functools
+from prettytable import PrettyTable
+
+
+logger = logging.getLogger('__name__')
+
+##################################
+# STATE
+##################################
+
+# Everything below is a no-op until enable() is called: span() hands out one shared null context manager and the
+# traced() wrappers only test this flag, so instrumented code pays one attribute lookup per call when disabled.
+_enabled = False
+_trace_path = None
+_max_events = 0
+_start = 0.0
+_events = []
+_dropped_events = 0
+_totals = {}
+_counters = {}
+_lock = threading.Lock()
+
+
+def enable(trace_path=None, max_events=1000000):
+    '''
+    Starts recording spans and counters, discarding anything recorded before.
+
+    @params trace_path: Optional .json file that finish() writes a Chrome trace to (open in chrome://tracing or
+        https://ui.perfetto.dev); without it only the summary is kept
+    @params max_events: Trace events kept in memory; later events still count towards the summary
+    '''
+    global _enabled, _trace_path, _max_events
+    reset()
+    _trace_path = trace_path or None
+    _max_events = max_events
+    _enabled = True
+    logger.info("Profiling enabled%s.", " (trace: %s)" % _trace_path if _trace_path else "")
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    global _start, _dropped_events
+    with _lock:
+        _start = time.time()
+        _dropped_events = 0
+        del _events[:]
+        _totals.clear()
+        _counters.clear()
+
+
+##################################
+# SPANS AND COUNTERS
+##################################
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.begin = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        _record(self.name, self.begin, time.time() - self.begin, self.args)
+        return False
+
+
+def _record(name, begin, seconds, args=None):
+    global _dropped_events
+    with _lock:
+        total = _totals.setdefault(name, [0, 0.0, 0.0])
+        total[0] += 1
+        total[1] += seconds
+        total[2] = max(total[2], seconds)
+        if len(_events) < _max_events:
+            event = {'name': name, 'ph': 'X', 'ts': (begin - _start) * 1e6, 'dur': seconds * 1e6,
+                     'pid': os.getpid(), 'tid': threading.current_thread().ident}
+            if args:
+                event['args'] = args
+            _events.append(event)
+        else:
+            _dropped_events += 1
+
+
+def span(name, **args):
+    '''
+    Context manager timing the enclosed block as one occurrence of the stage name, e.g.
+
+        with profiling.span('decode', path=nifti_path):
+            ...
+
+    @params args: Optional values shown with the event in the trace
+    '''
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def traced(name):
+    '''
+    Decorator recording every call of the function as a span.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            begin = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record(name, begin, time.time() - begin)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    '''
+    Adds value to a running counter, e.g. slices loaded or predicted.
+    '''
+    global _dropped_events
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+        if len(_events) < _max_events:
+            _events.append({'name': name, 'ph': 'C', 'ts': (time.time() - _start) * 1e6, 'pid': os.getpid(),
+                            'args': {name: _counters[name]}})
+        else:
+            _dropped_events += 1
+
+
+##################################
+# EXPORT
+##################################
+
+def get_summary():
+    '''
+    @returns: List of dicts (name, calls, seconds, mean_ms, max_ms), slowest stage first. Times of nested spans are
+        also included in their enclosing span.
+    '''
+    with _lock:
+        totals = dict(_totals)
+    summary = [{'name': name, 'calls': calls, 'seconds': seconds, 'mean_ms': 1000 * seconds / calls, 'max_ms': 1000 * longest}
+               for name, (calls, seconds, longest) in totals.items()]
+    return sorted(summary, key=lambda row: -row['seconds'])
+
+
+def get_counters():
+    with _lock:
+        return dict(_counters)
+
+
+def format_summary():
+    table = PrettyTable(['stage', 'calls', 'total s', 'mean ms', 'max ms'])
+    for row in get_summary():
+        table.add_row([row['name'], row['calls'], "%.2f" % row['seconds'], "%.2f" % row['mean_ms'], "%.2f" % row['max_ms']])
+    for name, value in sorted(get_counters().items()):
+        table.add_row([name, value, '', '', ''])
+    return table.get_string()
+
+
+def write_chrome_trace(path):
+    '''
+    Writes the recorded events in the Chrome trace event format.
+    '''
+    with _lock:
+        trace = {'traceEvents': list(_events), 'displayTimeUnit': 'ms',
+                 'otherData': {'start': _start, 'dropped_events': _dropped_events}}
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(trace, f)
+    os.replace(tmp_path, path)
+
+
+def finish():
+    '''
+    Logs the summary table and writes the trace configured in enable(), if profiling is on.
+    '''
+    if not _enabled:
+        return
+    logger.info("Stage timings:\n%s", format_summary())
+    if _trace_path:
+        write_chrome_trace(_trace_path)
+        logger.info("Wrote profiling trace to %s%s", _trace_path,
+                    " (%d events dropped)" % _dropped_events if _dropped_events else "")
@@ -0,0 +1,156 @@
+import os
+import hashlib
+import logging
+import numpy as np
+
+
+logger = logging.getLogger('__name__')
+
+# Channel order of the one-hot labels produced by pipeline.load_data.
+SAMPLER_CLASSES = [0, 7, 8, 9, 45, 51, 52, 53, 68]
+SAMPLER_MODES = ['uniform', 'foreground', 'class_balanced']
+
+
+def compute_class_histograms(y, chunk_size=64, indices=None):
+    '''
+    Counts the pixels of every class in each slice.
+
+    @params y: One-hot labels with shape (num_slices, h, w, num_classes)
+    @params chunk_size: Slices summed at a time, bounding temporary memory
+    @params indices: Optional slice positions in y to count (e.g. the training split of a slice store)
+    @returns: int64 array with shape (num_slices, num_classes)
+    '''
+    if indices is None:
+        indices = np.arange(y.shape[0])
+    histograms = np.zeros((len(indices), y.shape[3]), dtype=np.int64)
+    for start in range(0, len(indices), chunk_size):
+        histograms[start:start+chunk_size] = np.sum(y[indices[start:start+chunk_size]], axis=(1, 2))
+    return histograms
+
+
+def get_fingerprint(y, trials=None):
+    '''
+    Cheap identity of a label array (shape, the trial of every slice and a strided subsample of the labels) used to
+    name and validate a cached index.
+    '''
+    digest = hashlib.sha1(str(y.shape).encode())
+    if trials is not None:
+        digest.update("\n".join(trials).encode())
+    for start in range(0, y.shape[0], 64):
+        digest.update(np.ascontiguousarray(y[start:start+64, ::16, ::16, :]).tobytes())
+    return digest.hexdigest()
+
+
+def get_cache_path(cache_dir, fingerprint):
+    return os.path.join(cache_dir, "slice_index_" + fingerprint[:16] + ".npz")
+
+
+def load_class_histograms(y, cache_dir=None, trials=None):
+    '''
+    Returns the per-slice class histograms of every slice of y, reusing the index in cache_dir computed for the same
+    slices. The index covers the whole slice store rather than one split, so every model trained on the same data
+    (whatever its split or shuffle) shares it.
+
+    @params trials: Optional trial of every slice (see slice_store.SliceStore), part of the cache key
+    '''
+    fingerprint = get_fingerprint(y, trials) if cache_dir else None
+    cache_path = get_cache_path(cache_dir, fingerprint) if cache_dir else None
+    if cache_path and os.path.isfile(cache_path):
+        with np.load(cache_path) as index:
+            if str(index['fingerprint']) == fingerprint:
+                logger.debug("Loaded slice class index from %s", cache_path)
+                return index['histograms']
+    histograms = compute_class_histograms(y)
+    if cache_path:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = cache_path + ".tmp" + str(os.getpid()) + ".npz"
+        np.savez(tmp_path, histograms=histograms, fingerprint=fingerprint)
+        os.replace(tmp_path, cache_path)
+    return histograms
+
+
+def get_slice_weights(histograms, mode='uniform', power=0.5, uniform_mix=0.2):
+    '''
+    Converts class histograms into per-slice sampling probabilities.
+
+    @params mode: 'uniform' (every slice equally likely), 'foreground' (proportional to the foreground pixel fraction)
+        or 'class_balanced' (each foreground class present in a slice contributes 1/(slices containing it)^power, so
+        slices showing rare classes are drawn more often)
+    @params power: Strength of class balancing; 0 weights slices by how many classes they show, 1 fully inverts class frequency
+    @params uniform_mix: Fraction of probability mass spread uniformly, so every slice (even background only) can still be drawn
+    @returns: float64 array of probabilities summing to 1
+    '''
+    num_slices = histograms.shape[0]
+    uniform = np.full(num_slices, 1.0 / num_slices)
+    if mode == 'uniform':
+        return uniform
+
+    foreground = histograms[:, 1:].astype(np.float64)
+    if mode == 'foreground':
+        weights = foreground.sum(axis=1) / np.maximum(histograms.sum(axis=1), 1)
+    elif mode == 'class_balanced':
+        present = foreground > 0
+        slices_per_class = present.sum(axis=0)
+        class_weights = np.where(slices_per_class > 0, 1.0 / np.maximum(slices_per_class, 1) ** power, 0)
+        weights = present.dot(class_weights)
+    else:
+        raise ValueError('Invalid sampler: %s' % mode)
+
+    if weights.sum() == 0:
+        return uniform
+    return (1 - uniform_mix) * weights / weights.sum() + uniform_mix * uniform
+
+
+class SliceSampler(object):
+    '''
+    Draws the slice order of each training epoch. An epoch still has one draw per training slice, but with
+    non-uniform weights slices are drawn with replacement according to their probabilities.
+    '''
+    def __init__(self, weights, mode='uniform'):
+        self.weights = weights
+        self.mode = mode
+
+    def epoch_indices(self):
+        if self.mode == 'uniform':
+            return np.random.permutation(len(self.weights))
+        return np.random.choice(len(self.weights), len(self.weights), replace=True, p=self.weights)
+
+    def expected_class_coverage(self, histograms):
+        '''
+        Expected fraction of drawn slices containing each class, keyed by label value.
+        '''
+        present = histograms > 0
+        return {label: float(self.weights.dot(present[:, k])) for k, label in enumerate(SAMPLER_CLASSES[:histograms.shape[1]])}
+
+
+def get_sampler(params, y_train, cache_dir=None, indices=None, trials=None):
+    '''
+    Builds the sampler configured in a trainingconfig.ini section (sampler, sampler_power, sampler_uniform_mix).
+    Returns None for uniform sampling, which keeps nn.train's plain shuffle.
+
+    @params cache_dir: Optional folder of the class index of y_train (see load_class_histograms)
+    @params indices: Optional training slice positions in y_train; the sampler then draws positions in indices
+    @params trials: Optional trial of every slice of y_train
+    '''
+    mode = params.get('sampler', 'uniform').strip().lower() or 'uniform'
+    if mode not in SAMPLER_MODES:
+        raise ValueError('Invalid sampler: %s' % mode)
+    if mode == 'uniform':
+        return None
+
+    logger.info("Building %s slice sampler.", mode)
+    histograms = load_class_histograms(y_train, cache_dir, trials)
+    if indices is not None:
+        histograms = histograms[indices]
+    weights = get_slice_weights(histograms, mode,
+                                power=float(params.get('sampler_power', 0.5)),
+                                uniform_mix=float(params.get('sampler_uniform_mix', 0.2)))
+    sampler = SliceSampler(weights, mode)
+
+    uniform_coverage = SliceSampler(get_slice_weights(histograms, 'uniform')).expected_class_coverage(histograms)
+    for label, fraction in sorted(sampler.expected_class_coverage(histograms).items()):
+        if label == 0 or not uniform_coverage[label]:
+            continue
+        logger.info("   class %d: in %.1f%% of drawn slices (%.1f%% with uniform sampling)", label, 100 * fraction, 100 * uniform_coverage[label])
+    return sampler
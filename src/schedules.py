@@ -0,0 +1,154 @@
+import math
+import logging
+import nn
+
+
+logger = logging.getLogger('__name__')
+
+##################################
+# LEARNING RATE SCHEDULES
+##################################
+
+# Every schedule answers learning_rate(epoch) before an epoch runs and is told the validation accuracies through
+# update(epoch, acc) afterwards. get_state/set_state let a resumed run continue the schedule where it stopped.
+
+class ConstantSchedule(object):
+    def __init__(self, base_lr):
+        self.base_lr = base_lr
+
+    def learning_rate(self, epoch):
+        return self.base_lr
+
+    def update(self, epoch, acc):
+        pass
+
+    def get_state(self):
+        return {}
+
+    def set_state(self, state):
+        pass
+
+
+class PlateauSchedule(object):
+    '''
+    Multiplies the learning rate by factor whenever the validation Dice has not improved by min_delta for patience
+    epochs, never going below min_lr.
+    '''
+    def __init__(self, base_lr, factor=0.5, patience=3, min_lr=1e-6, min_delta=0.0, labels=None):
+        self.lr = base_lr
+        self.factor = factor
+        self.patience = patience
+        self.min_lr = min_lr
+        self.min_delta = min_delta
+        self.labels = labels
+        self.best = None
+        self.bad_epochs = 0
+
+    def learning_rate(self, epoch):
+        return self.lr
+
+    def update(self, epoch, acc):
+        score = nn.dice_score(acc, self.labels)
+        if self.best is None or score > self.best + self.min_delta:
+            self.best = score
+            self.bad_epochs = 0
+            return
+        self.bad_epochs += 1
+        if self.bad_epochs >= self.patience and self.lr > self.min_lr:
+            self.lr = max(self.lr * self.factor, self.min_lr)
+            self.bad_epochs = 0
+            logger.info("Validation Dice plateaued; learning rate reduced to %g.", self.lr)
+
+    def get_state(self):
+        return {'lr': self.lr, 'best': self.best, 'bad_epochs': self.bad_epochs}
+
+    def set_state(self, state):
+        self.lr, self.best, self.bad_epochs = state['lr'], state['best'], state['bad_epochs']
+
+
+class CosineSchedule(object):
+    '''
+    Cosine annealing from base_lr at epoch 0 to min_lr at the last epoch.
+    '''
+    def __init__(self, base_lr, epochs, min_lr=0.0):
+        self.base_lr = base_lr
+        self.epochs = epochs
+        self.min_lr = min_lr
+
+    def learning_rate(self, epoch):
+        progress = epoch / float(max(self.epochs - 1, 1))
+        return self.min_lr + 0.5 * (self.base_lr - self.min_lr) * (1 + math.cos(math.pi * min(progress, 1.0)))
+
+    def update(self, epoch, acc):
+        pass
+
+    def get_state(self):
+        return {}
+
+    def set_state(self, state):
+        pass
+
+
+##################################
+# EARLY STOPPING
+##################################
+
+class EarlyStopping(object):
+    '''
+    Signals a stop once the validation Dice has not improved by min_delta for patience consecutive epochs.
+    '''
+    def __init__(self, patience, min_delta=0.0, labels=None):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.labels = labels
+        self.best = None
+        self.best_epoch = None
+        self.bad_epochs = 0
+
+    def update(self, epoch, acc):
+        score = nn.dice_score(acc, self.labels)
+        if self.best is None or score > self.best + self.min_delta:
+            self.best, self.best_epoch = score, epoch
+            self.bad_epochs = 0
+        else:
+            self.bad_epochs += 1
+        return self.should_stop()
+
+    def should_stop(self):
+        return self.bad_epochs >= self.patience
+
+    def get_state(self):
+        return {'best': self.best, 'best_epoch': self.best_epoch, 'bad_epochs': self.bad_epochs}
+
+    def set_state(self, state):
+        self.best, self.best_epoch, self.bad_epochs = state['best'], state['best_epoch'], state['bad_epochs']
+
+
+def get_lr_schedule(params, base_lr, epochs, labels=None):
+    '''
+    Builds the schedule named by lr_schedule (constant, plateau or cosine) in a config section.
+    '''
+    name = params.get('lr_schedule', 'constant').strip().lower() or 'constant'
+    min_lr = float(params.get('lr_min', 1e-6))
+    if name == 'constant':
+        return ConstantSchedule(base_lr)
+    if name == 'plateau':
+        return PlateauSchedule(base_lr,
+                               factor=float(params.get('lr_plateau_factor', 0.5)),
+                               patience=int(params.get('lr_plateau_patience', 3)),
+                               min_lr=min_lr,
+                               min_delta=float(params.get('early_stopping_min_delta', 0.0)),
+                               labels=labels)
+    if name == 'cosine':
+        return CosineSchedule(base_lr, epochs, min_lr=min_lr)
+    raise ValueError('Invalid lr_schedule: %s' % name)
+
+
+def get_early_stopping(params, labels=None):
+    '''
+    Returns an EarlyStopping for early_stopping_patience > 0, otherwise None.
+    '''
+    patience = int(params.get('early_stopping_patience', 0))
+    if patience <= 0:
+        return None
+    return EarlyStopping(patience, float(params.get('early_stopping_min_delta', 0.0)), labels)
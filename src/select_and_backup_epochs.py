@@ -8,6 +8,7 @@ import logging
 import pickle
 import time
 import datetime
+import json
 from shutil import copyfile
 
 groups_dir = "/media/jessica/Storage1/models/u-net_v1-0/groups_final_sub"
@@ -66,6 +67,18 @@ desired_epochs = {
 }
 
 
+def get_desired_epoch(group_model_dir, group_folder):
+	# Models trained with a checkpoint manager record their best epoch in a manifest; the hand-maintained
+	# desired_epochs table is only needed for older models.
+	manifest_path = os.path.join(group_model_dir, group_folder + "_manifest.json")
+	if os.path.isfile(manifest_path):
+		with open(manifest_path) as f:
+			manifest = json.load(f)
+		if manifest.get('deployed_epoch') is not None:
+			return manifest['deployed_epoch']
+	return desired_epochs[group_folder]
+
+
 def main():
 	for group_folder in sorted(os.listdir(groups_dir)):
 
@@ -89,9 +102,10 @@ def main():
 		index_target = group_folder + ".index"
 		meta_target = group_folder + ".meta"
 
-		desired_epoch_folder = group_folder + "_epoch_" + str(desired_epochs[group_folder])
+		desired_epoch = get_desired_epoch(group_model_dir, group_folder)
+		desired_epoch_folder = group_folder + "_epoch_" + str(desired_epoch)
 
-		print("\tSelecting epoch", desired_epochs[group_folder], "looking in:", desired_epoch_folder)
+		print("\tSelecting epoch", desired_epoch, "looking in:", desired_epoch_folder)
 
 		data_target_path = os.path.join(os.path.join(group_model_dir, desired_epoch_folder), data_target)
 		index_target_path = os.path.join(os.path.join(group_model_dir, desired_epoch_folder), index_target)
@@ -0,0 +1,141 @@
+import os
+import multiprocessing
+import logging
+from contextlib import contextmanager
+import tensorflow as tf
+
+
+logger = logging.getLogger('__name__')
+
+# Runtime knobs for tf.Session creation. Every key may be set in any section of trainingconfig.ini (or in DEFAULT,
+# which configparser propagates to all sections); missing keys fall back to these values, which reproduce the
+# original hardcoded behavior (GPU 0 visible, TensorFlow-chosen thread pools, no XLA).
+SESSION_DEFAULTS = {
+    'visible_devices': '0',
+    'device': '',
+    'intra_op_threads': '0',
+    'inter_op_threads': '0',
+    'allow_growth': 'false',
+    'gpu_memory_fraction': '0',
+    'xla_jit': 'false',
+    'tower_devices': '',
+    'virtual_cpus': '1',
+}
+
+
+def _parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def _parse_threads(value):
+    """
+    Thread counts accept an integer (0 lets TensorFlow decide) or 'auto', which uses every logical core.
+    """
+    value = str(value).strip().lower()
+    if value == 'auto':
+        return multiprocessing.cpu_count()
+    return int(value)
+
+
+def get_session_params(params, overrides=None):
+    """
+    Extracts and types the session settings from a config section.
+
+    Args:
+        params (dict): Config section as returned by training.get_all_params (string values).
+        overrides (dict): Optional values (e.g. from the command line) that take precedence over params. Entries
+            set to None are ignored.
+
+    Returns:
+        dict: Typed session settings with keys visible_devices, device, intra_op_threads, inter_op_threads,
+            allow_growth, gpu_memory_fraction, xla_jit, tower_devices and virtual_cpus.
+    """
+    merged = dict(SESSION_DEFAULTS)
+    for key in SESSION_DEFAULTS:
+        if key in params:
+            merged[key] = params[key]
+    if overrides:
+        for key, value in overrides.items():
+            if value is not None:
+                merged[key] = value
+
+    return {
+        'visible_devices': str(merged['visible_devices']).strip(),
+        'device': str(merged['device']).strip(),
+        'intra_op_threads': _parse_threads(merged['intra_op_threads']),
+        'inter_op_threads': _parse_threads(merged['inter_op_threads']),
+        'allow_growth': _parse_bool(merged['allow_growth']),
+        'gpu_memory_fraction': float(merged['gpu_memory_fraction']),
+        'xla_jit': _parse_bool(merged['xla_jit']),
+        'tower_devices': str(merged['tower_devices']).strip(),
+        'virtual_cpus': int(merged['virtual_cpus']),
+    }
+
+
+def apply_visible_devices(session_params):
+    """
+    Sets CUDA_VISIBLE_DEVICES. Must run before the first session is created. 'all' leaves the environment alone,
+    and an empty value hides every GPU (CPU-only run).
+    """
+    visible_devices = session_params['visible_devices']
+    if visible_devices.lower() == 'all':
+        return
+    os.environ["CUDA_VISIBLE_DEVICES"] = visible_devices
+
+
+def make_session_config(session_params):
+    config = tf.ConfigProto(allow_soft_placement=True, device_count={'CPU': session_params['virtual_cpus']})
+    config.intra_op_parallelism_threads = session_params['intra_op_threads']
+    config.inter_op_parallelism_threads = session_params['inter_op_threads']
+    config.gpu_options.allow_growth = session_params['allow_growth']
+    if session_params['gpu_memory_fraction'] > 0:
+        config.gpu_options.per_process_gpu_memory_fraction = session_params['gpu_memory_fraction']
+    if session_params['xla_jit']:
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return config
+
+
+def create_session(session_params):
+    logger.debug("Session settings: %s", session_params)
+    return tf.Session(config=make_session_config(session_params))
+
+
+@contextmanager
+def device_scope(session_params):
+    """
+    Places the ops built inside the block on the configured device (e.g. /cpu:0 or /gpu:1). With no device set,
+    placement is left to TensorFlow.
+    """
+    if session_params['device']:
+        with tf.device(session_params['device']):
+            yield
+    else:
+        yield
+
+
+def get_tower_devices(session_params):
+    """
+    Resolves tower_devices into the list of devices used for data-parallel training.
+
+    Accepted values are empty (single device, no towers), 'gpu' (every visible GPU), 'cpu' (one tower per virtual
+    CPU device, see virtual_cpus) or an explicit comma separated list such as '/gpu:0,/gpu:1'.
+
+    Returns:
+        list: Device names. Fewer than two entries means towers are not used.
+    """
+    tower_devices = session_params['tower_devices']
+    if not tower_devices:
+        return []
+    if tower_devices.lower() == 'gpu':
+        from tensorflow.python.client import device_lib
+        local_devices = device_lib.list_local_devices(session_config=make_session_config(session_params))
+        return ['/gpu:%d' % i for i in range(len([d for d in local_devices if d.device_type == 'GPU']))]
+    if tower_devices.lower() == 'cpu':
+        return ['/cpu:%d' % i for i in range(session_params['virtual_cpus'])]
+    return [device.strip() for device in tower_devices.split(',') if device.strip()]
+
+
+def describe(session_params):
+    return ", ".join("%s=%s" % (key, session_params[key]) for key in sorted(session_params))
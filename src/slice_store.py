@@ -0,0 +1,95 @@
+import os
+import logging
+import numpy as np
+import pipeline
+
+
+logger = logging.getLogger('__name__')
+
+
+class SliceStore(object):
+    '''
+    All training slices in one preallocated pair of arrays: x is float32 with shape (N, h, w, 1) and y is the uint8
+    one-hot segmentation with shape (N, h, w, num_classes). Splits, the augmented/original concatenation and
+    shuffling are integer index arrays into these, so no step of train_model copies the dataset again.
+
+    uint8 labels keep one-hot semantics (argmax, sums) at an eighth of the size of the float64 arrays produced by
+    pipeline.load_data; TensorFlow converts each fed minibatch to float32.
+    '''
+    def __init__(self, x, y, trials, augmented, orig_dims=None):
+        self.x = x
+        self.y = y
+        self.trials = trials
+        self.augmented = augmented
+        self.orig_dims = orig_dims
+
+    def __len__(self):
+        return self.x.shape[0]
+
+    def original_indices(self):
+        return np.where(~self.augmented)[0]
+
+    def augmented_indices(self):
+        return np.where(self.augmented)[0]
+
+    def nbytes(self):
+        return self.x.nbytes + self.y.nbytes
+
+
+def load_slice_store(training_dir, no_empty=False, reorient=True, include_lower=True, load_augmented=True, cache_dir=None):
+    '''
+    Loads every trial of training_dir (and, if requested, its augmented copies) into a SliceStore.
+
+    Scans are loaded one at a time and compacted to float32/uint8 straight away, so besides the store only one
+    scan's worth of pipeline.load_data output is alive at any point. The final arrays are allocated with np.empty
+    and filled block by block while the per-scan blocks are released; since untouched pages of np.empty are never
+    committed, peak memory stays close to one copy of the dataset.
+    '''
+    scan_paths = pipeline.find_scan_paths(training_dir, load_augmented=False)
+    augmented_paths = pipeline.find_scan_paths(training_dir, load_augmented=True) if load_augmented else []
+    if not scan_paths:
+        raise ValueError("No trial folders found in %s." % training_dir)
+
+    # Originals and augmented copies share one training size, since they end up in the same arrays.
+    max_dim = pipeline.find_training_dim(scan_paths + augmented_paths)
+    training_dim = 512 if max_dim <= 512 else 1024
+
+    blocks = []
+    orig_dims = None
+    for scan_path in scan_paths + augmented_paths:
+        raw_images, segmentations, dims = pipeline.load_data(scan_path, reorient, training_dim, training_dim, no_empty=no_empty, include_lower=include_lower, cache_dir=cache_dir)
+        if scan_path in scan_paths:
+            orig_dims = dims
+        if not raw_images:
+            continue
+        x_block = np.empty((len(raw_images), training_dim, training_dim, 1), dtype=np.float32)
+        y_block = np.empty((len(segmentations),) + segmentations[0].shape, dtype=np.uint8)
+        for i in range(len(raw_images)):
+            x_block[i, :, :, 0] = raw_images[i]
+            y_block[i] = segmentations[i]
+        del raw_images, segmentations
+        blocks.append((x_block, y_block, os.path.basename(scan_path), scan_path in augmented_paths))
+
+    if not blocks:
+        raise ValueError("No slices loaded from the trial folders in %s (every scan was empty or skipped)." % training_dir)
+
+    num_slices = sum(block[0].shape[0] for block in blocks)
+    x = np.empty((num_slices, training_dim, training_dim, 1), dtype=np.float32)
+    y = np.empty((num_slices,) + blocks[0][1].shape[1:], dtype=np.uint8)
+    trials = []
+    augmented = np.zeros(num_slices, dtype=bool)
+
+    start = 0
+    while blocks:
+        x_block, y_block, trial, is_augmented = blocks.pop(0)
+        end = start + x_block.shape[0]
+        x[start:end] = x_block
+        y[start:end] = y_block
+        trials.extend([trial] * x_block.shape[0])
+        augmented[start:end] = is_augmented
+        del x_block, y_block
+        start = end
+
+    store = SliceStore(x, y, trials, augmented, orig_dims)
+    logger.info("Loaded %d slices (%d augmented) into a %.2f GB slice store.", num_slices, int(augmented.sum()), store.nbytes() / 1024.0 ** 3)
+    return store
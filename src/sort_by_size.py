@@ -1,17 +1,28 @@
 import nibabel as nib
+import json
 import os
 
 target_dir = "/media/jessica/Storage/SubK"
 over_dir = os.path.join(target_dir, "over_512")
 under_dir = os.path.join(target_dir, "under_512")
 
+# Written by convert_mha_to_nii.py; scans missing from it are sized from their NIfTI header.
+index_path = os.path.join(target_dir, "dataset_index.json")
+index = {}
+if os.path.isfile(index_path):
+	with open(index_path) as f:
+		index = json.load(f)
+
 for file in os.listdir(target_dir):
-	if 'trial' in file and 'volume' in file and file.endswith('.nii'):
-		nifti = nib.load(os.path.join(target_dir, file))
-		nifti_shape = nifti.get_fdata().shape
-		sorted_shape = sorted(nifti_shape, reverse=True)[1:]
-		if sorted_shape[0] <= 512 and sorted_shape[1] <= 512:
+	# Hidden files include the partial .tmp<pid>_ outputs of convert_mha_to_nii.py.
+	if not file.startswith('.') and 'trial' in file and 'volume' in file and (file.endswith('.nii') or file.endswith('.nii.gz')):
+		if file in index:
+			bucket = index[file]['size_bucket']
+		else:
+			nifti_shape = nib.load(os.path.join(target_dir, file)).shape
+			sorted_shape = sorted(nifti_shape, reverse=True)[1:]
+			bucket = "under_512" if sorted_shape[0] <= 512 and sorted_shape[1] <= 512 else "over_512"
+		if bucket == "under_512":
 			os.rename(os.path.join(target_dir, file), os.path.join(under_dir, file))
 		else:
 			os.rename(os.path.join(target_dir, file), os.path.join(over_dir, file))
-
@@ -0,0 +1,244 @@
+import os
+import re
+import json
+import datetime
+import logging
+import numpy as np
+import profiling
+
+
+logger = logging.getLogger('__name__')
+
+SPLIT_NAMES = ['train', 'val', 'test']
+
+# Folder suffixes of augmented copies (see pipeline.load_all_data); an augmented trial belongs to its source trial.
+AUGMENTATION_SUFFIX = re.compile(r'(_r-?\d+)?_(ed|rot)$')
+
+# Subject folders of the data layout (Sub[x], see README); trial folder names themselves carry no subject.
+SUBJECT_DIR = re.compile(r'^Sub(\w+)$')
+
+
+def get_trial_id(scan_path, group_pattern=''):
+    '''
+    Maps a trial folder to the unit that is kept together in one split.
+
+    @params scan_path: Path or name of a trial folder, e.g. .../trial11_60_fs or .../trial11_60_fs_ed
+    @params group_pattern: Optional regex applied to the folder name whose first group defines the unit instead,
+        e.g. '^(trial[0-9]+)_' to keep every sweep of a trial number (or a subject prefix) together
+    '''
+    name = AUGMENTATION_SUFFIX.sub('', os.path.basename(os.path.normpath(scan_path)))
+    if group_pattern:
+        match = re.search(group_pattern, name)
+        if match:
+            return match.group(1)
+    return name
+
+
+def get_trial_subject(scan_path, default_subject=''):
+    '''
+    Subject a trial folder belongs to: the innermost Sub[x] folder on its real path (so trial folders linked into
+    a training group from a subject folder are recognized), otherwise default_subject.
+
+    @returns: The subject identifier (e.g. 'B' for SubB), or None if unknown
+    '''
+    for part in reversed(os.path.realpath(scan_path).split(os.sep)):
+        match = SUBJECT_DIR.match(part)
+        if match:
+            return match.group(1)
+    return default_subject or None
+
+
+def get_trial_subjects(training_dir, trial_names, group_pattern='', default_subject=''):
+    '''
+    @params trial_names: Names of the trial folders in training_dir
+    @returns: Dict of trial id -> sorted list of the subjects of its folders (empty if unknown)
+    '''
+    subjects = {}
+    for name in set(trial_names):
+        trial_subjects = subjects.setdefault(get_trial_id(name, group_pattern), [])
+        subject = get_trial_subject(os.path.join(training_dir, name), default_subject)
+        if subject and subject not in trial_subjects:
+            trial_subjects.append(subject)
+    return {trial: sorted(trial_subjects) for trial, trial_subjects in subjects.items()}
+
+
+def get_folder_subjects(training_dir, trial_names, default_subject=''):
+    '''
+    Subject of every trial folder, the unit kept together in one split with split_by = subject.
+
+    @params trial_names: Names of the trial folders in training_dir
+    @returns: Dict of folder name -> subject
+    '''
+    subjects = {name: get_trial_subject(os.path.join(training_dir, name), default_subject) for name in set(trial_names)}
+    unknown = sorted(name for name, subject in subjects.items() if subject is None)
+    if unknown:
+        raise ValueError("No subject for trial folders %s: they are not inside a Sub[x] folder (or linked from one) "
+                         "and split_subject is not set." % unknown)
+    return subjects
+
+
+def split_trials(trial_ids, percent_train, percent_val, percent_test, seed):
+    '''
+    Assigns whole trials to train/val/test with a fixed seed.
+
+    Trials are shuffled (sorted first, so the result does not depend on directory listing order) and cut according
+    to the percentages; val and test each get at least one trial when there are enough trials.
+
+    @returns: Dict of trial id -> 'train', 'val' or 'test'
+    '''
+    assert percent_train + percent_val + percent_test == 100
+    trials = sorted(set(trial_ids))
+    order = np.random.RandomState(seed).permutation(len(trials))
+
+    num_val = int(round(len(trials) * percent_val / 100.0))
+    num_test = int(round(len(trials) * percent_test / 100.0))
+    if percent_val and not num_val and len(trials) > 2:
+        num_val = 1
+    if percent_test and not num_test and len(trials) > 1:
+        num_test = 1
+    num_train = max(len(trials) - num_val - num_test, 1)
+
+    assignment = {}
+    for rank, index in enumerate(order):
+        if rank < num_train:
+            assignment[trials[index]] = 'train'
+        elif rank < num_train + num_val:
+            assignment[trials[index]] = 'val'
+        else:
+            assignment[trials[index]] = 'test'
+    return assignment
+
+
+def get_split_of_trial(manifest, trial_folder, subject=None):
+    '''
+    Looks up the split of a scan by its full trial folder name (e.g. 'trial6_30_fs', as in the prediction file
+    trial6_30_fs_pred_seg.nii) and subject. The folder is mapped to a trial id with the manifest's group pattern,
+    as during training.
+
+    @params subject: Subject of the scan (e.g. 'B'); a trial only matches scans of the subjects recorded for it.
+        Trials without recorded subjects (older manifests, or no Sub[x] folder on the training path and no
+        split_subject) match by name alone. With split_by = subject, the split is that of the subject.
+    @returns: The split, or None if the scan was not part of the split
+    '''
+    if manifest.get('split_by') == 'subject':
+        return get_assignment(manifest).get(subject) if subject is not None else None
+    trial_id = get_trial_id(trial_folder, manifest.get('group_pattern', ''))
+    split = get_assignment(manifest).get(trial_id)
+    if split is None:
+        return None
+    trial_subjects = manifest.get('subjects', {}).get(trial_id)
+    if trial_subjects and subject is not None and subject not in trial_subjects:
+        return None
+    return split
+
+
+def get_manifest_path(models_dir, model_name):
+    return os.path.join(models_dir, model_name, model_name + "_split.json")
+
+
+def get_group_manifest(models_dir, group):
+    '''
+    Split manifest of a trained group, or None if there is no models_dir or the group was not split by trial.
+    '''
+    if not models_dir:
+        return None
+    manifest_path = get_manifest_path(models_dir, group)
+    if not os.path.isfile(manifest_path):
+        return None
+    manifest = read_split_manifest(manifest_path)
+    if not manifest.get('subjects'):
+        logger.warning("%s records no subjects; its trials are matched by folder name in every subject.", manifest_path)
+    return manifest
+
+
+def get_prediction_trial(pred_seg_name):
+    '''
+    Trial folder a prediction was made for, e.g. 'trial6_30_fs' for trial6_30_fs_pred_seg.nii
+    (see pipeline.predict_all_segs).
+    '''
+    name = re.sub(r'\.nii(\.gz)?$', '', pred_seg_name)
+    return re.sub(r'_pred_seg$', '', name)
+
+
+def write_split_manifest(manifest_path, assignment, seed, split_by, group_pattern='', slice_counts=None, subjects=None):
+    manifest = {'split_by': split_by,
+                'group_pattern': group_pattern,
+                'seed': int(seed),
+                'trials': {split: sorted(trial for trial in assignment if assignment[trial] == split) for split in SPLIT_NAMES},
+                'subjects': subjects or {},
+                'slices': slice_counts or {},
+                'created': datetime.datetime.now().isoformat()}
+    if not os.path.isdir(os.path.dirname(manifest_path)):
+        os.makedirs(os.path.dirname(manifest_path))
+    with open(manifest_path + ".tmp", 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def read_split_manifest(manifest_path):
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def update_split_manifest(manifest_path, **values):
+    '''
+    Adds entries (e.g. per-trial test accuracy) to an existing manifest.
+    '''
+    manifest = read_split_manifest(manifest_path)
+    manifest.update(values)
+    with open(manifest_path + ".tmp", 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def get_assignment(manifest):
+    '''
+    Inverts the manifest's split -> trials lists into trial id (subject with split_by = subject) -> split.
+    '''
+    return {trial: split for split in SPLIT_NAMES for trial in manifest['trials'].get(split, [])}
+
+
+def load_or_create_split(manifest_path, trial_ids, percent_train, percent_val, percent_test, seed, split_by, group_pattern='', subjects=None):
+    '''
+    Reuses the manifest next to the model if there is one, so retraining and evaluation see the same trials in each
+    split; otherwise splits trial_ids and writes it.
+
+    @params trial_ids: Unit of every slice: its trial id, or its subject with split_by = subject
+
+    @params subjects: Optional dict of trial id -> subjects (see get_trial_subjects), recorded so evaluation can tell
+        apart trials of different subjects that share a folder name
+    @returns: Dict of trial id -> split
+    '''
+    if os.path.isfile(manifest_path):
+        manifest = read_split_manifest(manifest_path)
+        assignment = get_assignment(manifest)
+        missing = sorted(set(trial_ids) - set(assignment))
+        if missing:
+            raise ValueError("Trials %s are not in split manifest %s." % (missing, manifest_path))
+        if subjects and not manifest.get('subjects'):
+            update_split_manifest(manifest_path, subjects=subjects)
+        logger.info("Using split manifest %s", manifest_path)
+        return assignment
+
+    assignment = split_trials(trial_ids, percent_train, percent_val, percent_test, seed)
+    slice_counts = {split: int(sum(assignment[trial] == split for trial in trial_ids)) for split in SPLIT_NAMES}
+    write_split_manifest(manifest_path, assignment, seed, split_by, group_pattern, slice_counts, subjects)
+    logger.info("Wrote split manifest %s", manifest_path)
+    return assignment
+
+
+@profiling.traced('split')
+def split_indices_by_trial(trial_ids, assignment, total_keep=0):
+    '''
+    Trial-level counterpart of pipeline.split_indices: returns positions instead of copying slices, so callers
+    holding one backing array (see slice_store.SliceStore) can index into it.
+
+    @params trial_ids: Trial id of every slice
+    @params total_keep: If non-zero, a random subset of this many training slices is kept
+    @returns: Integer arrays (train, val, test) of positions in trial_ids
+    '''
+    indices = [np.array([i for i, trial in enumerate(trial_ids) if assignment.get(trial) == split], dtype=np.int64) for split in SPLIT_NAMES]
+    if total_keep != 0 and len(indices[0]) > total_keep:
+        indices[0] = np.sort(np.random.choice(indices[0], total_keep, replace=False))
+    logger.debug("Slices per split: %s", dict(zip(SPLIT_NAMES, [len(split) for split in indices])))
+    return tuple(indices)
@@ -0,0 +1,106 @@
+import os
+import queue
+import logging
+import threading
+import multiprocessing
+import numpy as np
+
+
+logger = logging.getLogger('__name__')
+
+
+class ValidationWorker(object):
+    '''
+    Computes validation Dice for exported epoch checkpoints in a separate process, so the training loop never waits
+    for a validation pass.
+
+    The validation set is written once to .npy files in work_dir and memory-mapped by the worker, which builds its
+    own copy of the network, restores each submitted checkpoint and sends back (epoch, step, acc). Jobs are handled
+    in submission order, so results arrive in epoch order.
+    '''
+    def __init__(self, x_val, y_val, model_args, h, w, model_name, work_dir, visible_devices=''):
+        '''
+        @params model_args: Positional arguments of Unet.Unet, as used by the training graph
+        @params h, w: Slice dimensions
+        @params work_dir: Folder for the exported validation arrays (the model directory)
+        @params visible_devices: CUDA_VISIBLE_DEVICES for the worker; empty runs validation on the CPU
+        '''
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+        self.x_path = os.path.join(work_dir, model_name + "_validation_x.npy")
+        self.y_path = os.path.join(work_dir, model_name + "_validation_y.npy")
+        np.save(self.x_path, x_val)
+        # One-hot labels are 0/1, so uint8 keeps argmax intact at a quarter of the size.
+        np.save(self.y_path, y_val.astype(np.uint8))
+
+        # submit() may be called from the checkpoint writer thread.
+        self.pending = 0
+        self.lock = threading.Lock()
+        context = multiprocessing.get_context('spawn')
+        self.jobs = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(target=_worker_main,
+                                       args=(self.jobs, self.results, self.x_path, self.y_path, model_args, h, w,
+                                             model_name, visible_devices))
+        self.process.daemon = True
+        self.process.start()
+
+    def submit(self, epoch, step, checkpoint_path):
+        with self.lock:
+            self.pending += 1
+        self.jobs.put((epoch, step, checkpoint_path))
+
+    def poll(self, block=False):
+        '''
+        Returns the (epoch, step, acc) results that have arrived. With block=True, waits for every pending job.
+        '''
+        done = []
+        while self.pending:
+            try:
+                result = self.results.get(block=block, timeout=5 if block else None)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError("Validation worker exited with code %s." % self.process.exitcode)
+                if not block:
+                    break
+                continue
+            with self.lock:
+                self.pending -= 1
+            if isinstance(result[2], str):
+                raise RuntimeError("Validation of epoch %d failed: %s" % (result[0], result[2]))
+            done.append(result)
+        return done
+
+    def close(self):
+        if self.process.is_alive():
+            self.jobs.put(None)
+            self.process.join()
+        for path in (self.x_path, self.y_path):
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+def _worker_main(jobs, results, x_path, y_path, model_args, h, w, model_name, visible_devices):
+    os.environ["CUDA_VISIBLE_DEVICES"] = visible_devices
+    import tensorflow as tf
+    import nn
+    import Unet
+
+    x_val = np.load(x_path, mmap_mode='r')
+    y_val = np.load(y_path, mmap_mode='r')
+    model = Unet.Unet(*model_args, h=h, w=w)
+    saver = tf.train.Saver()
+    sess = tf.Session()
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        epoch, step, checkpoint_path = job
+        try:
+            saver.restore(sess, os.path.join(checkpoint_path, model_name))
+            acc = nn.validate(sess, model, x_val, y_val)
+            results.put((epoch, step, [float(a) for a in acc]))
+        except Exception as e:
+            results.put((epoch, step, str(e)))
+    sess.close()
@@ -0,0 +1,60 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from elastix_log import parse_duration, parse_elastix_log
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def read_log(name):
+    with open(os.path.join(DATA_DIR, name)) as f:
+        return f.read()
+
+
+def test_parse_duration():
+    assert parse_duration('0.071 s.') == 0.071
+    assert parse_duration('1.8s') == 1.8
+    assert parse_duration('7m43.2s.') == 463.2
+    assert parse_duration('1h2m5.5s') == 3725.5
+    assert parse_duration('1d0h0m1s') == 86401.0
+    assert parse_duration('12.5') == 12.5
+    assert parse_duration('n/a') is None
+
+
+def test_parse_library_log():
+    # Written by ElastixImageFilter, which runs "parameter map N" stages
+    stages = parse_elastix_log(read_log('elastix_library.log'))
+    assert [stage['stage'] for stage in stages] == [0, 1]
+
+    affine, bspline = stages
+    assert affine['seconds'] == 1.8
+    assert affine['final_metric'] == -0.50987
+    assert [r['resolution'] for r in affine['resolutions']] == [0, 1]
+    assert [r['iterations'] for r in affine['resolutions']] == [4, 2]
+    assert affine['resolutions'][0]['seconds'] == 0.071
+    assert affine['resolutions'][0]['final_metric'] == -0.448115
+    assert affine['resolutions'][1]['stopping_condition'] == 'Maximum number of iterations has been reached'
+
+    assert bspline['seconds'] == 3725.5
+    assert len(bspline['resolutions']) == 1
+    assert bspline['resolutions'][0]['seconds'] == 463.2
+    assert bspline['resolutions'][0]['iterations'] == 3
+
+
+def test_resolution_resets_between_stages():
+    # Lines of a stage before its first "Resolution:" must not update the previous stage's last resolution
+    text = read_log('elastix_library.log').replace('Resolution: 0\nInitialization of AdvancedMattesMutualInformation '
+                                                   'metric took: 29 ms.', 'Initialization took: 29 ms.')
+    affine, bspline = parse_elastix_log(text)
+    assert bspline['resolutions'] == []
+    assert affine['resolutions'][1]['iterations'] == 2
+    assert affine['resolutions'][1]['seconds'] == 0.098
+
+
+def test_parse_command_line_log():
+    text = read_log('elastix_library.log').replace('parameter map', 'parameter file')
+    stages = parse_elastix_log(text)
+    assert [stage['seconds'] for stage in stages] == [1.8, 3725.5]
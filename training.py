@@ -7,12 +7,21 @@ import nn
 from math import floor, ceil
 import pipeline
 import Unet
+import session_config
+import checkpointing
+import schedules
+import validation_worker
+import sampler
+import splits
+import slice_store
+import augmentation
+import profiling
 import logging
 import argparse
 import configparser
 import pickle
+import json
 from shutil import copyfile
-os.environ["CUDA_VISIBLE_DEVICES"]="0"
 
 
 logger = logging.getLogger('__name__')
@@ -22,16 +31,22 @@ logger.handlers = []
 logger.addHandler(stream)
 logger.setLevel(logging.INFO)
 
-fh = logging.FileHandler('training_log.log')
-fh.setLevel(logging.DEBUG)
-logger.addHandler(fh)
-
 logging.getLogger('PIL').setLevel(logging.ERROR)
 logging.getLogger('PIL.Image').setLevel(logging.ERROR)
 logging.getLogger('tensorflow').setLevel(logging.ERROR)
 
+def get_log_path(model_name):
+    # Each model logs to its own file so that several trainings can share a working directory.
+    return model_name + '_training_log.log' if model_name else 'training_log.log'
+
+def add_log_file(log_path):
+    fh = logging.FileHandler(log_path)
+    fh.setLevel(logging.DEBUG)
+    logger.addHandler(fh)
+
 def main():
     args = get_args()
+    add_log_file(get_log_path(args.model_name))
 
     if not os.path.isfile('trainingconfig.ini'):
         logger.info("No config file found, setting defaults.")
@@ -44,6 +59,16 @@ def main():
     if args.debug:
         logger.setLevel(level=logging.DEBUG)
 
+    session_params = session_config.get_session_params(training_params, get_session_overrides(args))
+    session_config.apply_visible_devices(session_params)
+
+    data_cache_dir = args.data_cache_dir if args.data_cache_dir is not None else training_params.get('data_cache_dir', '')
+    profile_trace = args.profile if args.profile is not None else training_params.get('profile_trace', '')
+    if profile_trace:
+        profiling.enable(profile_trace)
+    selection_labels = parse_labels(training_params.get('selection_labels', ''))
+    stats = {}
+
     losses, accs, test_acc = train_model(training_params['models_dir'],
                                          training_params['training_data_dir'],
                                          int(training_params['epochs']),
@@ -59,11 +84,32 @@ def main():
                                          int(training_params['mean']),
                                          float(training_params['weight_decay']),
                                          float(training_params['learning_rate']),
-                                         float(training_params['dropout']))
+                                         float(training_params['dropout']),
+                                         session_params=session_params,
+                                         data_cache_dir=data_cache_dir or None,
+                                         stats=stats,
+                                         resume=args.resume,
+                                         async_checkpoint=training_params.get('async_checkpoint', 'false').lower() == 'true',
+                                         keep_best=int(training_params.get('keep_best_checkpoints', 0)),
+                                         selection_labels=selection_labels,
+                                         lr_schedule=schedules.get_lr_schedule(training_params,
+                                                                               float(training_params['learning_rate']),
+                                                                               int(training_params['epochs']),
+                                                                               selection_labels),
+                                         early_stopping=schedules.get_early_stopping(training_params, selection_labels),
+                                         async_validation=training_params.get('async_validation', 'false').lower() == 'true',
+                                         validation_visible_devices=training_params.get('validation_visible_devices', ''),
+                                         sampler_params=training_params,
+                                         split_by=training_params.get('split_by', 'slice').strip().lower() or 'slice',
+                                         split_seed=int(training_params['split_seed']) if training_params.get('split_seed', '').strip() else None,
+                                         split_group_pattern=training_params.get('split_group_pattern', ''),
+                                         split_subject=training_params.get('split_subject', '').strip(),
+                                         augmenter=augmentation.get_augmenter(training_params))
 
     logger.info("Saving training history and info.")
 
-    save_training_hist(losses, accs, test_acc, training_params['models_dir'], args.model_name, args.session_config)
+    save_training_hist(losses, accs, test_acc, training_params['models_dir'], args.model_name, args.session_config, stats=stats)
+    profiling.finish()
 
 
 def configure_default_dirs(default_models_dir, default_training_data_dir):
@@ -103,6 +149,33 @@ def configure_defaults():
     config['DEFAULT']['ckpt_n_hours'] = '1'
     config['DEFAULT']['ckpt_n_epochs'] = '5'
     config['DEFAULT']['keep_percent'] = '100'
+    config['DEFAULT']['data_cache_dir'] = ''
+    config['DEFAULT']['async_checkpoint'] = 'true'
+    config['DEFAULT']['keep_best_checkpoints'] = '3'
+    config['DEFAULT']['selection_labels'] = '7,52'
+    config['DEFAULT']['early_stopping_patience'] = '0'
+    config['DEFAULT']['early_stopping_min_delta'] = '0.001'
+    config['DEFAULT']['lr_schedule'] = 'constant'
+    config['DEFAULT']['lr_plateau_factor'] = '0.5'
+    config['DEFAULT']['lr_plateau_patience'] = '2'
+    config['DEFAULT']['lr_min'] = '1e-6'
+    config['DEFAULT']['async_validation'] = 'false'
+    config['DEFAULT']['validation_visible_devices'] = ''
+    config['DEFAULT']['sampler'] = 'uniform'
+    config['DEFAULT']['sampler_power'] = '0.5'
+    config['DEFAULT']['sampler_uniform_mix'] = '0.2'
+    config['DEFAULT']['split_by'] = 'slice'
+    config['DEFAULT']['split_seed'] = ''
+    config['DEFAULT']['split_group_pattern'] = ''
+    config['DEFAULT']['split_subject'] = ''
+    config['DEFAULT']['online_augmentation'] = 'false'
+    config['DEFAULT']['aug_probability'] = '0.5'
+    config['DEFAULT']['aug_max_rotation'] = '30'
+    config['DEFAULT']['aug_alphas'] = '5,15'
+    config['DEFAULT']['aug_sigmas'] = '1,3'
+    config['DEFAULT']['profile_trace'] = ''
+    for key, value in session_config.SESSION_DEFAULTS.items():
+        config['DEFAULT'][key] = value
 
     with open('trainingconfig.ini', 'w') as configfile:
         config.write(configfile)
@@ -130,6 +203,18 @@ def get_args():
     parser.add_argument('--default-training_data_dir', '-dt', action='store')
     parser.add_argument('--debug', '-de', action='store_true')
     parser.add_argument('--epochs', '-e', action='store', type=int, default=50)
+    parser.add_argument('--visible-devices', action='store', default=None)
+    parser.add_argument('--device', action='store', default=None)
+    parser.add_argument('--intra-op-threads', action='store', default=None)
+    parser.add_argument('--inter-op-threads', action='store', default=None)
+    parser.add_argument('--allow-growth', action='store_const', const='true', default=None)
+    parser.add_argument('--xla', action='store_const', const='true', default=None)
+    parser.add_argument('--tower-devices', action='store', default=None)
+    parser.add_argument('--virtual-cpus', action='store', default=None)
+    parser.add_argument('--gpu-memory-fraction', action='store', default=None)
+    parser.add_argument('--data-cache-dir', action='store', default=None)
+    parser.add_argument('--resume', '-r', action='store_true')
+    parser.add_argument('--profile', action='store', default=None, help='Time pipeline stages and write a Chrome trace to this .json file.')
 
     args = parser.parse_args()
 
@@ -139,7 +224,21 @@ def get_args():
 
     return args
 
-def save_training_hist(losses, val_accs, test_acc, models_dir, model_name, session_config):
+def parse_labels(value):
+    return [int(label) for label in value.split(',') if label.strip()]
+
+def get_session_overrides(args):
+    return {'visible_devices': args.visible_devices,
+            'device': args.device,
+            'intra_op_threads': args.intra_op_threads,
+            'inter_op_threads': args.inter_op_threads,
+            'allow_growth': args.allow_growth,
+            'xla_jit': args.xla,
+            'gpu_memory_fraction': args.gpu_memory_fraction,
+            'tower_devices': args.tower_devices,
+            'virtual_cpus': args.virtual_cpus}
+
+def save_training_hist(losses, val_accs, test_acc, models_dir, model_name, session_config, stats=None):
     loss_list_name = model_name + "_losses"
     val_accs_name = model_name + "_val_accs"
     test_acc_name = model_name + "_test_acc"
@@ -172,6 +271,11 @@ def save_training_hist(losses, val_accs, test_acc, models_dir, model_name, sessi
         for item in test_acc:
             f.write("%s\n" % item)
 
+    if stats:
+        stats_path = os.path.join(os.path.join(models_dir, model_name), model_name + "_train_stats.json")
+        with open(stats_path, 'w') as f:
+            json.dump(stats, f)
+
     orig_config = './trainingconfig.ini'
     config_name = model_name + "_config_" + str(session_config) + ".ini"
     new_config = os.path.join(os.path.join(models_dir, model_name), config_name)
@@ -179,8 +283,24 @@ def save_training_hist(losses, val_accs, test_acc, models_dir, model_name, sessi
 
     new_training_log_path = os.path.join(os.path.join(models_dir, model_name), 'training_log.log')
 
-    copyfile('./training_log.log', new_training_log_path)
-    os.remove('./training_log.log')
+    copyfile(get_log_path(model_name), new_training_log_path)
+    os.remove(get_log_path(model_name))
+
+def get_split_seed(models_dir, model_name, resume):
+    model_path = os.path.join(models_dir, model_name)
+    seed_path = os.path.join(model_path, model_name + "_split_seed")
+    if resume:
+        if os.path.isfile(seed_path):
+            with open(seed_path) as f:
+                return int(f.read())
+        logger.warning("No split seed found for %s; the resumed run will use a new data split.", model_name)
+
+    seed = np.random.randint(2**31 - 1)
+    if not os.path.isdir(model_path):
+        os.makedirs(model_path)
+    with open(seed_path, 'w') as f:
+        f.write(str(seed))
+    return seed
 
 def train_model(models_dir,
                 training_data_dir,
@@ -197,114 +317,280 @@ def train_model(models_dir,
                 mean,
                 weight_decay,
                 learning_rate,
-                dropout):
+                dropout,
+                session_params=None,
+                data_cache_dir=None,
+                stats=None,
+                resume=False,
+                async_checkpoint=False,
+                keep_best=0,
+                selection_labels=None,
+                lr_schedule=None,
+                early_stopping=None,
+                async_validation=False,
+                validation_visible_devices='',
+                sampler_params=None,
+                split_by='slice',
+                split_seed=None,
+                split_group_pattern='',
+                split_subject='',
+                augmenter=None):
+
+    if split_by not in ('slice', 'trial', 'subject'):
+        raise ValueError('Invalid split_by: %s' % split_by)
 
     logger.info("Fetching data.")
 
-    # NOTE: There is a potential bug here where the sizes of augmented/nonaugmented data do not match, i.e. one group is  > 512 and one is < 512. This case is (probably) not handled properly. 
-
-    raw_data_lst_nonaug, seg_data_lst_nonaug, orig_dims = pipeline.load_all_data(training_data_dir, no_empty=True, reorient=True, predicting=False, include_lower=False, load_augmented=False)
+    # Originals and augmented copies are loaded into one backing store, padded to a common size; everything below
+    # works on index arrays into it. With online augmentation, the _ed/_rot copies are not needed at all.
+    if augmenter:
+        logger.info("Online augmentation enabled; skipping augmented trial folders.")
+    store = slice_store.load_slice_store(training_data_dir, no_empty=True, reorient=True, include_lower=False, load_augmented=not augmenter, cache_dir=data_cache_dir)
+    orig_dims = store.orig_dims
 
-    raw_data_lst_aug, seg_data_lst_aug, aug_dims = pipeline.load_all_data(training_data_dir, no_empty=True, reorient=True, predicting=False, include_lower=False, load_augmented=True)
-
-
-
-    training_height, training_width = raw_data_lst_nonaug[0].shape[0], raw_data_lst_nonaug[0].shape[1]
-
-    print("type(seg_data_lst_nonaug):", type(seg_data_lst_nonaug))
-    print("type(seg_data_lst_nonaug[0]):", type(seg_data_lst_nonaug[0]))
-
-    print("len(raw_data_lst_nonaug), len(seg_data_lst_nonaug): ", len(raw_data_lst_nonaug), len(seg_data_lst_nonaug))
+    training_height, training_width = store.x.shape[1], store.x.shape[2]
 
     print("training_height, training_width: ", training_height, training_width)
 
-    print("raw_data_lst_nonaug[0].shape: ", raw_data_lst_nonaug[0].shape)
-    print("seg_data_lst_nonaug[0].shape: ", seg_data_lst_nonaug[0].shape)
-
-
-
     logger.debug("ORIG DIMS: %s", orig_dims)
 
     logger.info("Initializing model.")
 
+    if session_params is None:
+        session_params = session_config.get_session_params({})
+
     tf.reset_default_graph()
-    sess = tf.Session()
-    model = Unet.Unet(mean, weight_decay, learning_rate, dropout, h=training_height, w=training_width)
+    sess = session_config.create_session(session_params)
+    tower_devices = session_config.get_tower_devices(session_params)
+    if len(tower_devices) > 1 and batch_size < len(tower_devices):
+        logger.warning("Batch size %d is smaller than the number of towers (%d); some towers will idle.", batch_size, len(tower_devices))
+    with session_config.device_scope(session_params):
+        model = Unet.Unet(mean, weight_decay, learning_rate, dropout, h=training_height, w=training_width, devices=tower_devices)
     sess.run(tf.global_variables_initializer())
+    # With a checkpoint manager, pruning is driven by validation Dice instead of recency.
+    if keep_best:
+        max_to_keep = 0
     saver = tf.train.Saver(max_to_keep=max_to_keep, keep_checkpoint_every_n_hours=ckpt_n_hours)
 
-    x_train, x_val, x_test, y_train, y_val, y_test = pipeline.split_data(raw_data_lst_nonaug,
-                                                                         seg_data_lst_nonaug,
-                                                                         train_percent,
-                                                                         val_percent,
-                                                                         test_percent,
-                                                                         keep_percent,
-                                                                         total_keep = 500)
-
-
-    if len(raw_data_lst_aug) > 0:
+    # Seeding the split lets a resumed run rebuild exactly the same train/val/test sets.
+    seed = get_split_seed(models_dir, model_name, resume)
+    np.random.seed(seed)
+
+    original_indices = store.original_indices()
+    augmented_indices = store.augmented_indices()
+
+    split_manifest_path, test_trials = None, None
+    if split_by == 'slice':
+        train_indices, val_indices, test_indices = pipeline.split_indices(len(original_indices),
+                                                                          train_percent,
+                                                                          val_percent,
+                                                                          test_percent,
+                                                                          keep_percent,
+                                                                          total_keep = 500)
+    else:
+        # Whole trials (or subjects) go to one split, so neighboring slices of a sweep never end up on both sides.
+        split_manifest_path = splits.get_manifest_path(models_dir, model_name)
+        trial_ids = [splits.get_trial_id(store.trials[i], split_group_pattern) for i in original_indices]
+        subjects = splits.get_trial_subjects(training_data_dir, [store.trials[i] for i in original_indices], split_group_pattern, split_subject)
+        unit_ids = trial_ids
+        if split_by == 'subject':
+            folder_subjects = splits.get_folder_subjects(training_data_dir, [store.trials[i] for i in original_indices], split_subject)
+            unit_ids = [folder_subjects[store.trials[i]] for i in original_indices]
+        assignment = splits.load_or_create_split(split_manifest_path,
+                                                 unit_ids,
+                                                 train_percent,
+                                                 val_percent,
+                                                 test_percent,
+                                                 split_seed if split_seed is not None else seed,
+                                                 split_by,
+                                                 split_group_pattern,
+                                                 subjects)
+        train_indices, val_indices, test_indices = splits.split_indices_by_trial(unit_ids, assignment, total_keep = 500)
+        test_trials = [trial_ids[i] for i in test_indices]
+        if keep_percent != 100:
+            logger.warning("keep_percent is ignored when splitting by %s.", split_by)
+
+    # Positions within the original slices -> positions in the store.
+    train_indices = original_indices[train_indices]
+    val_indices = np.sort(original_indices[val_indices])
+    test_order = np.argsort(original_indices[test_indices], kind='stable')
+    test_indices = original_indices[test_indices][test_order]
+    if test_trials is not None:
+        test_trials = [test_trials[i] for i in test_order]
+
+
+    if len(augmented_indices) > 0:
         logger.debug("Splitting augmented data.")
-        x_train_aug, x_val_aug, x_test_aug, y_train_aug, y_val_aug, y_test_aug = pipeline.split_data(raw_data_lst_aug,
-                                                                                                     seg_data_lst_aug,
-                                                                                                     percent_train = 90,
-                                                                                                     percent_val = 5,
-                                                                                                     percent_test = 5,
-                                                                                                     percent_keep = 100,
-                                                                                                     total_keep = 1000)
+        if split_by == 'slice':
+            train_aug, val_aug, test_aug = pipeline.split_indices(len(augmented_indices),
+                                                                  percent_train = 90,
+                                                                  percent_val = 5,
+                                                                  percent_test = 5,
+                                                                  percent_keep = 100,
+                                                                  total_keep = 1000)
+        else:
+            # Augmented copies are only used for training, and only those of training trials (or subjects).
+            if split_by == 'subject':
+                # A copy belongs to the subject of its source folder.
+                aug_ids = [folder_subjects.get(splits.get_trial_id(store.trials[i])) for i in augmented_indices]
+            else:
+                aug_ids = [splits.get_trial_id(store.trials[i], split_group_pattern) for i in augmented_indices]
+            aug_assignment = {trial: 'train' for trial in aug_ids if assignment.get(trial) == 'train'}
+            train_aug = splits.split_indices_by_trial(aug_ids, aug_assignment, total_keep = 1000)[0]
 
         logger.debug("Extending training set.")
 
-        x_train = np.concatenate((x_train, x_train_aug))
-        y_train = np.concatenate((y_train, y_train_aug))
-
-        logger.debug("Generated random indices.")
-
-        indices = np.arange(x_train.shape[0])
-        np.random.shuffle(indices)
+        train_indices = np.concatenate((train_indices, augmented_indices[train_aug]))
 
         logger.debug("Shuffling training set.")
 
-        x_train = x_train[indices]
-        y_train = y_train[indices]
-
-
+        np.random.shuffle(train_indices)
+
+    logger.info("Slices: %d train, %d validation, %d test (%.2f GB store, no copies).", len(train_indices), len(val_indices), len(test_indices), store.nbytes() / 1024.0 ** 3)
+
+
+    slice_sampler = None
+    if sampler_params:
+        # Shared by every model trained on the same slices; train_indices picks this model's training slices.
+        slice_sampler = sampler.get_sampler(sampler_params, store.y, data_cache_dir or models_dir, train_indices, store.trials)
+
+    # Asynchronous validation checkpoints every epoch; only the checkpoint manager's Dice-based pruning guarantees an
+    # epoch folder is not removed before the worker has scored it.
+    if async_validation and not keep_best:
+        logger.warning("Asynchronous validation requires keep_best_checkpoints > 0; validating inline instead.")
+        async_validation = False
+
+    checkpoint_manager = None
+    if keep_best:
+        checkpoint_manager = checkpointing.CheckpointManager(models_dir, model_name, keep_best, selection_labels)
+
+    start_epoch, start_step, history = 0, 0, None
+    if resume:
+        checkpoint_path, checkpoint_epoch = pipeline.find_latest_checkpoint(models_dir, model_name)
+        if checkpoint_path:
+            logger.info("Resuming from %s.", checkpoint_path)
+            saver.restore(sess, os.path.join(checkpoint_path, model_name))
+            history = nn.load_train_state(checkpoint_path, model_name)
+            np.random.set_state(history['rng_state'])
+            start_epoch, start_step = history['epoch'] + 1, history['step']
+            if stats is not None and history.get('stats'):
+                stats.update(history['stats'])
+            if checkpoint_manager:
+                checkpoint_manager.restore(pipeline.list_epoch_checkpoints(models_dir, model_name), history['accs'])
+            if lr_schedule and history.get('lr_schedule') is not None:
+                lr_schedule.set_state(history['lr_schedule'])
+            if early_stopping and history.get('early_stopping') is not None:
+                early_stopping.set_state(history['early_stopping'])
+        else:
+            logger.info("No resumable checkpoint found; starting from scratch.")
 
     logger.info("Training model. Details:")
     logger.info(" * Model name: %s", model_name)
     logger.info(" * Epochs: %d", num_epochs)
+    if start_epoch:
+        logger.info(" * Resuming at epoch: %d (step %d)", start_epoch, start_step)
     logger.info(" * Batch size: %d", batch_size)
-    logger.info(" * Max checkpoints to keep: %d", max_to_keep)
+    # With keep_best the saver keeps everything (max_to_keep = 0) and the checkpoint manager prunes, logged below.
+    if not keep_best:
+        logger.info(" * Max checkpoints to keep: %d", max_to_keep)
     logger.info(" * Keeping checkpoint every n hours: %d", ckpt_n_hours)
     logger.info(" * Keeping checkpoint every n epochs: %d", auto_save_interval)
+    logger.info(" * Asynchronous checkpoints: %s", async_checkpoint)
+    if keep_best:
+        logger.info(" * Keeping best %d checkpoints by validation Dice (labels: %s)", keep_best, selection_labels or "all")
+    if lr_schedule:
+        logger.info(" * Learning rate schedule: %s", type(lr_schedule).__name__)
+    if early_stopping:
+        logger.info(" * Early stopping: patience %d epochs, min delta %g", early_stopping.patience, early_stopping.min_delta)
+    if async_validation:
+        logger.info(" * Asynchronous validation on %s", "GPU " + validation_visible_devices if validation_visible_devices else "CPU")
+    if slice_sampler:
+        logger.info(" * Slice sampler: %s", slice_sampler.mode)
+    if augmenter:
+        logger.info(" * Online augmentation: %s", augmenter.describe())
+    logger.info(" * Data split: by %s%s", split_by, " (manifest %s)" % split_manifest_path if split_manifest_path else "")
     logger.info(" * Model directory save destination: %s", models_dir)
     logger.info(" * Training data directory: %s", training_data_dir)
+    if data_cache_dir:
+        logger.info(" * Preprocessed data cache: %s", data_cache_dir)
+    logger.info(" * Session: %s", session_config.describe(session_params))
+    if model.devices:
+        logger.info(" * Data-parallel towers: %s (global batch split across towers)", ", ".join(model.devices))
+
+    losses, accs = (history['losses'], history['accs']) if history else ([], [])
+
+    checkpointer = None
+    if async_checkpoint:
+        checkpointer = checkpointing.AsyncCheckpointer(saver, max_to_keep=max_to_keep, keep_checkpoint_every_n_hours=ckpt_n_hours)
+
+    validator = None
+    if async_validation:
+        validator = validation_worker.ValidationWorker(store.x[val_indices], store.y[val_indices], (mean, weight_decay, learning_rate, dropout),
+                                                        training_height, training_width, model_name,
+                                                        os.path.join(models_dir, model_name), validation_visible_devices)
 
     try:
         losses, accs = nn.train(sess,
                                 model,
                                 saver,
-                                x_train,
-                                y_train,
-                                x_val,
-                                y_val,
+                                store.x,
+                                store.y,
+                                store.x,
+                                store.y,
                                 num_epochs,
                                 batch_size,
                                 auto_save_interval,
                                 models_dir = models_dir,
-                                model_name = model_name)
+                                model_name = model_name,
+                                stats = stats,
+                                start_step = start_step,
+                                start_epoch = start_epoch,
+                                history = history,
+                                checkpointer = checkpointer,
+                                checkpoint_manager = checkpoint_manager,
+                                lr_schedule = lr_schedule,
+                                early_stopping = early_stopping,
+                                validator = validator,
+                                sampler = slice_sampler,
+                                train_indices = train_indices,
+                                val_indices = val_indices,
+                                augmenter = augmenter)
     except KeyboardInterrupt:
         logger.info("Training interrupted.")
-
-    logger.info("Training done. Saving model.")
+    finally:
+        if checkpointer:
+            logger.info("Waiting for pending checkpoints to be written.")
+            checkpointer.close()
+        if validator:
+            validator.close()
+
+    best_epoch = checkpoint_manager.best_epoch() if checkpoint_manager else None
+    if best_epoch is not None:
+        logger.info("Training done. Promoting epoch %d (best validation Dice) to the saved model.", best_epoch)
+        saver.restore(sess, os.path.join(checkpoint_manager.checkpoints[best_epoch], model_name))
+    else:
+        logger.info("Training done. Saving model.")
 
     pipeline.save_model(models_dir, model_name, saver, sess)
 
     logger.info("Computing accuracy on test set.")
 
-    test_acc = nn.validate(sess, model, x_test, y_test, verbose=True)
+    test_acc = nn.validate(sess, model, store.x, store.y, verbose=True, indices=test_indices)
 
     logger.info("Test accuracy: %s", test_acc)
 
+    if split_manifest_path:
+        test_acc_by_trial = nn.validate_by_trial(sess, model, store.x, store.y, test_trials, indices=test_indices)
+        for trial in sorted(test_acc_by_trial):
+            logger.info(" * %s: %s", trial, np.round(test_acc_by_trial[trial], 3))
+        splits.update_split_manifest(split_manifest_path,
+                                     test_acc=[float(a) for a in test_acc],
+                                     test_acc_by_trial={trial: [float(a) for a in acc] for trial, acc in test_acc_by_trial.items()})
+
+    if best_epoch is not None:
+        manifest_path = checkpoint_manager.write_manifest(best_epoch, test_acc)
+        logger.info("Wrote deployment manifest %s", manifest_path)
+
     return losses, accs, test_acc
 
 if __name__ == '__main__':
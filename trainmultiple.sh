@@ -1,20 +1,27 @@
-python training.py C_augs_group -de -s C_augs_group
-sleep 20
+# Trains the listed trainingconfig.ini sections as a queue across the given GPUs, sharing one preprocessed data
+# cache. Add or remove section names below; see schedule_training.py --help for CPU slots, memory budgets and retries.
+python schedule_training.py C_augs_group F_augs_group G_augs_group F_G_augs_group H_augs_group K_augs_group --devices 0 -de
 
-python training.py F_augs_group -de -s F_augs_group
-sleep 20
 
-python training.py G_augs_group -de -s G_augs_group
-sleep 20
+# Serial equivalent, kept for reference:
 
-python training.py F_G_augs_group -de -s F_G_augs_group
-sleep 20
+# python training.py C_augs_group -de -s C_augs_group
+# sleep 20
 
-python training.py H_augs_group -de -s H_augs_group
-sleep 20
+# python training.py F_augs_group -de -s F_augs_group
+# sleep 20
 
-python training.py K_augs_group -de -s K_augs_group
-sleep 20
+# python training.py G_augs_group -de -s G_augs_group
+# sleep 20
+
+# python training.py F_G_augs_group -de -s F_G_augs_group
+# sleep 20
+
+# python training.py H_augs_group -de -s H_augs_group
+# sleep 20
+
+# python training.py K_augs_group -de -s K_augs_group
+# sleep 20
 
 
 # python predict_all_groups.py